@@ -7,23 +7,33 @@
 		 scan using an MCC118 DAQ Hat. This program also utilizes a 
 		 Ronoth LoStik as a method to initiate the scan using a long-
 		 distance LoRa radio signal on the 913 MHz band. The data is 
-		 then saved to a CSV file onboard Raspberry Pi.
+		 then saved to a CSV or binary file onboard Raspberry Pi.
 """
 
-import sys
 import time
 import serial
 import os
-import csv  
-import errno
 import binascii
+import threading
 import RPi.GPIO as GPIO
 import glob
+import numpy as np
 from serial.threaded import LineReader, ReaderThread
 from daqhats import mcc118, OptionFlags, TriggerModes, HatIDs, HatError
 from daqhats_utils import select_hat_device, enum_mask_to_string, \
     chan_list_to_mask
 from datetime import datetime
+from racs_acquire import deinterleave_list, deinterleave_numpy, ScanPipeline, \
+    CaptureBuffer, PretriggerCapture, HatGroup, read_block_size, prepend_read
+from racs_recording import open_recording, raw_header, recover_recording, \
+    quarantine_recording, estimate_recording_size, codes_to_volts, \
+    start_compression_pool, RAW_FORMATS, PART_SUFFIX
+from racs_catalog import Catalog, describe_recording
+from racs_controller import ShotController, ARMED, REARM
+from racs_planner import plan_scan, measure_encode_cost, cached_write_bandwidth
+from racs_analysis import BlockSummary, OverviewPyramid, overview_path, \
+    summary_path, save_summary, summary_message, ArrivalDetector, \
+    TriggerEngine
 
 # Name and number of the DAQ system that this instance of the code is 
 # installed. These values are used for file naming and radio response 
@@ -45,10 +55,41 @@ EXTRA_LEAD_TIME = 69
 # MCC118 Channels to record from
 channels = [0, 7]
 
+# Stacked MCC118 boards to record from: {HAT address: channel list}, e.g.
+# {0: [0, 1, 2, 3, 4, 5, 6, 7], 1: [0, 1, 2, 3, 4, 5, 6, 7]}. None records
+# `channels` on the single board found by select_hat_device. The lowest
+# address is the clock leader and the other boards scan with
+# OptionFlags.EXTCLOCK: wire all CLK pins together and all TRIG pins to
+# TRIGGER_PIN. All boards are read in parallel and recorded side by side
+# in one file, channel numbers running on as address * 8 + channel. The
+# 100 kHz combined limit applies per board.
+HAT_CHANNELS = None
+
 # Desired Sample Rate Per Channel (Hz) - CANNOT exceed 100 kHz combined for MCC118
+# (lowered by the planner when the configuration cannot sustain it)
 global scan_rate
 scan_rate = 50000.0 
 
+# Startup scan-rate planner (racs_planner). Checks scan_rate against the
+# MCC118 limit, the write bandwidth of the card (WRITE_BANDWIDTH_MB in
+# MB/s, or measured with a short write test in mypath and cached there
+# for WRITE_BANDWIDTH_MAX_AGE_DAYS; run racs_planner.py on the DATA
+# directory to measure again) and the time this Pi takes to encode
+# RECORDING_FORMAT, allowing the recording PLANNER_DISK_BUDGET of the
+# bandwidth and PLANNER_CPU_BUDGET of a core. A rate that does not fit
+# is lowered when PLANNER_DOWNGRADE is set and refused otherwise; a
+# lowered rate is announced in the terminal and stored in each
+# recording header (requested_scan_rate). CHANNEL_MIN_RATES
+# ({channel: Hz}) are the lowest rates the channels can accept; the
+# script refuses to arm below them.
+USE_PLANNER = True
+CHANNEL_MIN_RATES = {}
+PLANNER_DOWNGRADE = True
+PLANNER_DISK_BUDGET = 0.5
+PLANNER_CPU_BUDGET = 0.5
+WRITE_BANDWIDTH_MB = None
+WRITE_BANDWIDTH_MAX_AGE_DAYS = 30
+
 # Desired recording length (seconds)
 recording_length = 30
 
@@ -56,6 +97,90 @@ recording_length = 30
 basepath = '/home/pi/Desktop' 
 mypath = basepath + '/' + DAQ_NAME + '/DATA'
 
+# Catalog of the recordings in mypath (SQLite, opened by main). Used for
+# the PING file count instead of listing the directory.
+catalog = None
+
+# Write bandwidth of the card (bytes/sec), found by setup_session
+write_bandwidth = None
+
+# scan_rate as configured, when the planner had to lower it
+requested_scan_rate = None
+
+# Recording file format:
+#   'csv'     - text, one column per channel (largest, slowest); the
+#               blast summary is saved next to it (.summary.json)
+#   'float32' - binary with header, 4 bytes/sample (ample for 12-bit data)
+#   'float64' - binary with header, 8 bytes/sample
+#   'int16'   - binary raw 12-bit ADC codes, 2 bytes/sample, with the
+#               calibration coefficients in the header
+RECORDING_FORMAT = 'csv'
+
+# Decimal places written per value by the 'csv' format. Whole blocks are
+# formatted in one step at this fixed precision; 5 decimals (10 uV) is
+# well below the 4.9 mV resolution of the 12-bit, +/-10 V MCC118. Set to
+# None for the full-precision csv.writer output.
+CSV_PRECISION = 5
+
+# Optional leading time column in CSV recordings, generated per block
+# from the running sample count:
+#   None       - no time column (original layout)
+#   'seconds'  - seconds since the trigger
+#   'epoch_ns' - Unix epoch nanoseconds, anchored at the trigger instant
+TIME_COLUMN = None
+
+# Durable writes: each recording is written under a temporary '.part' name,
+# fsynced every DURABLE_SYNC_MB megabytes or DURABLE_SYNC_SECONDS seconds
+# (whichever comes first) and renamed once complete. '.part' files left
+# by a brown-out are salvaged when the script starts.
+DURABLE_WRITES = True
+DURABLE_SYNC_MB = 4
+DURABLE_SYNC_SECONDS = 2.0
+
+# Reserve the full expected size of each recording on the SD card
+# (posix_fallocate) when it is created, before the scan is armed. This
+# avoids fragmentation and metadata stalls while recording, and a card
+# that is too full is reported before the shot instead of partway in.
+PREALLOCATE_FILES = True
+
+# Size (MB) of the aligned blocks the recording is written in. Output is
+# gathered into one buffer and written with a single os.write per block,
+# at offsets that line up with the SD card erase blocks. 0 uses Python's
+# small default buffer. Use bench_blocksize.py to pick a size per card.
+WRITE_BLOCK_MB = 1
+
+# Build a min/max/mean overview pyramid of each recording while it is
+# captured and store it next to the recording (.overview.npz), so that a
+# plotting tool can draw any zoom level from a few thousand points.
+# OVERVIEW_FACTOR is the number of samples (or bins) per bin at each level.
+OVERVIEW_PYRAMID = True
+OVERVIEW_FACTOR = 8
+
+# Length (s) of the start of each recording used as the pre-event
+# baseline of the blast summary (peaks, peak times since the trigger,
+# RMS, impulse and baseline mean/std per channel). The summary is
+# computed block by block while recording, stored in the recording
+# header and catalog, and sent in reply to the STATS radio message.
+BASELINE_SECONDS = 1.0
+
+# Detect the shock arrival on each channel while recording: the first
+# sample whose level ('level') or sample-to-sample change ('slope')
+# departs from the noise of the BASELINE_SECONDS baseline by more than
+# ARRIVAL_THRESHOLD standard deviations, and by at least ARRIVAL_MIN_VOLTS
+# (volts, or volts per sample for 'slope'). Arrival indices (samples of
+# the recording) and times (seconds since the trigger) are stored with
+# the blast summary.
+ARRIVAL_DETECTOR = False
+ARRIVAL_MODE = 'level'
+ARRIVAL_THRESHOLD = 6.0
+ARRIVAL_MIN_VOLTS = 0.05
+
+# Optional lossless compression of binary formats (None, 'zlib' or 'lzma').
+# Samples are delta encoded per channel and compressed in independent
+# chunks on COMPRESSION_WORKERS processes, off the acquisition thread.
+RECORDING_COMPRESSION = None
+COMPRESSION_WORKERS = 2
+
 # DAQ clearing terminal inputs
 CURSOR_BACK_2 = '\x1b[2D'
 ERASE_TO_END_OF_LINE = '\x1b[0K'
@@ -65,6 +190,80 @@ ERASE_TO_END_OF_LINE = '\x1b[0K'
 # (up to user_buffer_size).
 READ_ALL_AVAILABLE = -1
 
+# How scan reads are issued:
+#   'blocking'      - request blocks of READ_LATENCY_SECONDS worth of
+#                     samples with a real timeout; the read sleeps in the
+#                     driver until the block is complete, so the loop
+#                     wakes a fixed number of times per second
+#   'all_available' - READ_ALL_AVAILABLE, each read returns at once with
+#                     whatever is buffered (spins when little is there)
+# bench_readstrategy.py measures the CPU use of both.
+READ_STRATEGY = 'blocking'
+READ_LATENCY_SECONDS = 0.1
+
+# How the start of a finite scan is detected once the trigger pin is
+# driven:
+#   'read' - block in the driver on a read of the first scan, so the
+#            process sleeps until samples arrive; that read's samples
+#            are the start of the recording
+#   'poll' - poll a_in_scan_status every millisecond (original loop)
+# The latency from driving the trigger pin to the first data is printed
+# and stored in the recording header (trigger_latency_ns).
+TRIGGER_WAIT = 'read'
+
+# Timeout (s) of each blocking read while waiting for the first scan in
+# the 'read' mode. Between reads the power switch and the shutdown
+# command are checked, so a trigger that never reaches the MCC118 does
+# not hang the script.
+TRIGGER_READ_TIMEOUT = 0.5
+
+# Read samples with a_in_scan_read_numpy and deinterleave each chunk in a
+# single vectorized step. Set to False to fall back to a_in_scan_read and
+# the original per-sample list building.
+READ_NUMPY = True
+
+# Drain the MCC118 on a dedicated reader thread into a bounded queue of
+# preallocated blocks, leaving formatting and disk writes to the main
+# thread, so that an SD-card write stall does not delay the next read.
+USE_PIPELINE = True
+
+# Length (s) of each pipeline block and number of blocks in the queue.
+# The queue statistics printed after each recording show how close the
+# writer came to running out of blocks.
+PIPELINE_BLOCK_SECONDS = 0.1
+PIPELINE_NUM_BLOCKS = 50
+
+# Capture finite scans into one preallocated in-RAM buffer and write the
+# recording only after the scan completes, keeping the disk out of the
+# real-time path. Shots whose buffer would exceed CAPTURE_MEMORY_BUDGET
+# (bytes) fall back to streaming. A 30 s, 2-channel, 50 kHz shot needs 24 MB.
+CAPTURE_IN_RAM = False
+CAPTURE_MEMORY_BUDGET = 64 * 1024 * 1024
+
+# Continuous scan with pre-trigger history. Instead of a finite scan that
+# waits for the hardware trigger, the MCC118 scans continuously from the
+# moment the system is armed into a fixed-size ring buffer in RAM. When
+# the trigger occurs, the last PRETRIGGER_SECONDS before it are kept and
+# recording_length seconds after it are added, in one file; the header
+# field pretrigger_samples is the index of the trigger sample. The ring
+# holds PRETRIGGER_SECONDS plus PIPELINE_NUM_BLOCKS blocks of slack.
+CONTINUOUS_PRETRIGGER = False
+PRETRIGGER_SECONDS = 5.0
+
+# Data-driven software trigger for the continuous pre-trigger mode (needs
+# CONTINUOUS_PRETRIGGER). Every block read while armed is checked for a
+# level (volts from the BASELINE_SECONDS baseline) and/or slope (volts
+# per sample) crossing on TRIGGER_CHANNELS (indices into channels, None
+# for all). The recording is committed at the first sample where
+# TRIGGER_COINCIDENCE channels have crossed within TRIGGER_WINDOW_SECONDS.
+# A threshold of None disables that test. The radio trigger still works.
+SOFTWARE_TRIGGER = False
+TRIGGER_LEVEL = 0.5
+TRIGGER_SLOPE = None
+TRIGGER_CHANNELS = None
+TRIGGER_COINCIDENCE = 1
+TRIGGER_WINDOW_SECONDS = 0.001
+
 # Pin (GPIO 21) responsible for ending script and shutting down RPi. 
 # Shutdown is initiated when pin is driven HIGH by a momentary switch
 PWR_PIN = 21
@@ -89,12 +288,37 @@ COMPLETE_LED = 5
 # allows the LoStik to break from its "waiting to receive" loop
 CMD_RECEIVED = 1
 
+# Number of the shot armed last (counted by arm_shot). A radio trigger
+# only applies to the shot armed when it was received, so one still
+# waiting out EXTRA_LEAD_TIME after a software trigger ended that shot
+# cannot fire the next.
+armed_shot = 0
+
 # Flag indicating that the radio recieved a shutdown command (FLAG = 1)
 CMD_SHUTDOWN = 0
 
-# Flag to verify LoStik is Inserted
-global LoStikInserted
-LoStikInserted = 1
+# Flag indicating that the recording length was changed while armed
+# (FLAG = 1): the armed shot is re-armed with the new length
+REARM_REQUESTED = 0
+
+# Set whenever something may end the wait for the trigger (trigger or
+# shutdown command, power switch edge, software trigger), so that
+# wait_for_trigger sleeps until then instead of polling the flags above
+wake = threading.Event()
+
+# The MCC118 (or HatGroup) and the LoStik reader thread, opened once by
+# setup_session and reused by every shot
+hat = None
+radio = None
+
+# The ShotController running the shots (created by main)
+controller = None
+
+# Ping and recording length messages received while no shot is armed
+# (recording or finalizing). They are acted on by arm_shot once the next
+# shot is armed; pending_lock keeps one from slipping in between.
+pending_commands = []
+pending_lock = threading.Lock()
 
 # Message that must be received by LoStik to initiate recording. NOTE:
 # only the hexadecimal portion must be sent by transmitter LoStik
@@ -102,6 +326,7 @@ REC_SIG = 'radio_rx  4D43435354' # 4D43435354 = "MCCST"
 SHUTDOWN_SIG = 'radio_rx  4D43435344' # 4d43435344 = "MCCSD"
 PING_SIG = 'radio_rx  4D43435047' # 4D43435047 = "MCCPG"
 RECORDINGLENGTH_SIG = 'radio_rx  4D4343524C' # 4D43435047 = "MCCRL "
+STATS_SIG = 'radio_rx  4D43435353' # 4D43435353 = "MCCSS"
 
 # Response transmitted by radio when a connection to the LoStik has been
 # established. *MUST STAGGER RESPONSES FROM MULTIPLE RADIOS
@@ -120,6 +345,24 @@ SHUTDOWN_HEX = binascii.hexlify(SHUTDOWN_RESPONSE.encode()).decode()
 
 
 
+def parse_recording_length(data):
+    """
+    Reads the new length from a change recording length message
+    ('MCCRL <seconds>', hex encoded after 'radio_rx  ').
+
+    Returns:
+        int: Recording length (seconds).
+
+    Raises:
+        ValueError: The message does not hold a positive whole number
+        of seconds.
+
+    """
+    length = int(binascii.unhexlify(data[10:]).decode()[6:])
+    if length <= 0:
+        raise ValueError('%d seconds' % length)
+    return length
+
 # Functions to control the staggering of radio responses from DAQS to
 # avoid "talking over each other"
 def RadioResponseFirstDelay():
@@ -136,11 +379,17 @@ class PrintLines(LineReader):
     def connection_made(self, transport):
         print("     Connected to LoStik")
         self.transport = transport
-        self.send_cmd("sys set pindig GPIO11 1")
         self.send_cmd('mac pause') # Prepare LoStik to receive
         self.send_cmd('radio set pwr 15', delay=1) # Power for transmission. WARNING - possible to exceed FCC allowable limits. Use only to compensate for line losses to antenna.
         #self.send_cmd('radio set wdt 0', delay=1) # Disable watchdog timer for continuous reception
 
+    def announce_ready(self):
+        """
+        Reports the DAQ armed and listens for the next command. Called
+        by arm_shot for every shot.
+        """
+        self.send_cmd("sys set pindig GPIO11 1")
+
         # Sending staggered response
         RadioResponseFirstDelay()
         self.send_cmd('radio tx '+READY_HEX, delay=0)
@@ -175,10 +424,11 @@ class PrintLines(LineReader):
 		
         global CMD_RECEIVED # Define trigger flag as global variable
         global CMD_SHUTDOWN # Define shutdown flag as global variable
-        global recording_length
         
         # Handle a trigger message        
         if data == REC_SIG: # Trigger Message
+            shot = armed_shot
+
 			# Turning off red LED
             self.send_cmd("sys set pindig GPIO11 0")
 
@@ -190,8 +440,12 @@ class PrintLines(LineReader):
             # Allow for extra wait time for lighting fuse
             time.sleep(EXTRA_LEAD_TIME)
             
-            # Setting trigger flag
+            # Setting trigger flag, unless another shot was armed since
+            if shot != armed_shot:
+                print('     Trigger arrived after its shot, ignored')
+                return
             CMD_RECEIVED = 0
+            wake.set()
 
         # Handle a shutdown message
         elif data == SHUTDOWN_SIG:
@@ -204,10 +458,75 @@ class PrintLines(LineReader):
             RadioResponseSecondDelay()
             
             # Setting trigger flag
-            CMD_SHUTDOWN = 1            
+            CMD_SHUTDOWN = 1
+            wake.set()
             
+        # Handle a summary statistics request for the last recording
+        elif data == STATS_SIG:
+            try:
+                latest = catalog.latest(DAQ_NAME)
+                if latest is None or latest['summary'] is None:
+                    message = 'no data'
+                else:
+                    message = summary_message(latest['summary'],
+                                              latest['channels'])
+            except Exception as err:
+                # An exception here would end the LoStik reader thread,
+                # and with it every later command
+                print('     Summary unavailable: ', err)
+                message = 'no data'
+            print('     Last shot: ' + message)
+
+            # Response transmitted by radio when the stats message has been
+            # received. **MUST STAGGER RESPONSES FROM MULTIPLE RADIOS
+            STATS_RESPONSE = DAQ_NAME + ' Sts ' + message
+            STATS_HEX = binascii.hexlify(STATS_RESPONSE.encode()).decode()
+
+            # Sending staggered response
+            RadioResponseFirstDelay()
+            self.send_cmd('radio tx '+STATS_HEX, delay=0)
+            RadioResponseSecondDelay()
+
+            self.send_cmd('radio rx 0') # Re-engages continuous reception mode
+
+        # Ping and change recording length messages are acted on only
+        # while a shot is armed; otherwise they wait for the next one
+        elif data == PING_SIG or data[0:20] == RECORDINGLENGTH_SIG:
+            # A bad length is refused now, not when the next shot arms
+            if data != PING_SIG:
+                try:
+                    parse_recording_length(data)
+                except ValueError as err:
+                    print('     Invalid recording length: ', err)
+                    self.send_cmd('radio rx 0')
+                    return
+            with pending_lock:
+                queued = controller is None or controller.state != ARMED
+                # One answer covers every ping queued for the next shot
+                if queued and not (data == PING_SIG
+                                   and PING_SIG in pending_commands):
+                    pending_commands.append(data)
+            if queued:
+                print('     Queued until armed')
+                self.send_cmd('radio rx 0') # Re-engages continuous reception mode
+            else:
+                self.handle_armed_command(data)
+
+        # Prepare to receive another message
+        else:
+            self.send_cmd('radio rx 0') # Re-engages continuous reception mode
+
+    def handle_armed_command(self, data):
+        """
+        Acts on a ping or change recording length message. Called by
+        handle_line while a shot is armed, or by arm_shot for a message
+        queued while none was.
+        """
+        global recording_length
+        global REARM_REQUESTED
+
         # Handle a ping message
-        elif data == PING_SIG:
+        if data == PING_SIG:
             
             for a in range(10):
                 GPIO.output(PRIMED_LED,GPIO.HIGH)
@@ -223,7 +542,9 @@ class PrintLines(LineReader):
                 
             GPIO.output(PRIMED_LED,GPIO.HIGH)
             
-            FileCounter = len(glob.glob1(mypath,"*.csv"))
+            # Recordings deleted or copied in by hand are counted too
+            catalog.refresh()
+            FileCounter = catalog.count()
             
             # Response transmitted by radio when the ping message has been
 			# received. **MUST STAGGER RESPONSES FROM MULTIPLE RADIOS
@@ -239,24 +560,19 @@ class PrintLines(LineReader):
             
         # Handle a change recording length message
         elif data[0:20] == RECORDINGLENGTH_SIG:
-            
-            print('     RECV: '+binascii.unhexlify(data[10:]).decode())   
-                           
-            print('     REC Length: ' + binascii.unhexlify(data[10:]).decode()[6:] )
-            
-            hat.a_in_scan_cleanup()     
-            
-            recording_length = int(binascii.unhexlify(data[10:]).decode()[6:])
-            
-            global samples_per_channel
-            samples_per_channel = int(recording_length*actual_scan_rate)
-            
-            hat.a_in_scan_start(channel_mask, samples_per_channel, scan_rate, options)
-            
-            self.send_cmd('radio rx 0') # Re-engages continuous reception mode
-        
-        # Prepare to receive another message
-        else:
+            try:
+                length = parse_recording_length(data)
+            except ValueError as err:
+                print('     Invalid recording length: ', err)
+            else:
+                print('     REC Length: ' + str(length))
+
+                # The recording of the armed shot was created and sized
+                # for the old length, so the controller re-arms it
+                recording_length = length
+                REARM_REQUESTED = 1
+                wake.set()
+
             self.send_cmd('radio rx 0') # Re-engages continuous reception mode
 
     def connection_lost(self, exc):
@@ -268,195 +584,532 @@ class PrintLines(LineReader):
         self.transport.write(('%s\r\n' % cmd).encode('UTF-8'))
         time.sleep(delay)
 
-def main():
+def setup_session():
     """
-    This function is executed automatically when the module is run directly.
+    Opens everything the shots of a session share, once: the GPIO pins,
+    the MCC118 HAT(s) and scan plan, the recording catalog and the
+    LoStik.
+
+    Returns:
+        None
+
     """
-    # Initialize the pins, and set their numbering scheme
+    # Initialize the pins, and set their numbering scheme. The trigger
+    # pin is held LOW until a trigger; the power switch wakes
+    # wait_for_trigger on its rising edge.
     GPIO.setmode(GPIO.BCM)
     GPIO.setup(PRIMED_LED, GPIO.OUT, initial=GPIO.LOW)
     GPIO.setup(RECORDING_LED, GPIO.OUT, initial=GPIO.LOW)
     GPIO.setup(COMPLETE_LED, GPIO.OUT, initial=GPIO.LOW)
-    # Convert the list to a channel mask that
-    # can be passed as a parameter to the MCC 118 functions.
-    global channel_mask
-    channel_mask = chan_list_to_mask(channels)
-    num_channels = len(channels)
+    GPIO.setup(TRIGGER_PIN, GPIO.OUT, initial=GPIO.LOW)
+    GPIO.setup(PWR_PIN, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+    GPIO.add_event_detect(PWR_PIN, GPIO.RISING,
+                          callback=lambda channel: wake.set(),
+                          bouncetime=50)
     global options
-    options = OptionFlags.EXTTRIGGER # Commands MCC118 to wait for signal on trigger input pin before recording
+    if CONTINUOUS_PRETRIGGER:
+        options = OptionFlags.CONTINUOUS # Scan from arming on, the trigger is marked in the ring buffer
+    else:
+        options = OptionFlags.EXTTRIGGER # Commands MCC118 to wait for signal on trigger input pin before recording
+    if RECORDING_FORMAT in RAW_FORMATS:
+        # Return raw ADC codes, calibration is applied when the file is read
+        options |= OptionFlags.NOSCALEDATA | OptionFlags.NOCALIBRATEDATA
     trigger_mode = TriggerModes.ACTIVE_HIGH # Commands MCC118 to look for HIGH signal on trigger input pin
 
-    try:
-        # Select an MCC 118 HAT device to use.
+    # Select the MCC 118 HAT device(s) to use. The channel mask passed to
+    # a_in_scan_start comes from the channel list of the single board; a
+    # HatGroup scans the HAT_CHANNELS list of each board and takes None.
+    global hat
+    global scan_channels
+    global num_channels
+    global channel_mask
+    if HAT_CHANNELS is None:
         address = select_hat_device(HatIDs.MCC_118)
-        global hat
         hat = mcc118(address)
-        
-        # Ready LED
-        GPIO.output(PRIMED_LED,GPIO.HIGH)
-        
-        # Terminal Header
-        print('\n\n///////////////////////////////////////////////////////////////////')
-        print('\n' + '     ' + DAQ_NAME + ' - Finite Data Acquisition with LoRa Trigger @ 50kHz     \n')
-        print('///////////////////////////////////////////////////////////////////')
+        scan_channels = channels
+        channel_mask = chan_list_to_mask(scan_channels)
+    else:
+        hat = HatGroup([(address, mcc118(address), HAT_CHANNELS[address])
+                        for address in sorted(HAT_CHANNELS)],
+                       OptionFlags.EXTCLOCK)
+        scan_channels = hat.channels
+        channel_mask = None
+    num_channels = len(scan_channels)
+
+    # Terminal Header
+    print('\n\n///////////////////////////////////////////////////////////////////')
+    print('\n' + '     ' + DAQ_NAME + ' - Finite Data Acquisition with LoRa Trigger @ 50kHz     \n')
+    print('///////////////////////////////////////////////////////////////////')
 
-        global actual_scan_rate
+    global scan_rate
+    global actual_scan_rate
+    if USE_PLANNER:
+        # Largest scan rate up to scan_rate that will not overrun
+        global write_bandwidth
+        if write_bandwidth is None:
+            if WRITE_BANDWIDTH_MB:
+                write_bandwidth = WRITE_BANDWIDTH_MB * 1e6
+            else:
+                os.makedirs(mypath, exist_ok=True)
+                write_bandwidth, measured = cached_write_bandwidth(
+                    mypath, WRITE_BANDWIDTH_MAX_AGE_DAYS)
+                if measured:
+                    print('     Planner: write bandwidth measured, %.2f MB/s'
+                          % (write_bandwidth / 1e6))
+        if HAT_CHANNELS is None:
+            board_channels = [num_channels]
+        else:
+            board_channels = [len(chans) for chans in hat.channel_lists]
+        # The encoding is timed together with the analysis each shot
+        # runs on every block, at the requested rate
+        stages = create_analysis(num_channels, scan_rate,
+                                 int(recording_length * scan_rate))
+        analyse = lambda block, header: analyse_block(block, header, stages)
+        plan = plan_scan(
+            board_channels, RECORDING_FORMAT, write_bandwidth,
+            lambda rate: hat.a_in_scan_actual_rate(num_channels, rate),
+            scan_rate, CHANNEL_MIN_RATES, RECORDING_COMPRESSION,
+            CSV_PRECISION, TIME_COLUMN,
+            measure_encode_cost(RECORDING_FORMAT, num_channels,
+                                RECORDING_COMPRESSION, CSV_PRECISION,
+                                time_column=TIME_COLUMN, analyse=analyse),
+            PLANNER_DISK_BUDGET, PLANNER_CPU_BUDGET, PLANNER_DOWNGRADE)
+        for note in plan.notes:
+            print('     Planner: ' + note)
+        if plan.downgraded:
+            # Every shot is recorded slower than configured
+            global requested_scan_rate
+            requested_scan_rate = scan_rate
+            banner = ('!!  SCAN RATE LOWERED FROM %.0f TO %.0f S/s/channel  !!'
+                      % (scan_rate, plan.actual_scan_rate))
+            print('\n     ' + '!' * len(banner))
+            print('     ' + banner)
+            print('     ' + '!' * len(banner) + '\n')
+        scan_rate = plan.scan_rate
+        actual_scan_rate = plan.actual_scan_rate
+    else:
         actual_scan_rate = hat.a_in_scan_actual_rate(num_channels, scan_rate)
-        
-        global samples_per_channel        
-        samples_per_channel = int(recording_length*actual_scan_rate)
-        
-        # Scan Information to Terminal
-        print('\n\n*************************************')
-        print('\nSelected Parameters:')
-        print('    Channels: ', end='')
-        print(', '.join([str(chan) for chan in channels]))
-        print('    Requested scan rate (samples/sec/channel): ', scan_rate)
-        print('    Actual scan rate (samples/sec/channel): ', actual_scan_rate)
-        print('    Options: ', enum_mask_to_string(OptionFlags, options))
-        print('    Trigger Mode: ', trigger_mode.name)
-        print('    Number of samples/channel requested: ', samples_per_channel)
-        print('    Length of recording (seconds): ', samples_per_channel/actual_scan_rate)
-        print('    CSV Storage location: ' + mypath)
-        print('    DAQ Name:   ' + DAQ_NAME)
-        print('    DAQ Number: ', DAQ_NUM)
-        print('    Total Number of DAQS: ', NUM_OF_DAQS)
-        print('    Radio Response Delay Window (seconds): ', RESPONSE_DELAY)
-        print('    Current date/time: ',datetime.strftime(datetime.now(), "%m_%d_%Y, %H:%M:%S"))
-        print('\n*************************************')
-
-        hat.trigger_mode(trigger_mode)
-
-        # Prepare MCC118 to start the scan based on above settings.
-        hat.a_in_scan_start(channel_mask, samples_per_channel, scan_rate,
-                            options)
+
+    global samples_per_channel        
+    samples_per_channel = int(recording_length*actual_scan_rate)
+
+    if RECORDING_COMPRESSION:
+        # Compression workers are started now rather than by the first
+        # chunk of the first shot
+        start_compression_pool(COMPRESSION_WORKERS, RECORDING_COMPRESSION)
+
+    # Scan Information to Terminal
+    print('\n\n*************************************')
+    print('\nSelected Parameters:')
+    print('    Channels: ', end='')
+    print(', '.join([str(chan) for chan in scan_channels]))
+    if HAT_CHANNELS is not None:
+        print('    HAT addresses: ', ', '.join(str(a) for a in sorted(HAT_CHANNELS)),
+              '(clock leader %d)' % min(HAT_CHANNELS))
+    print('    Requested scan rate (samples/sec/channel): ',
+          scan_rate if requested_scan_rate is None else requested_scan_rate)
+    print('    Actual scan rate (samples/sec/channel): ', actual_scan_rate)
+    print('    Options: ', enum_mask_to_string(OptionFlags, options))
+    print('    Trigger Mode: ', trigger_mode.name)
+    print('    Number of samples/channel requested: ', samples_per_channel)
+    print('    Length of recording (seconds): ', samples_per_channel/actual_scan_rate)
+    print('    Storage location: ' + mypath)
+    if USE_PLANNER:
+        print('    Write bandwidth (MB/s): %.2f, recording needs %.2f, encoding CPU %.0f%%'
+              % (write_bandwidth / 1e6, plan.bytes_per_second / 1e6,
+                 plan.cpu_load * 100))
+    print('    Recording format: ' + RECORDING_FORMAT)
+    print('    Compression: ', RECORDING_COMPRESSION)
+    print('    DAQ Name:   ' + DAQ_NAME)
+    print('    DAQ Number: ', DAQ_NUM)
+    print('    Total Number of DAQS: ', NUM_OF_DAQS)
+    print('    Radio Response Delay Window (seconds): ', RESPONSE_DELAY)
+    print('    Current date/time: ',datetime.strftime(datetime.now(), "%m_%d_%Y, %H:%M:%S"))
+    print('\n*************************************')
+
+    # Recording catalog, opened once and kept across recordings
+    global catalog
+    if catalog is None:
+        catalog = Catalog(mypath)
+
+    # Salvage recordings interrupted by a power loss. A file that cannot
+    # be salvaged is set aside rather than stop the DAQ from starting.
+    for part in sorted(glob.glob1(mypath, "*" + PART_SUFFIX)):
+        recovered = mypath + '/' + part
         try:
-            # Wait for the external trigger to occur
-            wait_for_trigger(hat)
+            recovered, samples = recover_recording(recovered)
+            if samples == 0:
+                # Armed but never triggered (or nothing committed)
+                os.remove(recovered)
+                continue
+            catalog.add(recovered, describe_recording(recovered)[0], samples)
+        except (OSError, ValueError, KeyError) as err:
+            print('     Cannot recover ' + part + ': ', err)
+            try:
+                print('     Moved to ' + os.path.basename(quarantine_recording(recovered)))
+            except OSError as err:
+                print('     ', err)
+            continue
+        print('     Recovered ' + os.path.basename(recovered) + ': ', samples, 'samples/channel')
 
-            print('\n (1) Scanning ... Press Ctrl-C to stop')
-            
-            # Read and save data from MCC118 as it records
-            #read_and_display_data(hat, samples_per_channel, num_channels,fileName)
-            
-            read_and_display_data(hat, samples_per_channel, num_channels)
+    hat.trigger_mode(trigger_mode)
 
-        except KeyboardInterrupt:
-            # Clear the '^C' from the display.
-            print(CURSOR_BACK_2, ERASE_TO_END_OF_LINE, '\n')
-            hat.a_in_scan_stop()
-            GPIO.cleanup()
-            quit()
-            
-    except (HatError, ValueError, KeyboardInterrupt) as err:
-        print('\n', err)
-        GPIO.cleanup()
-        hat.a_in_scan_stop()
+    # Radio link, kept open across shots
+    global radio
+    radio = open_radio()
 
-def wait_for_trigger(hat):
+def open_radio():
     """
-    Monitor the status of the specified HAT device in a loop until the
-    triggered status is True or the running status is False.
+    Opens the LoStik, retrying until it is plugged in.
+
+    Returns:
+        ReaderThread: The running serial reader; its protocol attribute
+        is the PrintLines instance.
+
+    """
+    while True:
+        try:
+            ser = serial.Serial("/dev/ttyUSB0", baudrate=57600)
+            reader = ReaderThread(ser, PrintLines)
+            reader.start()
+            reader.connect()
+            return reader
+        except (serial.SerialException, OSError):
+            for a in range(10):
+                GPIO.output(RECORDING_LED,GPIO.HIGH)
+                time.sleep(.1)
+                GPIO.output(RECORDING_LED,GPIO.LOW)
+                time.sleep(.1)
+            print("     LoStik USB not Properly Inserted!")
+
+def arm_shot():
+    """
+    Arms one shot: creates its recording, starts the scan and reports
+    the DAQ ready over the radio.
+
+    Returns:
+        tuple: (writer, capture), where capture is the running
+        PretriggerCapture of a continuous scan, or None.
+
+    """
+    global CMD_RECEIVED
+    global REARM_REQUESTED
+    global radio
+    global samples_per_channel
+    global armed_shot
+    armed_shot += 1
+    CMD_RECEIVED = 1
+    GPIO.output(TRIGGER_PIN,GPIO.LOW)
+    GPIO.output(COMPLETE_LED,GPIO.LOW)
+
+    # Reconnect the LoStik only if the link was lost
+    if not radio.alive:
+        radio.close()
+        radio = open_radio()
+
+    # Act on the messages that arrived while no shot was armed. A new
+    # recording length applies to this shot, so it needs no re-arm;
+    # pings are answered once the shot is armed.
+    with pending_lock:
+        commands = pending_commands[:]
+        del pending_commands[:]
+    for data in commands:
+        if data != PING_SIG:
+            radio.protocol.handle_armed_command(data)
+    REARM_REQUESTED = 0
+
+    # Length of this shot, which the radio may have changed since the last
+    samples_per_channel = int(recording_length*actual_scan_rate)
+
+    # Create the recording and reserve its space before arming
+    pre_samples = 0
+    if CONTINUOUS_PRETRIGGER:
+        pre_samples = int(PRETRIGGER_SECONDS * actual_scan_rate)
+    writer = create_recording(hat, samples_per_channel + pre_samples, num_channels)
+    capture = None
+    try:
+        capture = start_scan(writer, pre_samples)
+    except BaseException:
+        # Nothing of a shot that failed to arm is kept
+        abort_shot((writer, capture))
+        raise
+
+    # Ready LED
+    GPIO.output(PRIMED_LED,GPIO.HIGH)
+    print('\n <<<READY>>>\n\n (0) Waiting for trigger to initiate recording (or press Ctrl+C to abort)\n')
+    radio.protocol.announce_ready()
+    if PING_SIG in commands:
+        # The LED blink and staggered reply no longer delay the arming
+        radio.protocol.handle_armed_command(PING_SIG)
+    return writer, capture
+
+def start_scan(writer, pre_samples):
+    """
+    Starts the scan of a shot being armed.
 
     Args:
-        hat (mcc118): The mcc118 HAT device object on which the status will
-            be monitored.
+        writer: Recording writer of the shot.
+        pre_samples (int): Samples kept from before the trigger.
+
+    Returns:
+        PretriggerCapture: The running capture of a continuous scan,
+        or None.
+
+    """
+    # Prepare MCC118 to start the scan based on above settings.
+    hat.a_in_scan_start(channel_mask, samples_per_channel, scan_rate,
+                        options)
+
+    # Fill the ring buffer while armed
+    capture = None
+    detector = None
+    if SOFTWARE_TRIGGER:
+        if not CONTINUOUS_PRETRIGGER:
+            raise ValueError('SOFTWARE_TRIGGER requires CONTINUOUS_PRETRIGGER')
+        engine = TriggerEngine(num_channels, TRIGGER_LEVEL, TRIGGER_SLOPE,
+                               TRIGGER_COINCIDENCE,
+                               int(TRIGGER_WINDOW_SECONDS * actual_scan_rate),
+                               TRIGGER_CHANNELS,
+                               int(BASELINE_SECONDS * actual_scan_rate))
+        if RECORDING_FORMAT in RAW_FORMATS:
+            detector = lambda block: engine.update(codes_to_volts(block, writer.header))
+        else:
+            detector = engine.update
+    if CONTINUOUS_PRETRIGGER:
+        block_samples = max(1, int(PIPELINE_BLOCK_SECONDS * actual_scan_rate))
+        read_request_size, timeout = read_block_size(
+            actual_scan_rate, READ_LATENCY_SECONDS, samples_per_channel)
+        if READ_NUMPY:
+            read_chunk = lambda: hat.a_in_scan_read_numpy(read_request_size, timeout)
+        else:
+            read_chunk = lambda: hat.a_in_scan_read(read_request_size, timeout)
+        capture = PretriggerCapture(
+            read_chunk, num_channels, pre_samples, samples_per_channel,
+            PIPELINE_NUM_BLOCKS * block_samples,
+            np.int16 if RECORDING_FORMAT in RAW_FORMATS else np.float64,
+            detector, wake.set)
+        capture.start()
+    return capture
+
+def record_shot(shot):
+    """
+    Records a triggered shot.
+
+    Args:
+        shot (tuple): (writer, capture) from arm_shot.
 
     Returns:
         None
 
     """
-    try: 
-        # GPIO.setmode(GPIO.BCM)
-        GPIO.setup(PWR_PIN, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-        print('\n <<<READY>>>\n\n (0) Waiting for trigger to initiate recording (or press Ctrl+C to abort)\n')
-        
-        # Wait until LoStik is properly inserted
-        global LoStikInserted
-        while(LoStikInserted):
-            try:
-                ser = serial.Serial("/dev/ttyUSB0", baudrate=57600)
-                manager = (ReaderThread(ser, PrintLines))
-                enter = type(manager).__enter__
-                exit = type(manager).__exit__
-                value = enter(manager)
-                hit_except = False
-                LoStikInserted = 0
-				
-            except:
-                for a in range(10):
-                    GPIO.output(RECORDING_LED,GPIO.HIGH)
-                    time.sleep(.1)
-                    GPIO.output(RECORDING_LED,GPIO.LOW)  
-                    time.sleep(.1)			
-                print("     LoStik USB not Properly Inserted!")         
-        LoStikInserted = 1
+    writer, capture = shot
+    if capture is not None:
+        # Samples still in the MCC118 buffer were scanned before now
+        now_index = capture.samples_read + hat.a_in_scan_status().samples_available
+        if capture.triggered:
+            print('     Software trigger')
+        capture.trigger(now_index)
+
+        # Date the trigger sample, which precedes now for a
+        # software trigger
+        global trigger_time_ns
+        trigger_time_ns -= int((now_index - capture.trigger_index)
+                               * 1e9 / actual_scan_rate)
+
+    print('\n (1) Scanning ... Press Ctrl-C to stop')
+
+    # Read and save data from MCC118 as it records
+    read_and_display_data(hat, samples_per_channel, num_channels, writer,
+                          capture)
+
+def finalize_shot(shot):
+    """
+    Shows the complete LED and releases the scan so that the next shot
+    can be armed.
+
+    Args:
+        shot (tuple): (writer, capture) from arm_shot.
+
+    Returns:
+        None
+
+    """
+    GPIO.output(RECORDING_LED,GPIO.LOW)
+    GPIO.output(TRIGGER_PIN,GPIO.LOW)
+
+    # Complete LED
+    GPIO.output(COMPLETE_LED,GPIO.HIGH)
+    time.sleep(5)
+    GPIO.output(COMPLETE_LED,GPIO.LOW)
+    writer, capture = shot
+    if capture is not None:
+        capture.stop()
+    hat.a_in_scan_cleanup()
+
+def abort_shot(shot):
+    """
+    Releases a shot that was armed but not finalized, on shutdown or
+    an error: stops the scan and the capture thread, then keeps the
+    recording if it was triggered and deletes it otherwise.
+
+    Args:
+        shot (tuple): (writer, capture) from arm_shot.
+
+    Returns:
+        None
+
+    """
+    writer, capture = shot
+    try:
+        hat.a_in_scan_stop()
+    except HatError:
+        pass
+    try:
+        if capture is not None:
+            capture.stop()
+    finally:
+        if writer.file.closed:
+            pass
+        elif writer.header.get('trigger_time_ns') is None:
+            writer.discard()
+        else:
+            writer.close()
         try:
-            protocol = value
-            while(CMD_RECEIVED):
-                if GPIO.input(PWR_PIN) == 1 or CMD_SHUTDOWN:
-                    print("     Shutting Down")
-                    GPIO.cleanup()
-                    time.sleep(1)
-                    hat.a_in_scan_cleanup()
-                    time.sleep(1)
-                    quit()
-                pass
-        except:
-            hit_except = True
-            if not exit(manager, *sys.exc_info()):
-                raise
-        finally:
-            if not hit_except:
-                exit(manager, None, None, None)
+            hat.a_in_scan_cleanup()
+        except HatError:
+            pass
+        GPIO.output(PRIMED_LED,GPIO.LOW)
+        GPIO.output(RECORDING_LED,GPIO.LOW)
+        GPIO.output(TRIGGER_PIN,GPIO.LOW)
 
+def teardown_session():
+    """
+    Stops any scan and releases the hardware when the session ends.
+
+    Returns:
+        None
+
+    """
+    if hat is not None:
+        try:
+            hat.a_in_scan_stop()
+            hat.a_in_scan_cleanup()
+        except HatError:
+            pass
+    if radio is not None:
+        radio.close()
+    if catalog is not None:
+        catalog.close()
+    GPIO.cleanup()
+
+def main():
+    """
+    This function is executed automatically when the module is run directly.
+    Runs shots until a shutdown command, the power switch or Ctrl+C.
+    """
+    global controller
+    controller = ShotController(
+        setup_session, arm_shot,
+        lambda shot: wait_for_trigger(hat, shot[1]),
+        record_shot, finalize_shot, abort_shot, teardown_session)
+    try:
+        controller.run()
     except KeyboardInterrupt:
-	    print(CURSOR_BACK_2, ERASE_TO_END_OF_LINE, '\n')
-	    hat.a_in_scan_cleanup()
-	    GPIO.cleanup()
-	    quit()
+        # Clear the '^C' from the display.
+        print(CURSOR_BACK_2, ERASE_TO_END_OF_LINE, '\n')
+    except (HatError, ValueError, OSError) as err:
+        print('\n', err)
+
+def wait_for_trigger(hat, capture=None):
+    """
+    Waits for the radio trigger (or the software trigger of a continuous
+    capture), then drives the trigger pin and waits for the first data
+    of the scan.
+
+    Args:
+        hat (mcc118): The mcc118 HAT device object on which the status will
+            be monitored.
+        capture (PretriggerCapture): Continuous capture whose software
+            trigger also ends the wait, or None.
+
+    Returns:
+        bool or str: True once triggered, False on a shutdown command or
+        the power switch, or REARM when the recording length changed
+        while armed.
+
+    """
+    # Sleep until woken, then check what happened. The event is cleared
+    # before the checks so a wake-up that arrives while checking is not
+    # lost.
+    while True:
+        wake.clear()
+        if GPIO.input(PWR_PIN) == 1 or CMD_SHUTDOWN:
+            print("     Shutting Down")
+            return False
+        if not CMD_RECEIVED or (capture is not None and capture.triggered):
+            break
+        if REARM_REQUESTED:
+            print("     Re-arming for the new recording length")
+            return REARM
+        wake.wait()
 
     # Sends trigger pin on RPi to HIGH which should be connected to MCC118 trigger input pin
-    GPIO.setup(TRIGGER_PIN, GPIO.OUT)	
     GPIO.output(TRIGGER_PIN,GPIO.HIGH)
-    
-    # Read the status only to determine when the trigger occurs.
-    is_running = True
-    is_triggered = False
-    while is_running and not is_triggered:
-        status = hat.a_in_scan_status()
-        is_running = status.running
-        is_triggered = status.triggered
-        if not is_triggered:
-            time.sleep(0.001)
-    GPIO.cleanup()
 
-def read_and_display_data(hat, samples_per_channel, num_channels):
+    # Wall-clock time of the trigger edge, stored in the recording header
+    global trigger_time_ns
+    trigger_time_ns = time.time_ns()
+
+    # Wait for the first data of the scan. A continuous pre-trigger scan
+    # is already running and is not gated by the trigger input.
+    global first_read
+    global trigger_latency_ns
+    first_read = None
+    trigger_latency_ns = None
+    if CONTINUOUS_PRETRIGGER:
+        pass
+    elif TRIGGER_WAIT == 'read':
+        # Sleep in the driver until the first scan is available, in
+        # reads of TRIGGER_READ_TIMEOUT
+        while True:
+            if READ_NUMPY:
+                first_read = hat.a_in_scan_read_numpy(1, TRIGGER_READ_TIMEOUT)
+            else:
+                first_read = hat.a_in_scan_read(1, TRIGGER_READ_TIMEOUT)
+            if len(first_read.data) or not first_read.running:
+                break
+            if GPIO.input(PWR_PIN) == 1 or CMD_SHUTDOWN:
+                print("     Shutting Down")
+                return False
+        trigger_latency_ns = time.time_ns() - trigger_time_ns
+    else:
+        # Read the status only to determine when the trigger occurs.
+        is_running = True
+        is_triggered = False
+        while is_running and not is_triggered:
+            status = hat.a_in_scan_status()
+            is_running = status.running
+            is_triggered = status.triggered
+            if not is_triggered:
+                time.sleep(0.001)
+        trigger_latency_ns = time.time_ns() - trigger_time_ns
+    return True
+
+def create_recording(hat, samples_per_channel, num_channels):
     """
-    Reads data from the specified channels on the specified DAQ HAT devices,
-    and writes the data to a .csv file.  The reads are executed in a 
-    loop that continues until the user stops the scan, the specified 
-    scan length is reached, or an overrun error is detected.
+    Creates the recording file before the scan is armed, reserving its
+    expected size on the SD card. The trigger time and final file name
+    are filled in by read_and_display_data once the trigger occurs.
 
     Args:
         hat (mcc118): The mcc118 HAT device object.
-        num_channels (int): The number of channels to display.
+        samples_per_channel (int): The number of samples per channel.
+        num_channels (int): The number of channels to record.
 
     Returns:
-        None
+        The recording writer.
 
-    """   
-    
-    # Read all of the available samples (up to the size of the read_buffer which
-    # is specified by the user_buffer_size).  Since the read_request_size is set
-    # to -1 (READ_ALL_AVAILABLE), this function returns immediately with
-    # whatever samples are available (up to user_buffer_size) and the timeout
-    # parameter is ignored.
-    total_samples_read = 0
-    read_request_size = READ_ALL_AVAILABLE
-    completeFlag = 0    
-    timeout = 5.0
-    
+    """
     # file switch:  w =  Write to a file
     # file switch:  w+ = Write to a file, if it doesn't exist create it
     # file switch:  a =  Append to a file
@@ -464,10 +1117,10 @@ def read_and_display_data(hat, samples_per_channel, num_channels):
     # file switch:  x = will create a file, returns an error if the file exist
     
 
-    # If the scan starts, create a file name based upon current date and time.
-    # Retrieve the Current Working Directory and generate the full path 
-    # to where to write the collected data as a .csv file.  Open the file 
-    # begin writing the data to the file.  When done, close the file.
+    # Create a file name based upon current date and time (renamed to the
+    # trigger time once the scan starts). Retrieve the Current Working
+    # Directory and generate the full path to where to write the collected
+    # data in RECORDING_FORMAT.  Open the file, reserving its full size.
     
     try:
         if os.path.exists(basepath):
@@ -483,66 +1136,264 @@ def read_and_display_data(hat, samples_per_channel, num_channels):
     os.chdir(mypath)
     fileDateTime = datetime.strftime(datetime.now(), "(%m_%d_%Y)-(%H-%M-%S)")
     #filePath = mypath + "/" + DAQ_NAME + "_" + fileName + ".csv"
-    filePath = mypath + "/" + DAQ_NAME + "_" + fileDateTime + ".csv"
-    csvfile = open(filePath, "w+")
-    csvwriter = csv.writer(csvfile) 
+    header = {
+        'daq_name': DAQ_NAME,
+        'daq_num': DAQ_NUM,
+        'channels': scan_channels,
+        'hats': HAT_CHANNELS,
+        'scan_rate': actual_scan_rate,
+        'samples_requested': samples_per_channel,
+        'trigger_time_ns': None,
+        'trigger_time': None,
+    }
+    if requested_scan_rate is not None:
+        # The planner lowered the rate
+        header['requested_scan_rate'] = requested_scan_rate
+    if RECORDING_FORMAT in RAW_FORMATS:
+        header.update(raw_header([hat.calibration_coefficient_read(chan)
+                                  for chan in scan_channels]))
+    writer_options = {
+        'durable': DURABLE_WRITES,
+        'sync_bytes': int(DURABLE_SYNC_MB * 1024 * 1024),
+        'sync_seconds': DURABLE_SYNC_SECONDS,
+        'block_size': int(WRITE_BLOCK_MB * 1024 * 1024),
+    }
+    if RECORDING_FORMAT == 'csv':
+        writer_options['precision'] = CSV_PRECISION
+        writer_options['time_column'] = TIME_COLUMN
+    if RECORDING_COMPRESSION:
+        writer_options['workers'] = COMPRESSION_WORKERS
+    if PREALLOCATE_FILES:
+        writer_options['preallocate'] = estimate_recording_size(
+            RECORDING_FORMAT, samples_per_channel, num_channels,
+            RECORDING_COMPRESSION, CSV_PRECISION, TIME_COLUMN)
+    return open_recording(mypath + "/" + DAQ_NAME + "_" + fileDateTime,
+                          RECORDING_FORMAT, header, RECORDING_COMPRESSION,
+                          **writer_options)
+
+def create_analysis(num_channels, scan_rate, samples, pretrigger_samples=0):
+    """
+    Creates the analysis run on every block of a shot: the blast
+    summary, and the overview pyramid and arrival detector when enabled.
+
+    Args:
+        num_channels (int): The number of channels in the scan.
+        scan_rate (float): Actual scan rate (samples/sec/channel).
+        samples (int): Samples per channel in the recording.
+        pretrigger_samples (int): Index of the trigger sample.
+
+    Returns:
+        tuple: (summary, pyramid, detector), None for a stage that is off.
+
+    """
+    summary = BlockSummary(num_channels, scan_rate,
+                           int(BASELINE_SECONDS * scan_rate),
+                           pretrigger_samples)
+    pyramid = None
+    if OVERVIEW_PYRAMID:
+        pyramid = OverviewPyramid(num_channels, samples, OVERVIEW_FACTOR)
+    detector = None
+    if ARRIVAL_DETECTOR:
+        detector = ArrivalDetector(num_channels, scan_rate,
+                                   int(BASELINE_SECONDS * scan_rate),
+                                   ARRIVAL_THRESHOLD, ARRIVAL_MIN_VOLTS, ARRIVAL_MODE,
+                                   pretrigger_samples)
+    return summary, pyramid, detector
+
+def analyse_block(block, header, stages):
+    """
+    Runs the analysis of create_analysis on a block just written, in
+    volts.
+    """
+    block = np.asarray(block)
+    if RECORDING_FORMAT in RAW_FORMATS:
+        block = codes_to_volts(block, header)
+    for stage in stages:
+        if stage is not None:
+            stage.update(block)
+
+def read_and_display_data(hat, samples_per_channel, num_channels, writer,
+                          capture=None):
+    """
+    Reads data from the specified channels on the specified DAQ HAT devices,
+    and writes the data to a recording file.  The reads are executed in a 
+    loop that continues until the user stops the scan, the specified 
+    scan length is reached, or an overrun error is detected.
+
+    Args:
+        hat (mcc118): The mcc118 HAT device object.
+        num_channels (int): The number of channels to display.
+        writer: The recording writer returned by create_recording.
+        capture (PretriggerCapture): The triggered continuous capture,
+            or None for a finite scan.
+
+    Returns:
+        None
+
+    """   
+    
+    # With READ_STRATEGY 'blocking', each read waits until a block of
+    # READ_LATENCY_SECONDS of samples has arrived (or the scan ends), with a
+    # timeout a second longer than the block. Otherwise read all of the
+    # available samples (up to the size of the read_buffer which is
+    # specified by the user_buffer_size).  Since the read_request_size is set
+    # to -1 (READ_ALL_AVAILABLE), this function returns immediately with
+    # whatever samples are available (up to user_buffer_size) and the timeout
+    # parameter is ignored.
+    total_samples_read = 0
+    if READ_STRATEGY == 'blocking':
+        read_request_size, timeout = read_block_size(
+            actual_scan_rate, READ_LATENCY_SECONDS, samples_per_channel)
+    else:
+        read_request_size = READ_ALL_AVAILABLE
+        timeout = 5.0
+    completeFlag = 0    
+    
+    # Give the recording its trigger time and a name based upon it
+    fileDateTime = datetime.strftime(datetime.fromtimestamp(trigger_time_ns / 1e9),
+                                     "(%m_%d_%Y)-(%H-%M-%S)")
+    writer.set_trigger(trigger_time_ns, mypath + "/" + DAQ_NAME + "_" + fileDateTime)
+    pretrigger_samples = 0
+    if capture is not None:
+        pretrigger_samples = capture.trigger_index - capture.first_index
+        writer.update_header(pretrigger_samples=pretrigger_samples)
+    if trigger_latency_ns is not None:
+        writer.update_header(trigger_latency_ns=trigger_latency_ns)
+        print('     Trigger to first data: %.3f ms' % (trigger_latency_ns / 1e6))
+    if RECORDING_FORMAT in RAW_FORMATS:
+        sample_dtype = np.int16
+    else:
+        sample_dtype = np.float64
+
+    # Blast summary for the header and catalog, and the overview pyramid,
+    # updated block by block (in volts). Times are measured from the
+    # trigger sample, after any pre-trigger history.
+    stages = create_analysis(num_channels, actual_scan_rate,
+                             pretrigger_samples + samples_per_channel,
+                             pretrigger_samples)
+    summary, pyramid, detector = stages
+    def save_block(block):
+        writer.write(block) #Write the block to file
+        analyse_block(block, writer.header, stages)
     
     # Recording LED
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setup(RECORDING_LED, GPIO.OUT, initial=GPIO.LOW)
+    GPIO.output(PRIMED_LED,GPIO.LOW)
     GPIO.output(RECORDING_LED,GPIO.HIGH)
     
-    while total_samples_read < samples_per_channel:
-        read_result = hat.a_in_scan_read(read_request_size, timeout)
+    if READ_NUMPY:
+        read_chunk = lambda: hat.a_in_scan_read_numpy(read_request_size, timeout)
+    else:
+        read_chunk = lambda: hat.a_in_scan_read(read_request_size, timeout)
+    if first_read is not None:
+        # The samples of the read that waited for the trigger come first
+        read_chunk = prepend_read(first_read, read_chunk)
+    block_samples = max(1, int(PIPELINE_BLOCK_SECONDS * actual_scan_rate))
 
-        # Check for an overrun error
-        if read_result.hardware_overrun:
-            print('\n\nHardware overrun\n')
-            break
-        elif read_result.buffer_overrun:
-            print('\n\nBuffer overrun\n')
-            break
-        elif not (read_result.running and completeFlag == 0):
-            completeFlag = 1
-            print('\n (2) Recording Completed - Buffer Draining')
+    # Capture to RAM only when the whole shot fits the memory budget
+    capture_in_ram = CAPTURE_IN_RAM and capture is None
+    if capture_in_ram and CaptureBuffer.size_bytes(
+            samples_per_channel, num_channels, sample_dtype) > CAPTURE_MEMORY_BUDGET:
+        print('     Capture buffer exceeds memory budget - streaming to disk')
+        capture_in_ram = False
 
-        samples_read_per_channel = int(len(read_result.data) / num_channels)
-        total_samples_read += samples_read_per_channel
-        
-        totalSamples = len(read_result.data) 
+    if capture is not None:
+        try:
+            for segments in capture.blocks(block_samples):
+                if capture.finished and completeFlag == 0:
+                    completeFlag = 1
+                    print('\n (2) Recording Completed - Buffer Draining')
+                for block in segments:
+                    save_block(block)
+        finally:
+            # The reader thread must be gone before the scan is stopped
+            capture.stop()
+        hat.a_in_scan_stop()
+        if capture.overrun:
+            print('\n\n' + capture.overrun + '\n')
+        total_samples_read = capture.samples_read
+    elif capture_in_ram:
+        capture = CaptureBuffer(samples_per_channel, num_channels, sample_dtype)
+        total_samples_read = capture.capture(read_chunk)
+        if capture.overrun:
+            print('\n\n' + capture.overrun + '\n')
+        elif total_samples_read < samples_per_channel:
+            print('\n\nScan stopped after ' + str(total_samples_read) + ' of '
+                  + str(samples_per_channel) + ' samples per channel\n')
+        print('\n (2) Recording Completed - Saving Capture Buffer')
+        for block in capture.blocks(block_samples):
+            save_block(block)
+    elif USE_PIPELINE:
+        pipeline = ScanPipeline(read_chunk, samples_per_channel, num_channels,
+                                block_samples, PIPELINE_NUM_BLOCKS, sample_dtype)
+        pipeline.start()
+        for block in pipeline.blocks():
+            if pipeline.completed and completeFlag == 0:
+                completeFlag = 1
+                print('\n (2) Recording Completed - Buffer Draining')
+            save_block(block)
+        if pipeline.overrun:
+            print('\n\n' + pipeline.overrun + '\n')
+        total_samples_read = pipeline.samples_read
+    else:
+        while total_samples_read < samples_per_channel:
+            read_result = read_chunk()
 
-        if samples_read_per_channel > 0:
-            index = samples_read_per_channel * num_channels - num_channels
-            
-            new_index = 0
-            myArray=[] #create an empty array
-            for i in range(0, totalSamples, num_channels):
-                myArray.append([])  #add a row to the array (COLUMN)
-                for j in range(num_channels):
-					#append a num_channels of data to the array (ROW)
-                    myArray[new_index].append(read_result.data[i + j])  
-                new_index+=1
-
-            csvwriter.writerows(myArray) #Write the array to file
-            csvfile.flush
+            # Check for an overrun error
+            if read_result.hardware_overrun:
+                print('\n\nHardware overrun\n')
+                break
+            elif read_result.buffer_overrun:
+                print('\n\nBuffer overrun\n')
+                break
+            elif not (read_result.running and completeFlag == 0):
+                completeFlag = 1
+                print('\n (2) Recording Completed - Buffer Draining')
+
+            samples_read_per_channel = int(len(read_result.data) / num_channels)
+            total_samples_read += samples_read_per_channel
+
+            if samples_read_per_channel > 0:
+                if READ_NUMPY:
+                    # Reshape the whole chunk to (n, num_channels) at once
+                    block = deinterleave_numpy(read_result.data, num_channels)
+                    save_block(block)
+                else:
+                    myArray = deinterleave_list(read_result.data, num_channels)
+                    save_block(myArray)
 
     # Cleanup
-    csvfile.close()  
-    print('\n (3) Buffer Drained - Data Saved to CSV File\n')
-    GPIO.cleanup()
-    GPIO.setmode(GPIO.BCM)
-    
-    # Complete LED
-    GPIO.setup(COMPLETE_LED, GPIO.OUT, initial=GPIO.LOW)
-    GPIO.output(COMPLETE_LED,GPIO.HIGH)
-    time.sleep(5)
-    GPIO.cleanup()
-    hat.a_in_scan_cleanup()
-    global CMD_RECEIVED
-    CMD_RECEIVED = 1
-    
-    # Restarts script to prepare for another recording
-    main()
+    blast_summary = summary.result()
+    if ARRIVAL_DETECTOR:
+        blast_summary.update(detector.result())
+        for chan, arrival in zip(scan_channels, blast_summary['arrival_time']):
+            print('     Channel %d arrival: ' % chan,
+                  'none' if arrival is None else '%.6f s' % arrival)
+    # CSV has no header, and a binary header may lack the room: the
+    # summary is then stored next to the recording
+    in_header = writer.binary_header
+    if in_header:
+        try:
+            writer.update_header(summary=blast_summary)
+        except ValueError as err:
+            print('     Summary not stored in header: ', err)
+            in_header = False
+    writer.close()
+    if not in_header:
+        save_summary(summary_path(writer.path), blast_summary)
+    catalog.add(writer.path, writer.header, writer.samples_written, blast_summary)
+    if OVERVIEW_PYRAMID:
+        pyramid.save(overview_path(writer.path), writer.header)
+    print('\n (3) Buffer Drained - Data Saved to ' + os.path.basename(writer.path) + '\n')
+    if isinstance(capture, PretriggerCapture):
+        report = capture.report()
+        print('     Ring buffer: %d pre-trigger samples of %d, reader waits %d'
+              % (report['pretrigger_samples'], report['ring_size'],
+                 report['reader_waits']))
+    elif USE_PIPELINE and not capture_in_ram:
+        report = pipeline.report()
+        print('     Pipeline: %d blocks of %d samples, queue high-water mark %d of %d, reader waits %d'
+              % (report['blocks'], report['block_samples'], report['high_water'],
+                 report['queue_size'], report['reader_waits']))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+	Description:
+		 Benchmark sweeping the write block size of the recording writer
+		 against a target directory, normally the DATA folder on the SD
+		 card that will be used in the field. For each block size a
+		 recording-sized file is written in read-sized pieces, the same
+		 way read_and_display_data feeds the writer, and synced to the
+		 card. The sustained throughput and the longest single write()
+		 stall are reported; a stall longer than the MCC118 buffer can
+		 absorb is what turns into an overrun.
+
+		 Usage: python3 bench_blocksize.py /home/pi/Desktop/DAQ_A/DATA
+		        [--mb 64] [--piece-kb 80] [--sizes 0,64,256,1024,4096]
+"""
+
+import argparse
+import os
+import time
+from racs_recording import open_file
+
+
+def run(path, total, piece, block_size, durable):
+    """
+    Writes total bytes in pieces of piece bytes.
+
+    Returns:
+        tuple: (MB/s including the final sync, longest write in seconds)
+
+    """
+    data = os.urandom(piece)
+    f = open_file(path, block_size=block_size, durable=durable,
+                  preallocate=total)
+    longest = 0.0
+    start = time.perf_counter()
+    written = 0
+    while written < total:
+        t = time.perf_counter()
+        f.write(data)
+        longest = max(longest, time.perf_counter() - t)
+        written += piece
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    elapsed = time.perf_counter() - start
+    os.remove(path)
+    return written / elapsed / 1e6, longest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('directory', help='directory on the target card')
+    parser.add_argument('--mb', type=float, default=64.0,
+                        help='size of each test file (MB)')
+    parser.add_argument('--piece-kb', type=float, default=80.0,
+                        help='size of each writer call (KB); 0.1 s of '
+                             '2 channels at 50 kHz in float64 is 80 KB')
+    parser.add_argument('--sizes', default='0,64,256,1024,2048,4096',
+                        help='block sizes to sweep (KB, 0 = Python default '
+                             'buffering)')
+    parser.add_argument('--durable', action='store_true',
+                        help='use the durable writer (batched fsync)')
+    args = parser.parse_args()
+
+    total = int(args.mb * 1024 * 1024)
+    piece = int(args.piece_kb * 1024)
+    path = os.path.join(args.directory, 'bench_blocksize.tmp')
+
+    print('%.0f MB in %d KB pieces to %s%s' % (
+        args.mb, piece // 1024, args.directory,
+        ' (durable)' if args.durable else ''))
+    print('    block (KB)      MB/s   longest write (ms)')
+    for size in [int(s) for s in args.sizes.split(',')]:
+        rate, longest = run(path, total, piece, size * 1024, args.durable)
+        label = 'default' if size == 0 else str(size)
+        print('    %10s  %8.1f   %18.1f' % (label, rate, longest * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+	Description:
+		 Benchmark comparing the CPU cost of the two deinterleave paths
+		 used by read_and_display_data. Synthetic interleaved chunks are
+		 generated at the requested combined sample rate and pushed
+		 through each path (deinterleave + csv.writerows to a null sink).
+		 The result is reported as CPU seconds spent per second of
+		 recorded data, i.e. the fraction of one core the path needs to
+		 keep up with the MCC118. Both the deinterleave step alone and
+		 deinterleave + csv.writerows are reported.
+
+		 Usage: python3 bench_deinterleave.py [--rate 100000]
+		        [--channels 2] [--seconds 5] [--chunk 5000]
+"""
+
+import argparse
+import csv
+import os
+import time
+import numpy as np
+from racs_acquire import deinterleave_list, deinterleave_numpy
+
+
+def make_chunks(rate, num_channels, seconds, chunk):
+    """
+    Builds interleaved chunks of 12-bit quantized voltages.
+
+    Args:
+        rate (float): Combined sample rate (samples/sec, all channels).
+        num_channels (int): Number of channels in each scan.
+        seconds (float): Length of data to generate.
+        chunk (int): Samples per channel in each chunk.
+
+    Returns:
+        list[numpy.ndarray]: Interleaved float64 chunks.
+
+    """
+    rng = np.random.default_rng(0)
+    samples_per_channel = int(rate / num_channels * seconds)
+    codes = rng.integers(0, 4096, samples_per_channel * num_channels)
+    data = codes * (20.0 / 4096) - 10.0
+    step = chunk * num_channels
+    return [data[i:i + step] for i in range(0, len(data), step)]
+
+
+def run_list(chunks, num_channels, writer):
+    for data in chunks:
+        rows = deinterleave_list(data, num_channels)
+        if writer is not None:
+            writer.writerows(rows)
+
+
+def run_numpy(chunks, num_channels, writer):
+    for data in chunks:
+        block = deinterleave_numpy(data, num_channels)
+        if writer is not None:
+            writer.writerows(block.tolist())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rate', type=float, default=100000.0,
+                        help='combined sample rate (samples/sec)')
+    parser.add_argument('--channels', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--chunk', type=int, default=5000,
+                        help='samples per channel per read')
+    args = parser.parse_args()
+
+    chunks = make_chunks(args.rate, args.channels, args.seconds, args.chunk)
+    # a_in_scan_read returns lists, so convert outside of the timing
+    list_chunks = [c.tolist() for c in chunks]
+
+    print('Combined rate: %.0f S/s, %d channels, %.1f s of data, '
+          '%d samples/channel per read' % (args.rate, args.channels,
+                                           args.seconds, args.chunk))
+    with open(os.devnull, 'w') as devnull:
+        for label, writer in (('deinterleave only', None),
+                              ('deinterleave + csv.writerows',
+                               csv.writer(devnull))):
+            print('  ' + label)
+            for name, func, data in (('list', run_list, list_chunks),
+                                     ('numpy', run_numpy, chunks)):
+                start = time.process_time()
+                func(data, args.channels, writer)
+                cpu = time.process_time() - start
+                print('    %-6s %8.3f CPU s/s  (%5.1f%% of one core)'
+                      % (name, cpu / args.seconds,
+                         100.0 * cpu / args.seconds))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+	Description:
+		 Benchmark comparing the CPU use of the scan read strategies of
+		 read_and_display_data: READ_ALL_AVAILABLE, which returns at
+		 once with whatever is buffered and so spins when little is
+		 there, against blocking fixed-size reads sized by
+		 read_block_size() for several target latencies. Each strategy
+		 drains a scan for the given time, deinterleaving and formatting
+		 every read as CSV to a null sink, and reports reads per second
+		 and the CPU used as a percentage of one core.
+
+		 Without --hardware the MCC118 is simulated: samples become
+		 available at the scan rate in real time and a blocking read
+		 sleeps until its block is complete, as the driver does. With
+		 --hardware a continuous scan is run on the MCC118 at --address.
+
+		 Usage: python3 bench_readstrategy.py [--rate 50000] [--channels 2]
+		        [--seconds 5] [--latencies 0.01,0.1,0.5] [--hardware]
+"""
+
+import argparse
+import os
+import time
+import numpy as np
+from racs_acquire import deinterleave_numpy, read_block_size, ScanRead
+from racs_recording import format_csv_block
+
+READ_ALL_AVAILABLE = -1
+
+
+class SimulatedScan:
+    """
+    Stands in for a continuous MCC118 scan: samples become available at
+    scan_rate from the moment it is created.
+    """
+
+    def __init__(self, scan_rate, num_channels):
+        self.scan_rate = scan_rate
+        self.num_channels = num_channels
+        self.samples = np.random.uniform(-10, 10, int(scan_rate) * num_channels)
+        self.read = 0
+        self.start = time.perf_counter()
+
+    def _available(self):
+        return int((time.perf_counter() - self.start) * self.scan_rate) - self.read
+
+    def a_in_scan_read_numpy(self, samples_per_channel, timeout):
+        timed_out = False
+        if samples_per_channel > 0:
+            deadline = time.perf_counter() + timeout
+            while self._available() < samples_per_channel:
+                wait = (samples_per_channel - self._available()) / self.scan_rate
+                if time.perf_counter() + wait > deadline:
+                    timed_out = True
+                    break
+                time.sleep(wait)
+            count = min(self._available(), samples_per_channel)
+        else:
+            count = self._available()
+        count = min(count, len(self.samples) // self.num_channels)
+        self.read += count
+        return ScanRead(True, False, False, True, timed_out,
+                        self.samples[:count * self.num_channels])
+
+
+def hardware_scan(address, scan_rate, channels):
+    """
+    Starts a continuous scan on an MCC118.
+
+    Returns:
+        mcc118: The board, scanning.
+
+    """
+    from daqhats import mcc118, OptionFlags
+    hat = mcc118(address)
+    mask = sum(1 << chan for chan in channels)
+    hat.a_in_scan_start(mask, int(scan_rate * 10), scan_rate,
+                        OptionFlags.CONTINUOUS)
+    return hat
+
+
+def run(scan, request, timeout, seconds, num_channels, sink):
+    """
+    Reads for the given time.
+
+    Returns:
+        tuple: (reads per second, CPU percent of one core).
+
+    """
+    reads = 0
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    end = wall + seconds
+    while time.perf_counter() < end:
+        result = scan.a_in_scan_read_numpy(request, timeout)
+        reads += 1
+        block = deinterleave_numpy(result.data, num_channels)
+        if len(block):
+            sink.write(format_csv_block(block))
+    wall = time.perf_counter() - wall
+    return reads / wall, (time.process_time() - cpu) / wall * 100
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rate', type=float, default=50000.0,
+                        help='scan rate (samples/sec/channel)')
+    parser.add_argument('--channels', type=int, default=2,
+                        help='channels per scan')
+    parser.add_argument('--seconds', type=float, default=5.0,
+                        help='length of each run')
+    parser.add_argument('--latencies', default='0.01,0.1,0.5',
+                        help='target read latencies (s) for blocking reads')
+    parser.add_argument('--hardware', action='store_true',
+                        help='use an MCC118 instead of the simulation')
+    parser.add_argument('--address', type=int, default=0,
+                        help='HAT address for --hardware')
+    args = parser.parse_args()
+
+    strategies = [('all available', READ_ALL_AVAILABLE, 5.0)]
+    for latency in [float(l) for l in args.latencies.split(',')]:
+        request, timeout = read_block_size(args.rate, latency)
+        strategies.append(('blocking %g s' % latency, request, timeout))
+
+    print('%.0f S/s/channel x %d channels, %.0f s per run%s' % (
+        args.rate, args.channels, args.seconds,
+        ' (MCC118)' if args.hardware else ' (simulated)'))
+    print('    strategy          request    reads/s    CPU %')
+    with open(os.devnull, 'wb') as sink:
+        for name, request, timeout in strategies:
+            if args.hardware:
+                scan = hardware_scan(args.address, args.rate,
+                                     list(range(args.channels)))
+            else:
+                scan = SimulatedScan(args.rate, args.channels)
+            try:
+                rate, cpu = run(scan, request, timeout, args.seconds,
+                                args.channels, sink)
+            finally:
+                if args.hardware:
+                    scan.a_in_scan_stop()
+                    scan.a_in_scan_cleanup()
+            print('    %-16s %8s %10.0f %8.1f' % (
+                name, 'all' if request < 0 else request, rate, cpu))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,725 @@
+#!/usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+	Description:
+		 Acquisition helpers shared by the RACS_DAQ scripts. These
+		 functions turn the interleaved sample stream returned by the
+		 MCC118 scan reads into per-row blocks ready for the recording
+		 writer, optionally on a dedicated reader thread. Nothing in
+		 this module touches the DAQ Hat or GPIO directly, so it can also
+		 be imported on a workstation for benchmarking and
+		 post-processing.
+"""
+
+import collections
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+def deinterleave_list(data, num_channels):
+    """
+    Splits an interleaved sample list into rows, one Python float at a
+    time. This is the original read_and_display_data loop and is kept
+    for comparison and for use with a_in_scan_read.
+
+    Args:
+        data (list[float]): Interleaved samples as returned by
+            a_in_scan_read (ch0, ch1, ..., ch0, ch1, ...).
+        num_channels (int): The number of channels in the scan.
+
+    Returns:
+        list[list[float]]: One row of num_channels samples per scan.
+
+    """
+    totalSamples = len(data)
+    new_index = 0
+    myArray = [] #create an empty array
+    for i in range(0, totalSamples, num_channels):
+        myArray.append([])  #add a row to the array (COLUMN)
+        for j in range(num_channels):
+            #append a num_channels of data to the array (ROW)
+            myArray[new_index].append(data[i + j])
+        new_index += 1
+    return myArray
+
+
+def deinterleave_numpy(data, num_channels):
+    """
+    Splits an interleaved sample array into rows in one vectorized step.
+    The MCC118 returns whole scans, so the result is a view of the read
+    buffer and no samples are copied.
+
+    Args:
+        data (numpy.ndarray): Interleaved samples as returned by
+            a_in_scan_read_numpy.
+        num_channels (int): The number of channels in the scan.
+
+    Returns:
+        numpy.ndarray: Array of shape (n, num_channels).
+
+    """
+    data = np.asarray(data)
+    return data.reshape(-1, num_channels)
+
+
+# Read and status results of a HatGroup, with the fields of the daqhats
+# MCC118ScanRead and MCC118ScanStatus results
+ScanRead = collections.namedtuple(
+    'ScanRead', ['running', 'hardware_overrun', 'buffer_overrun', 'triggered',
+                 'timeout', 'data'])
+ScanStatus = collections.namedtuple(
+    'ScanStatus', ['running', 'hardware_overrun', 'buffer_overrun',
+                   'triggered', 'samples_available'])
+
+# Channels per MCC118, used to number the channels of a stack
+MCC118_CHANNELS = 8
+
+
+def read_block_size(scan_rate, latency, buffer_samples=None):
+    """
+    Sizes a blocking read: the samples per channel that arrive in
+    `latency` seconds, so the reader wakes about 1 / latency times per
+    second with a full block, kept to a quarter of the scan buffer so
+    the buffer cannot fill while a block is being gathered.
+
+    Args:
+        scan_rate (float): Actual scan rate (samples/sec/channel).
+        latency (float): Target time between reads (seconds).
+        buffer_samples (int): Scan buffer size (samples per channel),
+            or None when unknown.
+
+    Returns:
+        tuple: (samples per channel to request, timeout in seconds).
+
+    """
+    request = max(int(scan_rate * latency), 1)
+    if buffer_samples:
+        request = max(min(request, buffer_samples // 4), 1)
+    # A full block plus a second of slack before the read gives up
+    return request, request / scan_rate + 1.0
+
+
+def prepend_read(first_result, read_chunk):
+    """
+    Replays a read that was already made (e.g. the read that waited for
+    the trigger) before continuing with read_chunk.
+
+    Args:
+        first_result: A daqhats read result.
+        read_chunk (callable): Returns the next daqhats read result.
+
+    Returns:
+        callable: Returns first_result once, then read_chunk().
+
+    """
+    pending = [first_result]
+
+    def read():
+        if pending:
+            return pending.pop()
+        return read_chunk()
+    return read
+
+
+def overrun_message(read_result):
+    """
+    Checks a daqhats read result for an overrun error.
+
+    Args:
+        read_result: Result of a_in_scan_read or a_in_scan_read_numpy.
+
+    Returns:
+        str: 'Hardware overrun' or 'Buffer overrun', or None.
+
+    """
+    if read_result.hardware_overrun:
+        return 'Hardware overrun'
+    elif read_result.buffer_overrun:
+        return 'Buffer overrun'
+    return None
+
+
+class ScanPipeline:
+    """
+    Splits a scan into a reader thread and a writer stage. The reader
+    thread only drains the MCC118 buffer, copying samples into a fixed
+    pool of preallocated blocks and passing full blocks through a
+    bounded queue. The writer stage (the caller of blocks()) formats and
+    persists them, so a slow disk write no longer delays the next read.
+
+    Queue statistics are kept so buffers can be sized from real runs:
+    the high-water mark of the queue depth and the number of times the
+    reader had to wait for the writer to hand back a block.
+
+    Args:
+        read_chunk (callable): Returns the next daqhats read result
+            (data, hardware_overrun, buffer_overrun, running), e.g.
+            lambda: hat.a_in_scan_read_numpy(READ_ALL_AVAILABLE, 5.0).
+        samples_per_channel (int): Samples per channel to read in total.
+        num_channels (int): The number of channels in the scan.
+        block_samples (int): Samples per channel in each block.
+        num_blocks (int): Number of preallocated blocks (queue depth).
+        dtype: Sample type of the blocks.
+
+    """
+
+    def __init__(self, read_chunk, samples_per_channel, num_channels,
+                 block_samples, num_blocks, dtype=np.float64):
+        self.read_chunk = read_chunk
+        self.samples_per_channel = samples_per_channel
+        self.num_channels = num_channels
+        self.block_samples = block_samples
+        self.num_blocks = num_blocks
+        self.free = queue.Queue()
+        for i in range(num_blocks):
+            self.free.put(np.empty((block_samples, num_channels), dtype))
+        self.full = queue.Queue(maxsize=num_blocks)
+        self.thread = threading.Thread(target=self._reader, daemon=True)
+
+        self.samples_read = 0
+        self.blocks_passed = 0
+        self.high_water = 0
+        self.reader_waits = 0
+        self.overrun = None
+        self.error = None
+        self.completed = False
+
+    def start(self):
+        self.thread.start()
+
+    def _next_free(self):
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            # The writer holds every block; this is where overruns start
+            self.reader_waits += 1
+            return self.free.get()
+
+    def _put(self, block, rows):
+        self.full.put((block, rows))
+        self.blocks_passed += 1
+        self.high_water = max(self.high_water, self.full.qsize())
+
+    def _reader(self):
+        block = self._next_free()
+        rows = 0
+        try:
+            while self.samples_read < self.samples_per_channel:
+                read_result = self.read_chunk()
+
+                self.overrun = overrun_message(read_result)
+                if self.overrun:
+                    break
+                elif not read_result.running:
+                    self.completed = True
+
+                data = deinterleave_numpy(read_result.data, self.num_channels)
+                self.samples_read += len(data)
+
+                # Copy the chunk into the pool, passing on each full block
+                while len(data):
+                    count = min(len(data), self.block_samples - rows)
+                    block[rows:rows + count] = data[:count]
+                    rows += count
+                    data = data[count:]
+                    if rows == self.block_samples:
+                        self._put(block, rows)
+                        block = self._next_free()
+                        rows = 0
+        except Exception as exc:
+            self.error = exc
+        finally:
+            if rows:
+                self._put(block, rows)
+            self.full.put((None, 0))
+
+    def blocks(self):
+        """
+        Yields blocks in scan order until the reader finishes. Each block
+        is a view into the pool and is handed back to the reader as soon
+        as the caller asks for the next one, so it must be consumed (or
+        copied) before then.
+
+        Returns:
+            Iterator of numpy.ndarray of shape (n, num_channels).
+
+        """
+        while True:
+            block, rows = self.full.get()
+            if block is None:
+                break
+            yield block[:rows]
+            self.free.put(block)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def report(self):
+        """
+        Returns:
+            dict: Queue statistics for the finished scan.
+
+        """
+        return {
+            'samples_read': self.samples_read,
+            'blocks': self.blocks_passed,
+            'block_samples': self.block_samples,
+            'queue_size': self.num_blocks,
+            'high_water': self.high_water,
+            'reader_waits': self.reader_waits,
+            'overrun': self.overrun,
+        }
+
+
+class CaptureBuffer:
+    """
+    Holds a complete finite scan in one contiguous preallocated array.
+    Each read is copied straight into its slot, so the capture does no
+    per-chunk allocation of its own and never touches the disk. The
+    recording is written from the buffer after the scan completes.
+
+    Args:
+        samples_per_channel (int): Samples per channel in the scan.
+        num_channels (int): The number of channels in the scan.
+        dtype: Sample type of the buffer.
+
+    """
+
+    def __init__(self, samples_per_channel, num_channels, dtype=np.float64):
+        self.data = np.empty((samples_per_channel, num_channels), dtype)
+        self.num_channels = num_channels
+        self.rows = 0
+        self.overrun = None
+
+    @staticmethod
+    def size_bytes(samples_per_channel, num_channels, dtype=np.float64):
+        """
+        Returns:
+            int: Memory needed to capture the scan.
+
+        """
+        return samples_per_channel * num_channels * np.dtype(dtype).itemsize
+
+    def capture(self, read_chunk):
+        """
+        Reads until the buffer is full, an overrun occurs or the scan
+        stops. A scan that stops early (e.g. a_in_scan_stop from another
+        thread) leaves a short capture: rows is then less than the size
+        of the buffer.
+
+        Args:
+            read_chunk (callable): Returns the next daqhats read result.
+
+        Returns:
+            int: Samples per channel captured.
+
+        """
+        while self.rows < len(self.data):
+            read_result = read_chunk()
+
+            self.overrun = overrun_message(read_result)
+            if self.overrun:
+                break
+
+            chunk = deinterleave_numpy(read_result.data, self.num_channels)
+            count = min(len(chunk), len(self.data) - self.rows)
+            self.data[self.rows:self.rows + count] = chunk[:count]
+            self.rows += count
+
+            # The last read of a stopped scan holds all it will return
+            if not read_result.running:
+                break
+        return self.rows
+
+    def blocks(self, block_samples):
+        """
+        Yields the captured samples in slices of block_samples rows, so
+        the writer never has to format the whole shot in one piece.
+
+        Returns:
+            Iterator of numpy.ndarray of shape (n, num_channels).
+
+        """
+        for start in range(0, self.rows, block_samples):
+            yield self.data[start:min(start + block_samples, self.rows)]
+
+
+class RingBuffer:
+    """
+    Fixed-size circular buffer of rows. Writes copy each block into the
+    preallocated array at the running position, wrapping around at the
+    end, so a write costs the copy and nothing else: no allocation and
+    no shifting of the rows already held. Rows are addressed by their
+    absolute index since the first write.
+
+    Args:
+        capacity (int): Rows held.
+        num_channels (int): The number of channels in the scan.
+        dtype: Sample type of the buffer.
+
+    """
+
+    def __init__(self, capacity, num_channels, dtype=np.float64):
+        self.data = np.empty((capacity, num_channels), dtype)
+        self.capacity = capacity
+        self.written = 0
+
+    @property
+    def oldest(self):
+        """
+        Returns:
+            int: Absolute index of the oldest row still held.
+
+        """
+        return max(self.written - self.capacity, 0)
+
+    def write(self, block):
+        """
+        Appends rows, overwriting the oldest ones.
+
+        Args:
+            block (numpy.ndarray): Array of shape (n, num_channels).
+
+        Returns:
+            None
+
+        """
+        count = len(block)
+        if count > self.capacity:
+            block = block[count - self.capacity:]
+            self.written += count - self.capacity
+            count = self.capacity
+        start = self.written % self.capacity
+        first = min(count, self.capacity - start)
+        self.data[start:start + first] = block[:first]
+        self.data[:count - first] = block[first:]
+        self.written += count
+
+    def segments(self, start, stop):
+        """
+        Returns rows [start, stop) as views into the buffer: one view,
+        or two when the range wraps around the end.
+
+        Args:
+            start (int): Absolute index of the first row.
+            stop (int): Absolute index after the last row.
+
+        Returns:
+            list[numpy.ndarray]: Views of shape (n, num_channels).
+
+        Raises:
+            ValueError: Some rows are no longer (or not yet) held.
+
+        """
+        if start < self.oldest or stop > self.written:
+            raise ValueError('Rows %d-%d are not in the ring buffer' % (start, stop))
+        if stop <= start:
+            return []
+        first = start % self.capacity
+        last = first + stop - start
+        if last <= self.capacity:
+            return [self.data[first:last]]
+        return [self.data[first:], self.data[:last - self.capacity]]
+
+
+class PretriggerCapture:
+    """
+    Continuous scan through a ring buffer with pre-trigger history. A
+    reader thread drains the MCC118 into the ring from the moment the
+    scan starts; older samples are simply overwritten. When trigger()
+    is called, the last pre_samples rows before the trigger are frozen
+    and the next post_samples rows are kept too, and blocks() yields
+    them all in order for the recording. After the trigger the reader
+    waits rather than overwrite rows the writer has not taken yet, so
+    the ring needs room for pre_samples plus enough slack to ride out
+    disk stalls.
+
+    Args:
+        read_chunk (callable): Returns the next daqhats read result.
+        num_channels (int): The number of channels in the scan.
+        pre_samples (int): Samples per channel kept before the trigger.
+        post_samples (int): Samples per channel kept from the trigger on.
+        slack_samples (int): Extra ring rows beyond pre_samples; must
+            exceed the largest single read.
+        dtype: Sample type of the ring.
+        detector (callable): Optional software trigger, called on the
+            reader thread with every block read before the trigger. It
+            returns the absolute sample index where the trigger fired,
+            or None (see racs_analysis.TriggerEngine.update).
+        on_trigger (callable): Optional, called without arguments on the
+            reader thread once the detector has fired, e.g. to wake a
+            thread waiting for the trigger.
+
+    """
+
+    def __init__(self, read_chunk, num_channels, pre_samples, post_samples,
+                 slack_samples, dtype=np.float64, detector=None,
+                 on_trigger=None):
+        self.read_chunk = read_chunk
+        self.detector = detector
+        self.on_trigger = on_trigger
+        self.num_channels = num_channels
+        self.pre_samples = pre_samples
+        self.post_samples = post_samples
+        self.ring = RingBuffer(pre_samples + slack_samples, num_channels, dtype)
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._reader, daemon=True)
+
+        self.trigger_index = None
+        self.first_index = None
+        self.stop_index = None
+        self.consumed = 0
+        self.reader_waits = 0
+        self.overrun = None
+        self.error = None
+        self.finished = False
+        self.stopping = False
+
+    @property
+    def samples_read(self):
+        return self.ring.written
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """
+        Ends the capture, with or without a trigger (e.g. on shutdown or
+        a write error), and waits for the reader thread. Call before the
+        scan is cleaned up or restarted; a capture is not restarted, a
+        new one is built for the next scan.
+        """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if self.thread.ident is not None:
+            self.thread.join()
+
+    @property
+    def triggered(self):
+        return self.trigger_index is not None
+
+    def trigger(self, index=None):
+        """
+        Marks the trigger and freezes the pre-trigger history. Later
+        calls are ignored, so a radio trigger and a software trigger can
+        both be armed.
+
+        Args:
+            index (int): Absolute sample index of the trigger, by
+                default the next sample to be read.
+
+        Returns:
+            int: Pre-trigger samples per channel available (fewer than
+            pre_samples when the scan has not run that long).
+
+        """
+        with self.condition:
+            if self.trigger_index is not None:
+                return self.trigger_index - self.first_index
+            if index is None:
+                index = self.ring.written
+            self.trigger_index = index
+            self.first_index = max(index - self.pre_samples, self.ring.oldest)
+            self.stop_index = index + self.post_samples
+            self.consumed = self.first_index
+            self.condition.notify_all()
+            return index - self.first_index
+
+    def _reader(self):
+        try:
+            while not self.stopping:
+                read_result = self.read_chunk()
+
+                self.overrun = overrun_message(read_result)
+                if self.overrun:
+                    break
+
+                data = deinterleave_numpy(read_result.data, self.num_channels)
+                if self.detector is not None and self.trigger_index is None:
+                    fired = self.detector(data)
+                    if fired is not None:
+                        self.trigger(fired)
+                        if self.on_trigger is not None:
+                            self.on_trigger()
+                with self.condition:
+                    if self.stop_index is not None:
+                        data = data[:max(self.stop_index - self.ring.written, 0)]
+                        # Do not overwrite rows the writer has not taken
+                        while (self.ring.written + len(data) - self.consumed
+                               > self.ring.capacity and not self.stopping):
+                            self.reader_waits += 1
+                            self.condition.wait()
+                    self.ring.write(data)
+                    self.condition.notify_all()
+                    if self.stop_index is not None \
+                            and self.ring.written >= self.stop_index:
+                        break
+                if not read_result.running:
+                    break
+        except Exception as exc:
+            self.error = exc
+        finally:
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+
+    def blocks(self, block_samples):
+        """
+        Yields the pre-trigger history and then the post-trigger samples
+        as they arrive, at most block_samples rows at a time. Call after
+        trigger(). Each item is a list of one or two views into the ring
+        (see RingBuffer.segments), valid until the next item is
+        requested.
+
+        Returns:
+            Iterator of lists of numpy.ndarray of shape (n, num_channels).
+
+        """
+        while True:
+            with self.condition:
+                while (self.ring.written - self.consumed < block_samples
+                       and self.ring.written < self.stop_index
+                       and not self.finished):
+                    self.condition.wait()
+                end = min(self.consumed + block_samples, self.ring.written,
+                          self.stop_index)
+                if end <= self.consumed:
+                    break
+                segments = self.ring.segments(self.consumed, end)
+            yield segments
+            with self.condition:
+                self.consumed = end
+                self.condition.notify_all()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def report(self):
+        """
+        Returns:
+            dict: Capture statistics for the finished scan.
+
+        """
+        return {
+            'samples_read': self.ring.written,
+            'ring_size': self.ring.capacity,
+            'pretrigger_samples': (self.trigger_index - self.first_index
+                                   if self.trigger_index is not None else 0),
+            'reader_waits': self.reader_waits,
+            'overrun': self.overrun,
+        }
+
+
+class HatGroup:
+    """
+    A stack of MCC118 boards driven as one device. The scan methods used
+    by the RACS_DAQ scripts are forwarded to every board, and reads are
+    issued to all boards in parallel and joined into rows holding the
+    channels of every board side by side. The first board is the clock
+    leader; the others are started with clock_flag (OptionFlags.EXTCLOCK)
+    so they sample on the leader's CLK output, and all of them share the
+    TRIG input. Followers are started first so they are waiting for the
+    leader's first clock edge.
+
+    Channels are numbered across the stack as address * 8 + channel.
+
+    Args:
+        boards (list): (address, mcc118 object, channel list) per board,
+            leader first.
+        clock_flag: Scan option added for the followers.
+
+    """
+
+    def __init__(self, boards, clock_flag):
+        self.addresses = [address for address, hat, chans in boards]
+        self.hats = [hat for address, hat, chans in boards]
+        self.channel_lists = [list(chans) for address, hat, chans in boards]
+        self.channels = [address * MCC118_CHANNELS + chan
+                         for address, hat, chans in boards for chan in chans]
+        self.clock_flag = clock_flag
+        self.pool = ThreadPoolExecutor(max_workers=len(self.hats))
+        self.carry = [None] * len(self.hats)
+
+    def a_in_scan_actual_rate(self, num_channels, scan_rate):
+        # The leader's clock must suit the board with the most channels
+        return min(hat.a_in_scan_actual_rate(len(chans), scan_rate)
+                   for hat, chans in zip(self.hats, self.channel_lists))
+
+    def trigger_mode(self, mode):
+        for hat in self.hats:
+            hat.trigger_mode(mode)
+
+    def calibration_coefficient_read(self, channel):
+        address, chan = divmod(channel, MCC118_CHANNELS)
+        return self.hats[self.addresses.index(address)] \
+            .calibration_coefficient_read(chan)
+
+    def a_in_scan_start(self, channel_mask, samples_per_channel,
+                        sample_rate_per_channel, options):
+        """
+        Starts the scan on every board. Each board scans its own channel
+        list, so channel_mask (kept for the mcc118 signature) must be
+        None.
+        """
+        if channel_mask is not None:
+            raise ValueError('HatGroup scans its channel lists, pass channel_mask=None')
+        self.carry = [None] * len(self.hats)
+        for i in reversed(range(len(self.hats))):
+            mask = sum(1 << chan for chan in self.channel_lists[i])
+            self.hats[i].a_in_scan_start(
+                mask, samples_per_channel, sample_rate_per_channel,
+                options | self.clock_flag if i else options)
+
+    def a_in_scan_status(self):
+        statuses = [hat.a_in_scan_status() for hat in self.hats]
+        return ScanStatus(
+            running=all(s.running for s in statuses),
+            hardware_overrun=any(s.hardware_overrun for s in statuses),
+            buffer_overrun=any(s.buffer_overrun for s in statuses),
+            triggered=all(s.triggered for s in statuses),
+            samples_available=min(s.samples_available for s in statuses))
+
+    def a_in_scan_read_numpy(self, samples_per_channel, timeout):
+        """
+        Reads every board in parallel and returns the rows that all
+        boards have delivered; rows that only some boards have delivered
+        are kept for the next read.
+
+        Returns:
+            ScanRead: data holds the interleaved samples of the joined
+            rows (all channels of the stack per row).
+
+        """
+        results = list(self.pool.map(
+            lambda hat: hat.a_in_scan_read_numpy(samples_per_channel, timeout),
+            self.hats))
+        rows = []
+        for i, result in enumerate(results):
+            block = deinterleave_numpy(result.data, len(self.channel_lists[i]))
+            if self.carry[i] is not None and len(self.carry[i]):
+                block = np.concatenate((self.carry[i], block))
+            rows.append(block)
+        count = min(len(block) for block in rows)
+        self.carry = [block[count:] for block in rows]
+        return ScanRead(
+            running=all(r.running for r in results),
+            hardware_overrun=any(r.hardware_overrun for r in results),
+            buffer_overrun=any(r.buffer_overrun for r in results),
+            triggered=all(r.triggered for r in results),
+            timeout=any(r.timeout for r in results),
+            data=np.hstack([block[:count] for block in rows]).ravel())
+
+    # The group always reads NumPy arrays
+    a_in_scan_read = a_in_scan_read_numpy
+
+    def a_in_scan_stop(self):
+        for hat in self.hats:
+            hat.a_in_scan_stop()
+
+    def a_in_scan_cleanup(self):
+        for hat in self.hats:
+            hat.a_in_scan_cleanup()
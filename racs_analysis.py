@@ -0,0 +1,583 @@
+#!/usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+	Description:
+		 In-stream analysis of the blocks passing through
+		 read_and_display_data. Every accumulator here is updated one
+		 NumPy block at a time with vectorized operations, so running
+		 it during the capture costs a few array passes per block and
+		 no per-sample Python work. Blocks are (n, num_channels) arrays
+		 of volts.
+"""
+
+import json
+import os
+import numpy as np
+
+
+class BlockSummary:
+    """
+    Running per-channel blast summary of a recording: minimum / maximum
+    (the negative and positive peaks) and when they occurred, mean, RMS,
+    impulse, and the mean and standard deviation of a baseline taken
+    from the start of the recording, before the event arrives.
+
+    Args:
+        num_channels (int): The number of channels in the scan.
+        scan_rate (float): Actual scan rate (samples/sec/channel), for
+            the peak times and impulse. Without it those are omitted.
+        baseline_samples (int): Samples at the start of the recording
+            that form the baseline.
+        trigger_index (int): Index of the trigger sample in the
+            recording (the header pretrigger_samples), from which the
+            peak times are measured.
+
+    """
+
+    def __init__(self, num_channels, scan_rate=None, baseline_samples=0,
+                 trigger_index=0):
+        self.count = 0
+        self.scan_rate = scan_rate
+        self.baseline_samples = baseline_samples
+        self.trigger_index = trigger_index
+        self.minimum = np.full(num_channels, np.inf)
+        self.maximum = np.full(num_channels, -np.inf)
+        self.argmin = np.zeros(num_channels, dtype=np.int64)
+        self.argmax = np.zeros(num_channels, dtype=np.int64)
+        self.total = np.zeros(num_channels)
+        self.squares = np.zeros(num_channels)
+        self.baseline_count = 0
+        self.baseline_total = np.zeros(num_channels)
+        self.baseline_squares = np.zeros(num_channels)
+
+    def update(self, block):
+        """
+        Adds a block of samples.
+
+        Args:
+            block (numpy.ndarray): Array of shape (n, num_channels).
+
+        Returns:
+            None
+
+        """
+        if len(block) == 0:
+            return
+        columns = np.arange(block.shape[1])
+        low = block.argmin(axis=0)
+        high = block.argmax(axis=0)
+        # Strict comparison keeps the first occurrence of a peak
+        lower = block[low, columns] < self.minimum
+        higher = block[high, columns] > self.maximum
+        self.minimum[lower] = block[low, columns][lower]
+        self.argmin[lower] = self.count + low[lower]
+        self.maximum[higher] = block[high, columns][higher]
+        self.argmax[higher] = self.count + high[higher]
+        self.total += block.sum(axis=0)
+        self.squares += np.einsum('ij,ij->j', block, block)
+        if self.baseline_count < self.baseline_samples:
+            baseline = block[:self.baseline_samples - self.baseline_count]
+            self.baseline_total += baseline.sum(axis=0)
+            self.baseline_squares += np.einsum('ij,ij->j', baseline, baseline)
+            self.baseline_count += len(baseline)
+        self.count += len(block)
+
+    def result(self):
+        """
+        Returns:
+            dict: Per-channel lists: 'min', 'max', 'mean', 'rms',
+            'baseline_mean' and 'baseline_std' (volts), and with a scan
+            rate, 'min_time' and 'max_time' (seconds since the trigger,
+            negative before it) and 'impulse' (integral of the signal above the
+            baseline mean, volt-seconds). Empty when no samples were
+            added.
+
+        """
+        if self.count == 0:
+            return {'min': [], 'max': [], 'mean': []}
+        if self.baseline_count:
+            baseline_mean = self.baseline_total / self.baseline_count
+            baseline_std = np.sqrt(np.maximum(
+                self.baseline_squares / self.baseline_count - baseline_mean ** 2, 0))
+        else:
+            baseline_mean = baseline_std = np.zeros_like(self.total)
+        result = {
+            'min': self.minimum.tolist(),
+            'max': self.maximum.tolist(),
+            'mean': (self.total / self.count).tolist(),
+            'rms': np.sqrt(self.squares / self.count).tolist(),
+            'baseline_mean': baseline_mean.tolist(),
+            'baseline_std': baseline_std.tolist(),
+        }
+        if self.scan_rate:
+            result['min_time'] = ((self.argmin - self.trigger_index)
+                                  / self.scan_rate).tolist()
+            result['max_time'] = ((self.argmax - self.trigger_index)
+                                  / self.scan_rate).tolist()
+            result['impulse'] = ((self.total - self.count * baseline_mean)
+                                 / self.scan_rate).tolist()
+        return result
+
+
+class ArrivalDetector:
+    """
+    Finds the shock arrival on each channel: the first sample whose
+    level (or sample-to-sample slope) departs from the pre-event noise
+    by more than a threshold. The noise floor is measured over the
+    first noise_samples samples; after that each block is tested with
+    one vectorized comparison for the channels that have not fired yet,
+    and nothing is done once every channel has.
+
+    Args:
+        num_channels (int): The number of channels in the scan.
+        scan_rate (float): Actual scan rate (samples/sec/channel).
+        noise_samples (int): Samples at the start of the recording used
+            to measure the noise floor; no arrival is reported in them.
+        threshold (float): Departure from the noise mean, in noise
+            standard deviations.
+        min_volts (float): Smallest departure (volts, or volts per
+            sample for 'slope'), so quantization-quiet channels do not
+            fire on a single code step.
+        mode (str): 'level' or 'slope'.
+        trigger_index (int): Index of the trigger sample in the
+            recording (the header pretrigger_samples), from which the
+            arrival times are measured.
+
+    """
+
+    def __init__(self, num_channels, scan_rate, noise_samples, threshold=6.0,
+                 min_volts=0.0, mode='level', trigger_index=0):
+        if mode not in ('level', 'slope'):
+            raise ValueError('Unknown arrival mode: ' + str(mode))
+        self.scan_rate = scan_rate
+        self.trigger_index = trigger_index
+        self.noise_samples = max(noise_samples, 1)
+        self.threshold = threshold
+        self.min_volts = min_volts
+        self.mode = mode
+        self.count = 0
+        self.previous = None
+        self.noise_count = 0
+        self.noise_total = np.zeros(num_channels)
+        self.noise_squares = np.zeros(num_channels)
+        self.level = None
+        self.limit = None
+        self.arrival = np.full(num_channels, -1, dtype=np.int64)
+
+    def update(self, block):
+        """
+        Adds a block of samples.
+
+        Args:
+            block (numpy.ndarray): Array of shape (n, num_channels).
+
+        Returns:
+            None
+
+        """
+        if len(block) == 0 or (self.arrival >= 0).all():
+            self.count += len(block)
+            return
+        block = np.asarray(block, dtype=np.float64)
+        if self.mode == 'slope':
+            previous = block[:1] if self.previous is None else self.previous
+            self.previous = block[-1:]
+            signal = np.diff(block, axis=0, prepend=previous)
+        else:
+            signal = block
+
+        start = 0
+        if self.level is None:
+            noise = signal[:self.noise_samples - self.noise_count]
+            self.noise_total += noise.sum(axis=0)
+            self.noise_squares += np.einsum('ij,ij->j', noise, noise)
+            self.noise_count += len(noise)
+            start = len(noise)
+            if self.noise_count == self.noise_samples:
+                self.level = self.noise_total / self.noise_count
+                std = np.sqrt(np.maximum(
+                    self.noise_squares / self.noise_count - self.level ** 2, 0))
+                self.limit = np.maximum(self.threshold * std, self.min_volts)
+
+        if self.level is not None and start < len(signal):
+            pending = np.flatnonzero(self.arrival < 0)
+            hit = (np.abs(signal[start:, pending] - self.level[pending])
+                   > self.limit[pending])
+            fired = hit.any(axis=0)
+            self.arrival[pending[fired]] = (self.count + start
+                                            + hit.argmax(axis=0)[fired])
+        self.count += len(block)
+
+    def result(self):
+        """
+        Returns:
+            dict: Per-channel 'arrival_index' (sample of the recording)
+            and 'arrival_time' (seconds since the trigger) lists, None
+            for channels where no arrival was found.
+
+        """
+        index = [int(i) if i >= 0 else None for i in self.arrival]
+        return {
+            'arrival_index': index,
+            'arrival_time': [(i - self.trigger_index) / self.scan_rate
+                             if i is not None else None for i in index],
+        }
+
+
+class TriggerEngine:
+    """
+    Software trigger evaluated on continuous data, one block at a time.
+    A channel is hit where its level departs from its baseline by more
+    than `level` volts, or where it changes by more than `slope` volts
+    from one sample to the next. The trigger fires at the first sample
+    where at least `coincidence` channels have been hit within the last
+    `window` samples (with coincidence 1, at the first hit). Each block
+    costs a few whole-array operations, whatever its length.
+
+    Args:
+        num_channels (int): The number of channels in the scan.
+        level (float): Level threshold (volts from baseline), or None.
+        slope (float): Slope threshold (volts per sample), or None.
+        coincidence (int): Channels that must be hit together.
+        window (int): Samples within which hits count as coincident.
+        channels (list[int]): Columns of the block to watch, by default
+            all of them.
+        baseline_samples (int): Samples at the start used as each
+            channel's baseline level (0 for a baseline of 0 V). The
+            trigger is not armed before they have been seen.
+
+    """
+
+    def __init__(self, num_channels, level=None, slope=None, coincidence=1,
+                 window=1, channels=None, baseline_samples=0):
+        if level is None and slope is None:
+            raise ValueError('Trigger needs a level or a slope threshold')
+        self.channels = np.arange(num_channels) if channels is None \
+            else np.asarray(channels)
+        self.level = level
+        self.slope = slope
+        self.coincidence = min(max(coincidence, 1), len(self.channels))
+        self.window = max(window, 1)
+        self.baseline_samples = baseline_samples
+        self.baseline_total = np.zeros(len(self.channels))
+        self.baseline = np.zeros(len(self.channels))
+        self.count = 0
+        self.previous = None
+        self.last_hit = np.full(len(self.channels), np.iinfo(np.int64).min // 2)
+        self.fired = None
+
+    def update(self, block):
+        """
+        Adds a block of samples and checks the trigger conditions.
+
+        Args:
+            block (numpy.ndarray): Array of shape (n, num_channels).
+
+        Returns:
+            int: Sample index (since the first block) where the trigger
+            fired, or None. Once fired it stays fired and later blocks
+            are not examined.
+
+        """
+        if self.fired is not None or len(block) == 0:
+            self.count += len(block)
+            return None
+        signal = np.asarray(block, dtype=np.float64)[:, self.channels]
+        start = 0
+        if self.count < self.baseline_samples:
+            settle = signal[:self.baseline_samples - self.count]
+            self.baseline_total += settle.sum(axis=0)
+            start = len(settle)
+            if self.count + start == self.baseline_samples:
+                self.baseline = self.baseline_total / self.baseline_samples
+
+        hits = np.zeros(signal.shape, dtype=bool)
+        if self.level is not None:
+            hits |= np.abs(signal - self.baseline) > self.level
+        if self.slope is not None:
+            previous = signal[:1] if self.previous is None else self.previous
+            hits |= np.abs(np.diff(signal, axis=0, prepend=previous)) > self.slope
+        self.previous = signal[-1:]
+        hits[:start] = False
+        index = self.count + np.arange(len(signal))
+
+        if self.coincidence == 1:
+            fire = hits.any(axis=1)
+        else:
+            # Most recent hit of each channel at or before every sample
+            last = np.where(hits, index[:, None], self.last_hit)
+            last = np.maximum.accumulate(np.vstack((self.last_hit, last)))[1:]
+            self.last_hit = last[-1]
+            fire = (last > (index - self.window)[:, None]).sum(axis=1) \
+                >= self.coincidence
+        self.count += len(signal)
+        if fire.any():
+            self.fired = int(index[fire.argmax()])
+        return self.fired
+
+
+def summary_message(summary, channels=None, max_length=200):
+    """
+    Formats a blast summary as a short text for a radio reply: per
+    channel the positive and negative peaks (volts, relative to the
+    baseline mean), the time of the larger one and the impulse.
+
+    Args:
+        summary (dict): Result of BlockSummary.result().
+        channels (list): Channel numbers, in summary order. When None
+            (or not one per summary entry, e.g. a recording cataloged
+            without its channels) the channels are numbered from 0.
+        max_length (int): Longest message, for the radio payload limit.
+
+    Returns:
+        str: e.g. '0:+1.23/-0.456@12.3456s,I+0.00123 7:...'
+
+    """
+    if not summary.get('max'):
+        return 'no data'
+    if channels is None or len(channels) != len(summary['max']):
+        channels = range(len(summary['max']))
+    parts = []
+    for i, channel in enumerate(channels):
+        base = summary['baseline_mean'][i] if 'baseline_mean' in summary else 0.0
+        high = summary['max'][i] - base
+        low = summary['min'][i] - base
+        text = '%s:%+.3g/%+.3g' % (channel, high, low)
+        if 'max_time' in summary:
+            peak = summary['max_time' if high >= -low else 'min_time'][i]
+            text += '@%.4fs,I%+.3g' % (peak, summary['impulse'][i])
+        parts.append(text)
+    return ' '.join(parts)[:max_length]
+
+
+class OverviewPyramid:
+    """
+    Multi-resolution min / max / mean overview of a recording, built
+    while the blocks stream past. Level 0 summarizes every `factor`
+    samples, each higher level summarizes `factor` bins of the level
+    below, up to a top level of roughly top_points bins. A plotting tool
+    can then draw any zoom level by reading only the level whose bins
+    are just finer than the pixels on screen.
+
+    Partial bins are carried from one block to the next, so the result
+    does not depend on how the samples were split into blocks.
+
+    Args:
+        num_channels (int): The number of channels in the scan.
+        samples_per_channel (int): Expected length of the recording,
+            used to choose the number of levels.
+        factor (int): Samples per level 0 bin and bins per higher bin.
+        top_points (int): Approximate bins in the coarsest level.
+
+    """
+
+    def __init__(self, num_channels, samples_per_channel, factor=8,
+                 top_points=2000):
+        self.num_channels = num_channels
+        self.factor = factor
+        num_levels = 1
+        while samples_per_channel // factor ** (num_levels + 1) >= top_points:
+            num_levels += 1
+        # Finished bins of each level, and the carry of partial bins
+        # (min, max, sum, count) waiting for more input
+        self.levels = [[] for i in range(num_levels)]
+        self.carry = [None] * num_levels
+
+    def update(self, block):
+        """
+        Adds a block of samples.
+
+        Args:
+            block (numpy.ndarray): Array of shape (n, num_channels).
+
+        Returns:
+            None
+
+        """
+        if len(block) == 0:
+            return
+        block = np.asarray(block, dtype=np.float64)
+        counts = np.ones(len(block))
+        self._push(0, (block, block, block, counts))
+
+    def _push(self, level, bins):
+        if self.carry[level] is not None:
+            bins = tuple(np.concatenate((c, b)) for c, b in
+                         zip(self.carry[level], bins))
+        whole = len(bins[3]) - len(bins[3]) % self.factor
+        self.carry[level] = None
+        if whole < len(bins[3]):
+            self.carry[level] = tuple(b[whole:] for b in bins)
+        if whole == 0:
+            return
+        reduced = self._reduce(tuple(b[:whole] for b in bins), self.factor)
+        self.levels[level].append(reduced)
+        if level + 1 < len(self.levels):
+            self._push(level + 1, reduced)
+
+    def _reduce(self, bins, size):
+        minimum, maximum, total, counts = bins
+        n = len(counts) // size
+        shape = (n, size, self.num_channels)
+        return (minimum.reshape(shape).min(axis=1),
+                maximum.reshape(shape).max(axis=1),
+                total.reshape(shape).sum(axis=1),
+                counts.reshape(n, size).sum(axis=1))
+
+    def finish(self):
+        """
+        Closes the partial bins at the end of the recording, so the last
+        samples are represented at every level.
+
+        Returns:
+            list[tuple]: Per level, (min, max, mean, count) arrays.
+
+        """
+        for level in range(len(self.levels)):
+            carry = self.carry[level]
+            self.carry[level] = None
+            if carry is None:
+                continue
+            reduced = self._reduce(carry, len(carry[3]))
+            self.levels[level].append(reduced)
+            if level + 1 < len(self.levels):
+                self._push(level + 1, reduced)
+
+        result = []
+        for bins in self.levels:
+            if bins:
+                minimum, maximum, total, counts = (np.concatenate(b)
+                                                   for b in zip(*bins))
+            else:
+                minimum = maximum = total = np.empty((0, self.num_channels))
+                counts = np.empty(0)
+            result.append((minimum, maximum, total / counts[:, None], counts))
+        return result
+
+    def save(self, path, header):
+        """
+        Finishes the pyramid and stores it as a .npz file.
+
+        Args:
+            path (str): Output path (see overview_path).
+            header (dict): Recording header, for scan_rate, channels and
+                pretrigger_samples.
+
+        Returns:
+            None
+
+        """
+        arrays = {}
+        for level, (minimum, maximum, mean, counts) in enumerate(self.finish()):
+            arrays['min%d' % level] = minimum.astype(np.float32)
+            arrays['max%d' % level] = maximum.astype(np.float32)
+            arrays['mean%d' % level] = mean.astype(np.float32)
+        with open(path, 'wb') as f:
+            np.savez(f, factor=self.factor, levels=len(self.levels),
+                     scan_rate=header.get('scan_rate') or 0.0,
+                     pretrigger_samples=header.get('pretrigger_samples') or 0,
+                     channels=np.asarray(header.get('channels') or []),
+                     **arrays)
+
+
+def overview_path(recording_path):
+    """
+    Returns:
+        str: Path of the overview pyramid stored next to a recording.
+
+    """
+    return os.path.splitext(recording_path)[0] + '.overview.npz'
+
+
+def summary_path(recording_path):
+    """
+    Returns:
+        str: Path of the blast summary stored next to a recording whose
+        header cannot hold it: every CSV recording, and a binary one
+        whose header reserve is too small.
+
+    """
+    return os.path.splitext(recording_path)[0] + '.summary.json'
+
+
+def save_summary(path, summary):
+    """
+    Stores a blast summary as JSON (see summary_path).
+
+    Args:
+        path (str): Output path.
+        summary (dict): Result of BlockSummary.result().
+
+    Returns:
+        None
+
+    """
+    with open(path, 'w') as f:
+        json.dump(summary, f, sort_keys=True)
+
+
+def load_summary(recording_path, header=None):
+    """
+    Finds the blast summary of a recording, in its header or else in
+    the file next to it.
+
+    Args:
+        recording_path (str): Path of the recording.
+        header (dict): Header of a binary recording, or None.
+
+    Returns:
+        dict: The summary, or None when the recording has none.
+
+    """
+    if header is not None and header.get('summary') is not None:
+        return header['summary']
+    try:
+        with open(summary_path(recording_path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def load_overview(path, start=None, stop=None, max_points=4000):
+    """
+    Reads the part of an overview pyramid needed to draw [start, stop)
+    with at most max_points bins, using the finest level that fits.
+
+    Args:
+        path (str): Path of the .overview.npz file.
+        start (float): Start of the range (seconds since the trigger,
+            negative for the pre-trigger history), or None for the
+            start of the recording.
+        stop (float): End of the range, or None for the whole recording.
+        max_points (int): Most bins to return.
+
+    Returns:
+        dict: 'time' (bin start, seconds since the trigger), 'min',
+        'max' and 'mean' arrays of shape (n, num_channels), and the
+        'level' used.
+
+    """
+    with np.load(path) as overview:
+        factor = int(overview['factor'])
+        scan_rate = float(overview['scan_rate'])
+        # Overviews saved before pretrigger_samples was stored start at
+        # the trigger
+        offset = (int(overview['pretrigger_samples'])
+                  if 'pretrigger_samples' in overview.files else 0)
+        for level in range(int(overview['levels'])):
+            samples = factor ** (level + 1)
+            bins = len(overview['min%d' % level])
+            first = 0 if start is None else max(
+                0, (int(start * scan_rate) + offset) // samples)
+            last = bins if stop is None else min(
+                bins, -(-(int(stop * scan_rate) + offset) // samples))
+            if last - first <= max_points or level == int(overview['levels']) - 1:
+                break
+        return {
+            'level': level,
+            'time': (np.arange(first, last) * samples - offset) / scan_rate,
+            'min': overview['min%d' % level][first:last],
+            'max': overview['max%d' % level][first:last],
+            'mean': overview['mean%d' % level][first:last],
+        }
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+	Description:
+		 Persistent catalog of the recordings in a DATA directory, kept
+		 in an SQLite database next to the recordings. read_and_display_data
+		 adds each recording when it is finished, so the PING response
+		 and offline tools can count and query recordings without
+		 walking a directory that holds thousands of files.
+
+		 Usage (offline): python3 racs_catalog.py DATA_DIRECTORY
+"""
+
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+from datetime import datetime
+from racs_recording import read_header, read_csv_header, \
+    detect_time_column, recording_extensions, CsvRecordingWriter
+from racs_analysis import load_summary
+
+# File name of the catalog inside the DATA directory
+CATALOG_NAME = 'catalog.sqlite'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS recordings (
+    path TEXT PRIMARY KEY,
+    daq_name TEXT,
+    start_time_ns INTEGER,
+    start_time TEXT,
+    samples INTEGER,
+    scan_rate REAL,
+    channels TEXT,
+    format TEXT,
+    summary TEXT
+)
+'''
+
+# DAQ_X_(mm_dd_YYYY)-(HH-MM-SS).ext, as named by read_and_display_data
+_FILE_NAME = re.compile(r'(?P<daq>.+)_\((?P<date>\d\d_\d\d_\d{4})\)-'
+                        r'\((?P<time>\d\d-\d\d-\d\d)\)')
+
+
+class Catalog:
+    """
+    Catalog of the recordings in one directory. The number of
+    recordings is cached, so count() is O(1) and safe to call from the
+    LoStik reader thread. The catalog is reconciled with the directory
+    when it is opened, and again by refresh() once the directory has
+    changed, so recordings deleted or copied in by hand are counted.
+
+    Args:
+        directory (str): Directory holding the recordings.
+        name (str): File name of the catalog database.
+
+    """
+
+    def __init__(self, directory, name=CATALOG_NAME):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, name)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.db:
+            self.db.execute(_SCHEMA)
+        self._count = self._query_count()
+        self._mtime = None
+        self.reconcile()
+
+    def _query_count(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM recordings').fetchone()[0]
+
+    def count(self):
+        """
+        Returns:
+            int: Number of cataloged recordings.
+
+        """
+        return self._count
+
+    def add(self, path, header, samples, summary=None):
+        """
+        Adds (or replaces) a recording.
+
+        Args:
+            path (str): Path of the recording.
+            header (dict): Recording header (daq_name, trigger_time_ns,
+                trigger_time, scan_rate, channels, format).
+            samples (int): Samples per channel in the recording.
+            summary (dict): Summary statistics of the recording.
+
+        Returns:
+            None
+
+        """
+        row = (
+            os.path.relpath(path, self.directory),
+            header.get('daq_name'),
+            header.get('trigger_time_ns'),
+            header.get('trigger_time'),
+            samples,
+            header.get('scan_rate'),
+            json.dumps(header.get('channels')),
+            header.get('format', 'csv'),
+            json.dumps(summary) if summary is not None else None,
+        )
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO recordings VALUES '
+                            '(?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+        self._count = self._query_count()
+        self._seen()
+
+    def remove(self, path):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM recordings WHERE path = ?',
+                            (os.path.relpath(path, self.directory),))
+        self._count = self._query_count()
+        self._seen()
+
+    def _seen(self):
+        # The directory as it is after the catalog's own change (the
+        # recording and the database journal), so that refresh() only
+        # reconciles after changes made by others
+        self._mtime = os.stat(self.directory).st_mtime_ns
+
+    def query(self, daq_name=None, since_ns=None, until_ns=None):
+        """
+        Lists recordings, oldest first.
+
+        Args:
+            daq_name (str): Only recordings of this DAQ.
+            since_ns (int): Only recordings triggered at or after this
+                time (epoch ns).
+            until_ns (int): Only recordings triggered before this time.
+
+        Returns:
+            list[dict]: One dict per recording, with channels and
+            summary decoded and path made absolute.
+
+        """
+        sql = 'SELECT * FROM recordings WHERE 1'
+        args = []
+        if daq_name is not None:
+            sql += ' AND daq_name = ?'
+            args.append(daq_name)
+        if since_ns is not None:
+            sql += ' AND start_time_ns >= ?'
+            args.append(since_ns)
+        if until_ns is not None:
+            sql += ' AND start_time_ns < ?'
+            args.append(until_ns)
+        sql += ' ORDER BY start_time_ns'
+        with self.lock:
+            rows = [dict(row) for row in self.db.execute(sql, args)]
+        for row in rows:
+            row['path'] = os.path.join(self.directory, row['path'])
+            row['channels'] = json.loads(row['channels'])
+            if row['summary'] is not None:
+                row['summary'] = json.loads(row['summary'])
+        return rows
+
+    def latest(self, daq_name=None):
+        """
+        Returns:
+            dict: The most recently triggered recording (as in query()),
+            or None when the catalog is empty.
+
+        """
+        rows = self.query(daq_name, since_ns=self._latest_time(daq_name))
+        return rows[-1] if rows else None
+
+    def _latest_time(self, daq_name):
+        sql = 'SELECT MAX(start_time_ns) FROM recordings'
+        args = []
+        if daq_name is not None:
+            sql += ' WHERE daq_name = ?'
+            args.append(daq_name)
+        with self.lock:
+            return self.db.execute(sql, args).fetchone()[0]
+
+    def rebuild(self):
+        """
+        Catalogs every recording in the directory that is not cataloged
+        yet. This walks the directory once; afterwards the catalog is
+        kept up to date by add().
+
+        Returns:
+            int: Number of recordings added.
+
+        """
+        with self.lock:
+            known = set(row[0] for row in
+                        self.db.execute('SELECT path FROM recordings'))
+        extensions = tuple(recording_extensions())
+        added = 0
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(extensions) or name in known:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                header, samples = describe_recording(path)
+            except (OSError, ValueError):
+                continue
+            self.add(path, header, samples, load_summary(path, header))
+            added += 1
+        return added
+
+    def reconcile(self):
+        """
+        Brings the catalog in line with the directory: catalogs the
+        recordings that are missing (rebuild) and drops those whose file
+        is gone. This walks the directory once.
+
+        Returns:
+            tuple: (recordings added, recordings removed).
+
+        """
+        added = self.rebuild()
+        with self.lock:
+            known = [row[0] for row in
+                     self.db.execute('SELECT path FROM recordings')]
+        gone = [(path,) for path in known
+                if not os.path.exists(os.path.join(self.directory, path))]
+        if gone:
+            with self.lock, self.db:
+                self.db.executemany('DELETE FROM recordings WHERE path = ?', gone)
+            self._count = self._query_count()
+        # Taken after the walk, as the catalog's own writes (its journal)
+        # modify the directory too
+        self._seen()
+        return added, len(gone)
+
+    def refresh(self):
+        """
+        Reconciles the catalog if the directory was modified since it
+        was last reconciled, e.g. before answering a PING. Otherwise
+        this is one stat() call.
+
+        Returns:
+            bool: True if the catalog was reconciled.
+
+        """
+        if os.stat(self.directory).st_mtime_ns == self._mtime:
+            return False
+        self.reconcile()
+        return True
+
+    def close(self):
+        self.db.close()
+
+
+def describe_recording(path):
+    """
+    Builds catalog fields for a recording that was not cataloged when
+    it was written. Binary recordings describe themselves; for CSV the
+    header stored next to the recording is used, or else the DAQ name
+    and start time come from the file name and the channels from the
+    number of columns (the scan rate is then unknown). The rows are
+    counted.
+
+    Args:
+        path (str): Path of the recording.
+
+    Returns:
+        tuple: (header dict, samples per channel).
+
+    """
+    if not path.endswith(CsvRecordingWriter.extension):
+        header = read_header(path)
+        return header, header['samples_per_channel']
+
+    header = read_csv_header(path) or {'format': 'csv'}
+    match = _FILE_NAME.match(os.path.basename(path))
+    if match and 'trigger_time_ns' not in header:
+        start = datetime.strptime(match.group('date') + ' ' + match.group('time'),
+                                  '%m_%d_%Y %H-%M-%S')
+        header['daq_name'] = match.group('daq')
+        header['trigger_time'] = start.isoformat()
+        header['trigger_time_ns'] = int(start.timestamp()) * 1000000000
+    samples = 0
+    with open(path, 'rb') as f:
+        lines = [f.readline() for i in range(16)]
+        f.seek(0)
+        for piece in iter(lambda: f.read(1024 * 1024), b''):
+            samples += piece.count(b'\n')
+    if 'channels' not in header and lines[0]:
+        # One column per channel, after the time column if there is one
+        skip = 1 if detect_time_column(lines) else 0
+        header['channels'] = list(range(lines[0].count(b',') + 1 - skip))
+    return header, samples
+
+
+def main():
+    directory = sys.argv[1] if len(sys.argv) > 1 else '.'
+    catalog = Catalog(directory)
+    print('%d recordings cataloged' % catalog.count())
+    for row in catalog.query():
+        print('    %-45s %-6s %-26s %10s samples @ %s Hz' % (
+            os.path.basename(row['path']), row['daq_name'], row['start_time'],
+            row['samples'], row['scan_rate']))
+
+
+if __name__ == '__main__':
+    main()
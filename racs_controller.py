@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+	Description:
+		 Long-lived shot controller for the RACS DAQ scripts. One
+		 ShotController runs every shot of a session through an explicit
+		 state machine,
+
+		     idle -> armed -> recording -> finalizing -> armed -> ...
+
+		 calling the script's handler for each step. A shot that is armed
+		 may also be re-armed (aborted and armed again, e.g. when the
+		 recording length changes before the trigger). The HAT, GPIO and
+		 LoStik are opened once in idle and reused by every shot, where
+		 the scripts used to call main() again after each recording,
+		 nesting a stack frame and reopening everything per shot.
+		 soak_controller.py runs the handlers of RACS_DAQA through
+		 thousands of shots on simulated hardware and checks that memory
+		 stays flat.
+"""
+
+IDLE = 'idle'
+ARMED = 'armed'
+RECORDING = 'recording'
+FINALIZING = 'finalizing'
+STOPPED = 'stopped'
+
+# Returned by wait() to abort the armed shot and arm a new one
+REARM = 'rearm'
+
+# States each state may move to. Any state may stop: on shutdown while
+# armed, or when a handler raises.
+TRANSITIONS = {
+    IDLE: (ARMED, STOPPED),
+    ARMED: (ARMED, RECORDING, STOPPED),
+    RECORDING: (FINALIZING, STOPPED),
+    FINALIZING: (ARMED, STOPPED),
+    STOPPED: (),
+}
+
+
+class ShotController:
+    """
+    Runs shots until shutdown. The handlers do the work of each state;
+    whatever one shot needs is returned by arm() and passed to the
+    other shot handlers, so nothing of a finished shot is kept.
+
+    Args:
+        setup (callable): Called once in idle to open the hardware.
+        arm (callable): Prepares one shot (recording file, scan start)
+            and returns its state.
+        wait (callable): wait(shot) blocks until the trigger and returns
+            True, returns False to end the session (shutdown), or
+            returns REARM to abort the shot and arm the next one.
+        record (callable): record(shot) acquires and saves the shot.
+        finalize (callable): finalize(shot) releases what the shot used
+            so the next arm starts clean.
+        abort (callable): abort(shot) releases a shot that was armed
+            but never finalized, when wait() returns False or REARM or a
+            handler raises: it stops the scan and closes or discards the
+            file.
+        teardown (callable): Called once when the session ends, however
+            it ends.
+        on_state (callable): Optional, called with each new state.
+
+    """
+
+    def __init__(self, setup, arm, wait, record, finalize, abort, teardown,
+                 on_state=None):
+        self.setup = setup
+        self.arm = arm
+        self.wait = wait
+        self.record = record
+        self.finalize = finalize
+        self.abort = abort
+        self.teardown = teardown
+        self.on_state = on_state
+        self.state = IDLE
+        self.shots = 0
+
+    def _enter(self, state):
+        if state not in TRANSITIONS[self.state]:
+            raise RuntimeError('Invalid transition %s -> %s' % (self.state, state))
+        self.state = state
+        if self.on_state is not None:
+            self.on_state(state)
+
+    def run(self, max_shots=None):
+        """
+        Runs the session until wait() returns False, max_shots shots
+        are done, or a handler raises (re-raised after teardown).
+
+        Returns:
+            int: Shots completed.
+
+        """
+        shot = None
+        try:
+            self.setup()
+            while max_shots is None or self.shots < max_shots:
+                self._enter(ARMED)
+                shot = self.arm()
+                outcome = self.wait(shot)
+                if outcome == REARM:
+                    # Cleared first so a failing abort is not retried
+                    shot, armed = None, shot
+                    self.abort(armed)
+                    continue
+                if not outcome:
+                    break
+                self._enter(RECORDING)
+                self.record(shot)
+                self._enter(FINALIZING)
+                self.finalize(shot)
+                # Free the finished shot before the next one is armed
+                shot = None
+                self.shots += 1
+        finally:
+            try:
+                if shot is not None:
+                    # Armed (or recording) but not finalized
+                    self.abort(shot)
+            finally:
+                self.state = STOPPED
+                if self.on_state is not None:
+                    self.on_state(STOPPED)
+                self.teardown()
+        return self.shots
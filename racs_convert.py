@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+	Description:
+		 Batch converter for whole DATA directories of RACS recordings.
+		 Converts between CSV and the binary formats (optionally
+		 compressed) and can export decimated copies. Every file is
+		 split into chunks of rows and the chunks of all files are
+		 spread over a process pool, so a day of shots from all DAQs is
+		 converted on every core of the Pi or workstation. The workers
+		 read, decimate, format and compress; the main process only
+		 writes their output in order, with at most --max-pending jobs
+		 submitted ahead of it so memory stays bounded. A time column
+		 found at the start of a CSV source is skipped. A batch whose
+		 outputs would overwrite a source, or each other, is refused
+		 before anything is converted.
+
+		 Usage: python3 racs_convert.py SOURCE DEST --to csv
+		        [--decimate N] [--precision 5] [--time-column seconds]
+		        [--compression zlib] [--scan-rate 50000] [--workers N]
+"""
+
+import argparse
+import collections
+import io
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from racs_recording import read_header, read_rows, recording_extensions, \
+    format_csv_block, time_column, detect_time_column, open_file, \
+    compress_chunk, save_csv_header, TIME_COLUMNS, \
+    RECORDING_FORMATS, RAW_FORMATS, CsvRecordingWriter, \
+    BinaryRecordingWriter, CompressedRecordingWriter, CompressedRecordingReader
+from racs_catalog import describe_recording
+
+# Header fields that describe how a binary recording is stored, rather
+# than what was recorded
+_STORAGE_FIELDS = ('format', 'dtype', 'data_offset', 'samples_per_channel',
+                   'compression', 'delta', 'committed_count')
+_RAW_FIELDS = ('raw', 'calibration', 'lsb', 'min_volts')
+
+
+def decimate(block, factor):
+    """
+    Averages every factor rows of a block (a trailing partial group is
+    averaged on its own).
+
+    Args:
+        block (numpy.ndarray): Array of shape (n, num_channels).
+        factor (int): Rows per output row.
+
+    Returns:
+        numpy.ndarray: float64 array of shape (ceil(n / factor), num_channels).
+
+    """
+    whole = len(block) - len(block) % factor
+    result = block[:whole].reshape(-1, factor, block.shape[1]).mean(axis=1)
+    if whole < len(block):
+        result = np.concatenate((result, block[whole:].mean(axis=0, keepdims=True)))
+    return result
+
+
+def csv_row_offsets(path, rows_per_chunk):
+    """
+    Finds the byte offset of every rows_per_chunk-th row of a CSV file
+    in one streaming pass, so that its chunks can be read independently.
+
+    Returns:
+        tuple: (list of (row, byte offset) chunk starts, total rows,
+        file size).
+
+    """
+    starts = [(0, 0)]
+    rows = 0
+    position = 0
+    with open(path, 'rb') as f:
+        for piece in iter(lambda: f.read(16 * 1024 * 1024), b''):
+            count = piece.count(b'\n')
+            next_row = starts[-1][0] + rows_per_chunk
+            if rows + count >= next_row:
+                ends = np.flatnonzero(np.frombuffer(piece, np.uint8) == 10)
+                while rows + count >= next_row:
+                    starts.append((next_row, position + int(ends[next_row - rows - 1]) + 1))
+                    next_row += rows_per_chunk
+            rows += count
+            position += len(piece)
+    if starts[-1][1] >= position:
+        starts.pop()
+    return starts, rows, position
+
+
+def plan_file(path, args):
+    """
+    Describes the output of one file and splits it into jobs.
+
+    Returns:
+        tuple: (output header, list of job dicts).
+
+    """
+    # Chunks hold whole decimation groups
+    rows_per_chunk = max(args.chunk_rows // args.decimate, 1) * args.decimate
+
+    if path.endswith(CsvRecordingWriter.extension):
+        header = describe_recording(path)[0]
+        with open(path, 'rb') as f:
+            lines = [f.readline() for i in range(16)]
+        # A time column is not a channel; it is regenerated on request
+        skip = 1 if detect_time_column(lines) else 0
+        header['channels'] = list(range(lines[0].count(b',') + 1 - skip))
+        header['scan_rate'] = header.get('scan_rate') or args.scan_rate
+        starts, total, size = csv_row_offsets(path, rows_per_chunk)
+        ranges = starts + [(total, size)]
+        jobs = [{'start': r0, 'stop': r1, 'bytes': (b0, b1)}
+                for (r0, b0), (r1, b1) in zip(ranges[:-1], ranges[1:])]
+        source = {'source': 'csv', 'skip_columns': skip}
+    else:
+        header = read_header(path)
+        if header['format'] == 'compressed':
+            header = CompressedRecordingReader(path).header
+        total = header['samples_per_channel']
+        jobs = [{'start': r, 'stop': min(r + rows_per_chunk, total)}
+                for r in range(0, total, rows_per_chunk)]
+        source = {'source': 'binary', 'header': header}
+
+    raw = header.get('raw', False) and args.to in RAW_FORMATS
+    if args.to in RAW_FORMATS and not raw:
+        raise ValueError('int16 output needs a raw (int16) source recording')
+    if raw and args.decimate > 1:
+        raise ValueError('raw codes cannot be decimated, choose a float format')
+
+    out = {k: v for k, v in header.items() if k not in _STORAGE_FIELDS}
+    if not raw:
+        out = {k: v for k, v in out.items() if k not in _RAW_FIELDS}
+    if args.decimate > 1:
+        out['decimation'] = out.get('decimation', 1) * args.decimate
+        if out.get('scan_rate'):
+            out['scan_rate'] = out['scan_rate'] / args.decimate
+        if out.get('pretrigger_samples'):
+            out['pretrigger_samples'] = out['pretrigger_samples'] // args.decimate
+
+    for job in jobs:
+        job.update(source, path=path, to=args.to, raw=raw,
+                   decimate=args.decimate, precision=args.precision,
+                   time_column=args.time_column,
+                   compression=args.compression,
+                   chunk_samples=args.chunk_samples,
+                   scan_rate=out.get('scan_rate'),
+                   trigger_time_ns=out.get('trigger_time_ns') or 0,
+                   pretrigger_samples=out.get('pretrigger_samples', 0))
+    return out, jobs
+
+
+def convert_job(job):
+    """
+    Converts one chunk of rows. Runs in a worker process.
+
+    Returns:
+        bytes (CSV or binary frames) or a list of (rows, payload)
+        compressed chunks.
+
+    """
+    if job['source'] == 'csv':
+        start, stop = job['bytes']
+        with open(job['path'], 'rb') as f:
+            f.seek(start)
+            text = f.read(stop - start)
+        data = np.loadtxt(io.BytesIO(text), delimiter=',', ndmin=2)
+        data = data[:, job['skip_columns']:]
+    else:
+        data = read_rows(job['path'], job['start'], job['stop'],
+                         raw=job['raw'], header=job['header'])
+
+    if job['decimate'] > 1:
+        data = decimate(data, job['decimate'])
+
+    if job['to'] == 'csv':
+        times = None
+        if job['time_column']:
+            times = time_column(job['start'] // job['decimate']
+                                - job['pretrigger_samples'], len(data),
+                                job['scan_rate'], job['time_column'],
+                                job['trigger_time_ns'])
+        return format_csv_block(data, job['precision'], times=times,
+                                time_format=TIME_COLUMNS.get(job['time_column']))
+
+    data = np.ascontiguousarray(data, RECORDING_FORMATS[job['to']][1]['dtype'])
+    if job['compression']:
+        size = job['chunk_samples']
+        return [compress_chunk(data[i:i + size], job['compression'])
+                for i in range(0, len(data), size)]
+    return data.tobytes()
+
+
+def output_path(path, args):
+    """
+    Returns:
+        str: Path of the converted copy of path in args.dest.
+
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if args.to == 'csv':
+        extension = CsvRecordingWriter.extension
+    elif args.compression:
+        extension = CompressedRecordingWriter.extension
+    else:
+        extension = BinaryRecordingWriter.extension
+    return os.path.join(args.dest, stem + extension)
+
+
+def check_outputs(paths, args):
+    """
+    Finds conversions that would overwrite a source or another output,
+    e.g. converting a directory into itself, or foo.racs and foo.racz
+    that would both become foo.csv.
+
+    Returns:
+        str: Description of the first collision, or None.
+
+    """
+    sources = set(os.path.realpath(path) for path in paths)
+    outputs = {}
+    for path in paths:
+        out_path = output_path(path, args)
+        real = os.path.realpath(out_path)
+        if real in sources:
+            return '%s would overwrite a source recording' % out_path
+        if real in outputs:
+            return '%s and %s would both be converted to %s' % (
+                outputs[real], path, out_path)
+        outputs[real] = path
+    return None
+
+
+def open_output(path_base, header, args):
+    """
+    Returns:
+        tuple: (writer or file, output path) for the converted file.
+
+    """
+    if args.to == 'csv':
+        path = path_base + CsvRecordingWriter.extension
+        return open_file(path, block_size=args.block_size), path
+    dtype = RECORDING_FORMATS[args.to][1]['dtype']
+    if args.compression:
+        writer = CompressedRecordingWriter(
+            path_base + CompressedRecordingWriter.extension, header, dtype,
+            args.compression, workers=0, block_size=args.block_size)
+    else:
+        writer = BinaryRecordingWriter(
+            path_base + BinaryRecordingWriter.extension, header, dtype,
+            block_size=args.block_size)
+    return writer, writer.path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('source', help='directory (or file) of recordings')
+    parser.add_argument('dest', help='output directory')
+    parser.add_argument('--to', required=True, choices=sorted(RECORDING_FORMATS),
+                        help='output format')
+    parser.add_argument('--compression', choices=['zlib', 'lzma'],
+                        help='compress binary output')
+    parser.add_argument('--decimate', type=int, default=1,
+                        help='average every N samples')
+    parser.add_argument('--precision', type=int, default=5,
+                        help='CSV decimals')
+    parser.add_argument('--time-column', choices=sorted(TIME_COLUMNS),
+                        help='add a time column to CSV output')
+    parser.add_argument('--scan-rate', type=float,
+                        help='scan rate of CSV sources (samples/sec/channel)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='worker processes')
+    parser.add_argument('--chunk-rows', type=int, default=500000,
+                        help='rows per job')
+    parser.add_argument('--max-pending', type=int,
+                        help='jobs submitted ahead of the writer '
+                             '(default: 2 per worker)')
+    parser.add_argument('--chunk-samples', type=int, default=65536,
+                        help='rows per compressed chunk')
+    parser.add_argument('--block-size', type=int, default=1024 * 1024,
+                        help='output write block size (bytes)')
+    args = parser.parse_args()
+    if args.compression and args.to == 'csv':
+        parser.error('--compression needs a binary output format')
+    if args.time_column and args.to != 'csv':
+        parser.error('--time-column only applies to CSV output')
+
+    if os.path.isdir(args.source):
+        extensions = tuple(recording_extensions())
+        paths = [os.path.join(args.source, name)
+                 for name in sorted(os.listdir(args.source))
+                 if name.endswith(extensions)]
+    else:
+        paths = [args.source]
+    if any(path.endswith(CsvRecordingWriter.extension) for path in paths) \
+            and (args.to != 'csv' or args.time_column or args.decimate > 1) \
+            and not args.scan_rate:
+        parser.error('CSV sources carry no scan rate, pass --scan-rate')
+    # Checked before any job runs, as outputs are written in place
+    collision = check_outputs(paths, args)
+    if collision:
+        parser.error(collision)
+    os.makedirs(args.dest, exist_ok=True)
+
+    plans = []
+    for path in paths:
+        try:
+            plans.append((path,) + plan_file(path, args))
+        except (OSError, ValueError) as err:
+            print('    skipped %s: %s' % (os.path.basename(path), err))
+
+    # Jobs are submitted only max_pending ahead of the one being written,
+    # so the results of a large batch are not all held in memory at once
+    jobs = (job for plan in plans for job in plan[2])
+    max_pending = args.max_pending or 2 * args.workers
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        pending = collections.deque()
+
+        def next_result():
+            while len(pending) < max_pending:
+                job = next(jobs, None)
+                if job is None:
+                    break
+                pending.append(pool.submit(convert_job, job))
+            return pending.popleft().result()
+
+        for path, header, file_jobs in plans:
+            stem = os.path.splitext(os.path.basename(path))[0]
+            output, out_path = open_output(os.path.join(args.dest, stem),
+                                           header, args)
+            rows = 0
+            for job in file_jobs:
+                result = next_result()
+                rows += job['stop'] - job['start']
+                if args.to == 'csv':
+                    output.write(result)
+                elif args.compression:
+                    for chunk in result:
+                        output.write_chunk(*chunk)
+                else:
+                    output.write(np.frombuffer(result, output.dtype)
+                                 .reshape(-1, len(header['channels'])))
+            output.close()
+            # A CSV output gets a stored header unless its trigger time
+            # is only known from the file name of a CSV source
+            from_name = path.endswith(CsvRecordingWriter.extension) \
+                and 'pretrigger_samples' not in header
+            if args.to == 'csv' and not from_name:
+                save_csv_header(out_path, dict(header,
+                                               time_column=args.time_column))
+            print('    %s -> %s (%d rows)' % (os.path.basename(path),
+                                              os.path.basename(out_path),
+                                              -(-rows // args.decimate)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+	Description:
+		 Merges the recordings of one shot from several DAQs (DAQ_A to
+		 DAQ_F) into a single multi-node recording on a common time
+		 base. Each recording is placed by the trigger time stamped in
+		 its header (for CSV, the header stored next to it; a CSV
+		 recording without one is refused, as its file name only gives
+		 the second) and sampled at the output rate, either at the nearest
+		 sample or by linear resampling, which also corrects a known
+		 per-node clock drift. Samples outside a node's recording are
+		 NaN.
+
+		 The merge streams: the output is produced one window at a time
+		 and each input is read forward just far enough to cover it, so
+		 memory stays at a few windows whatever the length of the shot.
+
+		 Usage: python3 racs_merge.py OUTPUT_DIR RECORDING [RECORDING ...]
+		        [--rate 50000] [--resample] [--drift DAQ_B=12.5]
+		        [--format float32] [--scan-rate 50000 (CSV inputs)]
+"""
+
+import argparse
+import math
+import os
+from datetime import datetime
+import numpy as np
+from racs_recording import read_header, read_rows, open_recording, \
+    codes_to_volts, detect_time_column, CsvRecordingWriter, \
+    CompressedRecordingReader, RECORDING_FORMATS, TIME_COLUMNS
+from racs_catalog import describe_recording
+
+
+class RecordingStream:
+    """
+    Forward-only row reader over one recording. Binary recordings are
+    read directly at the requested rows; CSV recordings are parsed in
+    pieces and only the rows still needed are kept.
+
+    Args:
+        path (str): Path of the recording.
+        scan_rate (float): Scan rate of a CSV recording without a
+            stored header. Ignored for binary recordings.
+        csv_rows (int): Approximate rows parsed per CSV read.
+
+    """
+
+    def __init__(self, path, scan_rate=None, csv_rows=65536):
+        self.path = path
+        self.csv = path.endswith(CsvRecordingWriter.extension)
+        if self.csv:
+            self.header, self.total = describe_recording(path)
+            self.file = open(path, 'rb')
+            lines = [self.file.readline() for i in range(16)]
+            first = lines[0]
+            self.file.seek(0)
+            # A time column is not a channel
+            self.skip_columns = 1 if detect_time_column(lines) else 0
+            if not self.header.get('scan_rate'):
+                self.header['scan_rate'] = scan_rate
+            self.read_size = max(len(first), 1) * csv_rows
+            self.reader = None
+        else:
+            self.header = read_header(path)
+            self.reader = None
+            if self.header['format'] == 'compressed':
+                self.reader = CompressedRecordingReader(path)
+                self.header = self.reader.header
+            self.total = self.header['samples_per_channel']
+        self.num_channels = len(self.header['channels'])
+        self.buffer = np.empty((0, self.num_channels))
+        self.buffer_start = 0
+
+    def rows(self, start, stop):
+        """
+        Reads rows [start, stop), clipped to the recording. start must
+        not decrease between calls on a CSV recording.
+
+        Returns:
+            numpy.ndarray: float64 array of shape (n, num_channels).
+
+        """
+        start = max(start, 0)
+        stop = min(stop, self.total)
+        if stop <= start:
+            return np.empty((0, self.num_channels))
+        if not self.csv:
+            if self.reader is not None:
+                data = self.reader.read(start, stop)
+                if self.header.get('raw'):
+                    data = codes_to_volts(data, self.header)
+                return np.asarray(data, dtype=np.float64)
+            return np.asarray(read_rows(self.path, start, stop,
+                                        header=self.header), dtype=np.float64)
+
+        while True:
+            drop = min(start - self.buffer_start, len(self.buffer))
+            self.buffer = self.buffer[drop:]
+            self.buffer_start += drop
+            if self.buffer_start + len(self.buffer) >= stop:
+                break
+            lines = self.file.readlines(self.read_size)
+            if not lines:
+                break
+            piece = np.loadtxt(lines, delimiter=',', ndmin=2)[:, self.skip_columns:]
+            self.buffer = np.concatenate((self.buffer, piece))
+        return self.buffer[:stop - self.buffer_start]
+
+    def close(self):
+        if self.csv:
+            self.file.close()
+
+
+class MergeNode:
+    """
+    One input of a merge and where it sits on the common time base.
+
+    Args:
+        stream (RecordingStream): The recording.
+        offset (float): Start of the recording relative to the merge
+            start (seconds).
+        drift_ppm (float): Clock error of the node; positive when its
+            clock runs fast, so it really sampled faster than scan_rate.
+
+    """
+
+    def __init__(self, stream, offset, drift_ppm=0.0):
+        self.stream = stream
+        self.offset = offset
+        self.drift_ppm = drift_ppm
+        self.rate = stream.header['scan_rate'] * (1.0 + drift_ppm * 1e-6)
+
+    @property
+    def duration(self):
+        return self.stream.total / self.rate
+
+    def sample(self, times, resample):
+        """
+        Samples the node at the given merge times.
+
+        Args:
+            times (numpy.ndarray): Increasing times since the merge
+                start (seconds).
+            resample (bool): Interpolate linearly between samples
+                instead of taking the nearest one.
+
+        Returns:
+            numpy.ndarray: Array of shape (len(times), num_channels),
+            NaN outside the recording.
+
+        """
+        total = self.stream.total
+        position = (times - self.offset) * self.rate
+        result = np.full((len(times), self.stream.num_channels), np.nan)
+        if resample:
+            valid = (position >= 0) & (position <= total - 1)
+        else:
+            position = np.rint(position)
+            valid = (position >= 0) & (position < total)
+        if not valid.any():
+            return result
+        position = position[valid]
+        first = int(position[0])
+        data = self.stream.rows(first, int(position[-1]) + 2)
+        if not resample:
+            result[valid] = data[position.astype(np.int64) - first]
+            return result
+        below = np.floor(position)
+        fraction = (position - below)[:, None]
+        index = below.astype(np.int64) - first
+        above = np.minimum(index + 1, len(data) - 1)
+        result[valid] = data[index] * (1.0 - fraction) + data[above] * fraction
+        return result
+
+
+def plan_merge(streams, rate=None, drift=None):
+    """
+    Places recordings on a common time base starting at the earliest
+    first sample (the trigger, or before it with pre-trigger history).
+
+    Args:
+        streams (list[RecordingStream]): The recordings of one shot.
+        rate (float): Output scan rate, by default the highest input rate.
+        drift (dict): Clock drift (ppm) by DAQ name.
+
+    Returns:
+        tuple: (list of MergeNode, start time (epoch ns), output rate,
+        output samples per channel).
+
+    """
+    drift = drift or {}
+    for stream in streams:
+        # Only a stored header says exactly when a CSV recording starts
+        if stream.csv and 'pretrigger_samples' not in stream.header:
+            raise ValueError(stream.path + ': no stored header, the trigger '
+                             'time of a CSV recording is only known to the '
+                             'second')
+        if not stream.header.get('scan_rate'):
+            raise ValueError(stream.path + ': scan rate unknown, pass --scan-rate')
+        if stream.header.get('trigger_time_ns') is None:
+            raise ValueError(stream.path + ': no trigger time')
+    # Recordings with pre-trigger history start before their trigger
+    first_ns = [s.header['trigger_time_ns'] - int(round(
+        s.header.get('pretrigger_samples', 0) * 1e9 / s.header['scan_rate']))
+        for s in streams]
+    start_ns = min(first_ns)
+    nodes = [MergeNode(s, (first - start_ns) / 1e9,
+                       drift.get(s.header.get('daq_name'), 0.0))
+             for s, first in zip(streams, first_ns)]
+    rate = rate or max(s.header['scan_rate'] for s in streams)
+    samples = int(math.ceil(max(n.offset + n.duration for n in nodes) * rate))
+    return nodes, start_ns, rate, samples
+
+
+def merge(nodes, rate, samples, writer, resample=False, window=65536):
+    """
+    Streams the merged samples into a recording writer, one window of
+    output rows at a time.
+
+    Returns:
+        int: Samples per channel written.
+
+    """
+    for start in range(0, samples, window):
+        times = np.arange(start, min(start + window, samples)) / rate
+        writer.write(np.hstack([node.sample(times, resample) for node in nodes]))
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('output', help='output directory')
+    parser.add_argument('recordings', nargs='+', help='recordings of one shot')
+    parser.add_argument('--rate', type=float,
+                        help='output scan rate (default: highest input rate)')
+    parser.add_argument('--resample', action='store_true',
+                        help='interpolate linearly instead of taking the '
+                             'nearest sample')
+    parser.add_argument('--drift', action='append', default=[],
+                        metavar='DAQ=PPM',
+                        help='clock drift of a node in ppm (fast is positive)')
+    parser.add_argument('--format', default='float32',
+                        choices=[f for f in RECORDING_FORMATS if f != 'int16'],
+                        help='output format')
+    parser.add_argument('--compression', choices=['zlib', 'lzma'],
+                        help='compress binary output')
+    parser.add_argument('--time-column', choices=sorted(TIME_COLUMNS),
+                        help='add a time column to CSV output')
+    parser.add_argument('--scan-rate', type=float,
+                        help='scan rate of CSV inputs (samples/sec/channel)')
+    parser.add_argument('--window', type=int, default=65536,
+                        help='output rows per merge step')
+    args = parser.parse_args()
+
+    drift = {}
+    for item in args.drift:
+        name, _, ppm = item.partition('=')
+        drift[name] = float(ppm)
+    if args.drift and not args.resample:
+        print('    note: drift is only corrected to the nearest sample '
+              'without --resample')
+
+    streams = [RecordingStream(path, args.scan_rate) for path in args.recordings]
+    nodes, start_ns, rate, samples = plan_merge(streams, args.rate, drift)
+    for node in nodes:
+        header = node.stream.header
+        print('    %-6s %+10.6f s  %8d samples @ %s Hz' % (
+            header.get('daq_name'), node.offset, node.stream.total,
+            header['scan_rate']))
+
+    start = datetime.fromtimestamp(start_ns / 1e9)
+    header = {
+        'daq_name': 'MERGED',
+        'channels': ['%s:%s' % (n.stream.header.get('daq_name'), c)
+                     for n in nodes for c in n.stream.header['channels']],
+        'scan_rate': rate,
+        'samples_requested': samples,
+        'trigger_time_ns': start_ns,
+        'trigger_time': start.isoformat(),
+        'resampled': args.resample,
+        'nodes': [{
+            'daq_name': n.stream.header.get('daq_name'),
+            'path': os.path.basename(n.stream.path),
+            'channels': n.stream.header['channels'],
+            'scan_rate': n.stream.header['scan_rate'],
+            'trigger_time_ns': n.stream.header['trigger_time_ns'],
+            'offset': n.offset,
+            'drift_ppm': n.drift_ppm,
+        } for n in nodes],
+    }
+    options = {}
+    if args.format == 'csv':
+        options = {'precision': 5, 'time_column': args.time_column}
+    os.makedirs(args.output, exist_ok=True)
+    path_base = os.path.join(args.output, start.strftime(
+        'MERGED_(%m_%d_%Y)-(%H-%M-%S)'))
+    writer = open_recording(path_base, args.format, header, args.compression,
+                            block_size=1024 * 1024, **options)
+    merge(nodes, rate, samples, writer, args.resample, args.window)
+    writer.close()
+    for stream in streams:
+        stream.close()
+    print('    %d nodes, %d channels, %d samples @ %s Hz -> %s' % (
+        len(nodes), len(header['channels']), samples, rate,
+        os.path.basename(writer.path)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+	Description:
+		 Scan-rate planner for arbitrary channel sets. Given the channels
+		 of each MCC118, the minimum rate each channel needs, the
+		 recording format and the write bandwidth of the card, it picks
+		 the highest scan rate the boards can actually produce
+		 (a_in_scan_actual_rate) that the disk and the CPU can keep up
+		 with. A configuration that would overrun is downgraded to a
+		 lower rate, or refused when no rate satisfies every channel.
+		 main() runs it at startup; plan_scan() is the library call.
+
+		 The write bandwidth is measured once per card and cached in the
+		 recording directory (BANDWIDTH_CACHE), rather than writing a
+		 16 MB test file every time a DAQ starts. Running this script
+		 measures it again and refreshes the cache.
+
+		 Usage (offline): python3 racs_planner.py DATA_DIRECTORY
+		        --channels 2 [--rate 50000] [--format csv] [--min-rate 20000]
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+import numpy as np
+from racs_recording import estimate_recording_size, open_recording, \
+    open_file, raw_header, RECORDING_FORMATS, RAW_FORMATS
+
+# Combined sample rate of one MCC118 (samples/sec over all its channels)
+MCC118_MAX_RATE = 100000.0
+
+# File in the recording directory holding the measured write bandwidth
+BANDWIDTH_CACHE = 'racs_planner.json'
+
+
+class PlanError(ValueError):
+    """
+    No scan rate satisfies the channel, disk and CPU requirements.
+    """
+
+
+class ScanPlan:
+    """
+    Outcome of plan_scan().
+
+    Attributes:
+        scan_rate (float): Rate to request from a_in_scan_start.
+        actual_scan_rate (float): Rate the boards will run at.
+        bytes_per_second (float): Recording growth at that rate.
+        cpu_load (float): Fraction of one core spent encoding, or None
+            when not measured.
+        downgraded (bool): The rate is lower than requested.
+        notes (list[str]): Why the rate was chosen.
+
+    """
+
+    def __init__(self, scan_rate, actual_scan_rate, bytes_per_second,
+                 cpu_load, downgraded, notes):
+        self.scan_rate = scan_rate
+        self.actual_scan_rate = actual_scan_rate
+        self.bytes_per_second = bytes_per_second
+        self.cpu_load = cpu_load
+        self.downgraded = downgraded
+        self.notes = notes
+
+
+def bytes_per_row(recording_format, num_channels, compression=None,
+                  precision=None, time_column=None):
+    """
+    Returns:
+        float: Upper bound on the bytes a recording grows by per scan.
+
+    """
+    rows = 100000
+    return (estimate_recording_size(recording_format, rows, num_channels,
+                                    compression, precision, time_column)
+            - estimate_recording_size(recording_format, 0, num_channels,
+                                      compression, precision, time_column)) / rows
+
+
+def measure_encode_cost(recording_format, num_channels, compression=None,
+                        precision=5, rows=20000, time_column=None,
+                        analyse=None, block_rows=2000):
+    """
+    Times the work a shot does per block on this machine: the recording
+    writer itself (csv.writer when precision is None, format_csv_block
+    otherwise, the time column, or the binary conversion and optional
+    compression), writing a scratch file, followed by the analysis the
+    DAQ runs on every block.
+
+    Args:
+        recording_format (str): One of the RECORDING_FORMATS keys.
+        num_channels (int): The number of channels in the scan.
+        compression, precision, time_column: Recording options.
+        rows (int): Scans timed.
+        analyse (callable): Called as analyse(block, header) with every
+            block after it is written, as the DAQ does (codes_to_volts,
+            summary, pyramid, arrival detector), or None.
+        block_rows (int): Scans per block.
+
+    Returns:
+        float: CPU seconds per scan (row).
+
+    """
+    header = {'channels': list(range(num_channels)), 'scan_rate': 1000.0,
+              'trigger_time_ns': 0}
+    if recording_format in RAW_FORMATS:
+        header.update(raw_header([(1.0, 0.0)] * num_channels))
+        block = np.random.randint(0, 4096, (rows, num_channels)).astype(np.int16)
+    else:
+        block = np.random.uniform(-10, 10, (rows, num_channels))
+    options = {}
+    if recording_format == 'csv':
+        options = {'precision': precision, 'time_column': time_column}
+    elif compression:
+        # Compressed here rather than on the pool, to count its cost
+        options = {'workers': 0}
+    with tempfile.TemporaryDirectory() as directory:
+        writer = open_recording(os.path.join(directory, 'encode'),
+                                recording_format, header, compression,
+                                **options)
+        start = time.process_time()
+        for i in range(0, rows, block_rows):
+            writer.write(block[i:i + block_rows])
+            if analyse is not None:
+                analyse(block[i:i + block_rows], writer.header)
+        writer.close()
+        cost = time.process_time() - start
+    return cost / rows
+
+
+def measure_write_bandwidth(directory, size_mb=16, block_size=1024 * 1024):
+    """
+    Writes and syncs a test file in the recording directory.
+
+    Returns:
+        float: Sustained write bandwidth (bytes/sec).
+
+    """
+    path = os.path.join(directory, 'racs_planner.tmp')
+    data = os.urandom(block_size)
+    total = int(size_mb * 1024 * 1024)
+    start = time.perf_counter()
+    f = open_file(path, block_size=block_size)
+    try:
+        for i in range(0, total, block_size):
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+        os.remove(path)
+    return total / (time.perf_counter() - start)
+
+
+def cached_write_bandwidth(directory, max_age_days=30.0):
+    """
+    Returns the write bandwidth of the card holding directory, from
+    BANDWIDTH_CACHE when it was measured on the same filesystem less
+    than max_age_days ago, or else measured now and cached.
+
+    Args:
+        directory (str): Recording directory.
+        max_age_days (float): Age after which the card is measured again.
+
+    Returns:
+        tuple: (bandwidth in bytes/sec, True if it was measured now).
+
+    """
+    path = os.path.join(directory, BANDWIDTH_CACHE)
+    device = os.stat(directory).st_dev
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+        if cached['device'] == device and \
+                time.time() - cached['measured'] < max_age_days * 86400:
+            return float(cached['write_bandwidth']), False
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return save_write_bandwidth(directory, measure_write_bandwidth(directory)), True
+
+
+def save_write_bandwidth(directory, bandwidth):
+    """
+    Stores a measured write bandwidth in BANDWIDTH_CACHE.
+
+    Returns:
+        float: bandwidth.
+
+    """
+    with open(os.path.join(directory, BANDWIDTH_CACHE), 'w') as f:
+        json.dump({'write_bandwidth': bandwidth, 'measured': time.time(),
+                   'device': os.stat(directory).st_dev}, f)
+    return bandwidth
+
+
+def plan_scan(board_channels, recording_format, write_bandwidth,
+              actual_rate=None, requested_rate=None, min_rates=None,
+              compression=None, precision=5, time_column=None,
+              encode_cost=None, disk_budget=0.5, cpu_budget=0.5,
+              downgrade=True):
+    """
+    Picks the scan rate for a set of channels.
+
+    Args:
+        board_channels (list[int]): Channels scanned on each board.
+        recording_format (str): One of the RECORDING_FORMATS keys.
+        write_bandwidth (float): Measured write bandwidth (bytes/sec).
+        actual_rate (callable): Maps a requested rate to the rate the
+            boards will run at, e.g.
+            lambda rate: hat.a_in_scan_actual_rate(num_channels, rate).
+        requested_rate (float): Desired rate, by default the fastest the
+            boards allow.
+        min_rates (dict): Minimum rate per channel; the scan rate is
+            shared, so the highest one applies.
+        compression, precision, time_column: Recording options.
+        encode_cost (float): CPU seconds per scan from
+            measure_encode_cost(), or None to skip the CPU check.
+        disk_budget (float): Share of write_bandwidth the recording may
+            use, leaving room for write stalls.
+        cpu_budget (float): Share of one core the encoding may use.
+        downgrade (bool): Lower the rate to fit, instead of refusing.
+
+    Returns:
+        ScanPlan
+
+    Raises:
+        PlanError: The configuration cannot be recorded without overrun.
+
+    """
+    if actual_rate is None:
+        actual_rate = lambda rate: rate
+    num_channels = sum(board_channels)
+    required = max((min_rates or {}).values(), default=0.0)
+    notes = []
+
+    # Every board shares the scan clock, the busiest one sets the limit
+    limit = MCC118_MAX_RATE / max(board_channels)
+    limits = [(limit, 'the MCC118 limit of %.0f S/s per board' % MCC118_MAX_RATE)]
+    row_bytes = bytes_per_row(recording_format, num_channels, compression,
+                              precision, time_column)
+    limits.append((write_bandwidth * disk_budget / row_bytes,
+                   '%.0f%% of the %.2f MB/s write bandwidth'
+                   % (disk_budget * 100, write_bandwidth / 1e6)))
+    if encode_cost:
+        limits.append((cpu_budget / encode_cost,
+                       '%.0f%% of a core for %s encoding'
+                       % (cpu_budget * 100, recording_format)))
+    ceiling, reason = min(limits)
+
+    rate = requested_rate or limit
+    downgraded = False
+    if rate > ceiling:
+        message = '%.0f S/s/channel exceeds %s (%.0f S/s/channel)' % (
+            rate, reason, ceiling)
+        if not downgrade:
+            raise PlanError(message)
+        notes.append(message + ', rate lowered')
+        rate = ceiling
+        downgraded = True
+    if rate < required:
+        raise PlanError('Channels need %.0f S/s/channel but %s allows %.0f'
+                        % (required, reason, ceiling))
+
+    # The clock divisor may round up, step down until it fits
+    actual = actual_rate(rate)
+    while actual > ceiling * 1.000001 and rate > 1:
+        rate *= 0.99
+        actual = actual_rate(rate)
+    if actual < required:
+        raise PlanError('Achievable rate %.1f S/s/channel is below the required %.0f'
+                        % (actual, required))
+    return ScanPlan(rate, actual, actual * row_bytes,
+                    actual * encode_cost if encode_cost else None,
+                    downgraded, notes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('directory', help='recording directory to measure')
+    parser.add_argument('--channels', default='2',
+                        help='channels per board, comma separated')
+    parser.add_argument('--rate', type=float, help='requested scan rate')
+    parser.add_argument('--min-rate', type=float, default=0.0,
+                        help='minimum rate every channel needs')
+    parser.add_argument('--format', default='csv',
+                        choices=sorted(RECORDING_FORMATS))
+    parser.add_argument('--compression', choices=['zlib', 'lzma'])
+    args = parser.parse_args()
+
+    boards = [int(n) for n in args.channels.split(',')]
+    bandwidth = save_write_bandwidth(args.directory,
+                                     measure_write_bandwidth(args.directory))
+    cost = measure_encode_cost(args.format, sum(boards), args.compression)
+    print('    write bandwidth %.2f MB/s, encoding %.2f us/scan'
+          % (bandwidth / 1e6, cost * 1e6))
+    try:
+        plan = plan_scan(boards, args.format, bandwidth,
+                         requested_rate=args.rate,
+                         min_rates={'all': args.min_rate},
+                         compression=args.compression, encode_cost=cost)
+    except PlanError as err:
+        print('    refused: %s' % err)
+        return
+    for note in plan.notes:
+        print('    ' + note)
+    print('    scan rate %.1f S/s/channel, %.2f MB/s, %.0f%% CPU' % (
+        plan.actual_scan_rate, plan.bytes_per_second / 1e6,
+        plan.cpu_load * 100))
+
+
+if __name__ == '__main__':
+    main()
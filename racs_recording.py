@@ -0,0 +1,1401 @@
+#!/usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+	Description:
+		 Recording file formats shared by the RACS_DAQ scripts and the
+		 offline tools. A recording is written block by block through
+		 one of the writers below and can be read back into NumPy arrays
+		 with read_recording().
+
+		 Formats:
+		 	csv     - one row per scan, one column per channel (original),
+		 	          optionally at a fixed precision for speed and size
+		 	          and with a leading time column; the header is
+		 	          kept next to it in a .header.json file
+		 	float32 - self-describing binary file, float32 frames
+		 	float64 - self-describing binary file, float64 frames
+		 	int16   - self-describing binary file of raw 12-bit ADC
+		 	          codes; the calibration coefficients and scaling
+		 	          needed to rebuild volts are kept in the header
+
+		 Any binary format can also be written compressed (.racz):
+		 samples are delta encoded per channel and compressed with zlib
+		 or lzma in independent chunks on a process pool, so the
+		 compression never runs on the acquisition thread.
+
+		 Every format can be written durably: the file is created under a
+		 temporary '.part' name, fsynced in batches and renamed when
+		 complete. recover_recording() salvages the valid prefix of a
+		 '.part' file left behind by a power loss.
+
+		 Output can be gathered into large blocks that are written with a
+		 single os.write at block-aligned file offsets (BlockBufferedWriter),
+		 matching the erase blocks of the SD card.
+
+		 Recordings can be created before the trigger, with their full
+		 expected size reserved up front (see estimate_recording_size);
+		 set_trigger() then stamps the trigger time and final name, and
+		 the file is cut back to its actual length when closed.
+
+		 Binary layout (little endian):
+		 	preamble  magic 'RACS', version (uint16), header length
+		 	          (uint32), samples per channel (uint64)
+		 	          (the count committed at the last sync or commit
+		 	          while a header with committed_count is being
+		 	          written)
+		 	header    UTF-8 JSON, space padded so that the frames start
+		 	          on a HEADER_ALIGN byte boundary
+		 	frames    samples_per_channel rows of num_channels values
+
+		 Compressed layout: the same preamble and header, followed by
+		 	chunks    magic 'RCHK', rows (uint32), length (uint32) and the
+		 	          compressed channel-planar deltas of those rows
+		 	index     (offset uint64, rows uint32) for every chunk
+		 	footer    magic 'RIDX', index offset (uint64), chunk count
+		 	          (uint32)
+"""
+
+import collections
+import csv
+import io
+import json
+import lzma
+import multiprocessing
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import numpy as np
+
+# Identifies a RACS binary recording and the revision of its layout
+RECORDING_MAGIC = b'RACS'
+RECORDING_VERSION = 1
+
+# Fixed-size preamble at the start of each binary recording. The sample
+# count is patched in when the recording is closed.
+_PREAMBLE = struct.Struct('<4sHIQ')
+_SAMPLE_COUNT_OFFSET = 10
+
+# Frames start on a multiple of this many bytes
+HEADER_ALIGN = 4096
+
+# Spare header bytes so that fields filled in after the file is created
+# (trigger time, blast summary) fit without moving the frames, plus
+# HEADER_RESERVE_PER_CHANNEL per channel for the per-channel lists of
+# the blast summary (under 200 bytes of JSON per channel)
+HEADER_RESERVE = 2048
+HEADER_RESERVE_PER_CHANNEL = 512
+
+# Chunk framing of compressed recordings
+_CHUNK = struct.Struct('<4sII')
+_CHUNK_MAGIC = b'RCHK'
+_INDEX_ENTRY = struct.Struct('<QI')
+_FOOTER = struct.Struct('<4sQI')
+_FOOTER_MAGIC = b'RIDX'
+
+# Supported compressors: (compress, decompress)
+COMPRESSORS = {
+    'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress),
+    'lzma': (lambda data: lzma.compress(data, preset=1), lzma.decompress),
+}
+
+# Suffix of a recording that is still being written
+PART_SUFFIX = '.part'
+
+# Suffix given to a partial recording that could not be recovered
+QUARANTINE_SUFFIX = '.bad'
+
+# MCC118 code to volts scaling: volts = code * MCC118_LSB + MCC118_MIN_VOLTS
+MCC118_LSB = 20.0 / 4096
+MCC118_MIN_VOLTS = -10.0
+
+
+class RecordingFile(io.RawIOBase):
+    """
+    Unbuffered recording file on a raw descriptor. In durable mode the
+    data goes to path + PART_SUFFIX, is fsynced whenever sync_bytes have
+    been written or sync_seconds have passed since the last sync, and
+    the file is renamed to path once it is closed. Syncing in batches
+    keeps the cost of durability small on an SD card, where a sync per
+    chunk would ruin the write throughput.
+
+    Args:
+        path (str): Final path of the recording.
+        durable (bool): Enable the temporary name, batched fsync and
+            rename on close.
+        sync_bytes (int): Bytes written between syncs.
+        sync_seconds (float): Longest time between syncs.
+        preallocate (int): Bytes to reserve on the card when the file is
+            created. The file is truncated to the bytes actually written
+            when it is closed. Raises OSError (ENOSPC) right away if the
+            card cannot hold the reservation. As its size no longer says
+            how much was written, a preallocated file that is not
+            durable is still committed (see commit) at the sync interval.
+
+    """
+
+    def __init__(self, path, durable=False, sync_bytes=4 * 1024 * 1024,
+                 sync_seconds=2.0, preallocate=0):
+        super().__init__()
+        self.path = path
+        self.durable = durable
+        self.name = path + PART_SUFFIX if durable else path
+        self.fd = os.open(self.name, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.preallocate = preallocate
+        if preallocate:
+            try:
+                os.posix_fallocate(self.fd, 0, preallocate)
+            except OSError:
+                os.close(self.fd)
+                os.remove(self.name)
+                raise
+        self.sync_bytes = sync_bytes
+        self.sync_seconds = sync_seconds
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.syncs = 0
+        self.position = 0
+        self.size = 0
+        # Called before each sync, e.g. to commit a sample count
+        self.before_sync = None
+        self.discarded = False
+
+    def fileno(self):
+        return self.fd
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def write(self, data):
+        if self.discarded:
+            return memoryview(data).nbytes
+        count = os.write(self.fd, data)
+        self.position += count
+        self.size = max(self.size, self.position)
+        self.unsynced += count
+        if (self.durable or self.preallocate) and \
+                (self.unsynced >= self.sync_bytes or
+                 time.monotonic() - self.last_sync >= self.sync_seconds):
+            if self.durable:
+                self.sync()
+            else:
+                self.commit()
+        return count
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.position = os.lseek(self.fd, offset, whence)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def rename(self, path):
+        """
+        Moves the (still open) file to a new final path.
+        """
+        name = path + PART_SUFFIX if self.durable else path
+        os.replace(self.name, name)
+        self.path = path
+        self.name = name
+
+    def discard(self):
+        """
+        Drops everything still to be written and deletes the file when
+        it is closed, instead of keeping it.
+        """
+        self.discarded = True
+
+    def commit(self):
+        """
+        Calls before_sync (e.g. to store the sample count in the file)
+        without forcing anything onto the card.
+        """
+        if self.before_sync is not None:
+            self.before_sync()
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def sync(self):
+        """
+        Forces everything written so far onto the card.
+        """
+        self.commit()
+        os.fdatasync(self.fd)
+        self.syncs += 1
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.discarded:
+                os.close(self.fd)
+                os.remove(self.name)
+                return
+            if self.preallocate:
+                # Release the part of the reservation that was not used
+                os.ftruncate(self.fd, self.size)
+            if self.durable:
+                self.sync()
+            os.close(self.fd)
+            if self.durable:
+                os.replace(self.name, self.path)
+                _sync_directory(self.path)
+        finally:
+            super().close()
+
+
+def _commit_header(f):
+    # Puts the header of a new recording on the card before any samples,
+    # so that a recording armed but never triggered is still readable
+    f.flush()
+    if f.raw.durable:
+        f.raw.sync()
+
+
+def _sync_directory(path):
+    # Makes a rename in the directory of path durable
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class BlockBufferedWriter(io.BufferedIOBase):
+    """
+    Write buffer that hands the raw file only whole, aligned blocks. The
+    output is gathered into one preallocated block_size buffer and issued
+    as a single os.write once the buffer reaches the next multiple of
+    block_size in the file, so each write covers complete erase blocks
+    of the SD card instead of many small, arbitrarily sized pieces.
+    Writes that span whole blocks bypass the buffer. Only flush(), seek()
+    and close() write a partial block.
+
+    Args:
+        raw (RecordingFile): The file to write to.
+        block_size (int): Size of each write in bytes.
+
+    """
+
+    def __init__(self, raw, block_size=1024 * 1024):
+        super().__init__()
+        self.raw = raw
+        self.block_size = block_size
+        self._buffer = bytearray(block_size)
+        self._fill = 0
+        self.writes = 0
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def fileno(self):
+        return self.raw.fileno()
+
+    def _write_all(self, view):
+        self.writes += 1
+        while len(view):
+            view = view[self.raw.write(view):]
+
+    def write(self, data):
+        view = memoryview(data).cast('B')
+        total = len(view)
+        while len(view):
+            # Bytes left until the next block boundary in the file
+            room = self.block_size - self.raw.tell() % self.block_size
+            if self._fill == 0 and room == self.block_size \
+                    and len(view) >= self.block_size:
+                count = len(view) - len(view) % self.block_size
+                self._write_all(view[:count])
+                view = view[count:]
+                continue
+            count = min(len(view), room - self._fill)
+            self._buffer[self._fill:self._fill + count] = view[:count]
+            self._fill += count
+            view = view[count:]
+            if self._fill == room:
+                self.flush()
+        return total
+
+    def flush(self):
+        if self._fill:
+            self._write_all(memoryview(self._buffer)[:self._fill])
+            self._fill = 0
+
+    def tell(self):
+        return self.raw.tell() + self._fill
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.flush()
+        return self.raw.seek(offset, whence)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self.raw.close()
+            super().close()
+
+
+def open_file(path, text=False, block_size=0, **file_options):
+    """
+    Opens a recording file for writing.
+
+    Args:
+        path (str): Final path of the recording.
+        text (bool): Return a text stream (for csv.writer) instead of a
+            binary one.
+        block_size (int): Write the file in aligned blocks of this many
+            bytes (BlockBufferedWriter), or 0 for Python's default
+            buffering.
+        file_options: RecordingFile options (durable, sync_bytes,
+            sync_seconds, preallocate).
+
+    Returns:
+        A buffered binary or text file object.
+
+    """
+    raw = RecordingFile(path, **file_options)
+    if block_size:
+        f = BlockBufferedWriter(raw, block_size)
+    else:
+        f = io.BufferedWriter(raw)
+    if text:
+        return io.TextIOWrapper(f, encoding='ascii', newline='')
+    return f
+
+
+# Time column modes and their fixed-precision CSV formats
+TIME_COLUMNS = {
+    'seconds': '%.9f',  # seconds since the trigger
+    'epoch_ns': '%d',   # integer nanoseconds since the Unix epoch
+}
+
+
+def time_column(start, count, scan_rate, mode='seconds', trigger_time_ns=0):
+    """
+    Generates the time of samples [start, start + count) with vectorized
+    arithmetic, anchored at the trigger instant.
+
+    Args:
+        start (int): Index of the first sample since the trigger.
+        count (int): Number of samples.
+        scan_rate (float): Actual scan rate (samples/sec/channel).
+        mode (str): 'seconds' for seconds since the trigger (float64) or
+            'epoch_ns' for Unix epoch nanoseconds (int64).
+        trigger_time_ns (int): Wall-clock time of the trigger (epoch ns).
+
+    Returns:
+        numpy.ndarray: The time of each sample.
+
+    """
+    index = np.arange(start, start + count, dtype=np.int64)
+    if mode == 'seconds':
+        return index / scan_rate
+    elif mode == 'epoch_ns':
+        return trigger_time_ns + np.rint(index * (1e9 / scan_rate)).astype(np.int64)
+    raise ValueError('Unknown time column: ' + str(mode))
+
+
+def detect_time_column(lines):
+    """
+    Recognizes the time column that a CSV recording may carry before
+    its channels (CSV has no header to say so). The first column is a
+    time column when, over the first rows, it rises in equal steps:
+    whole epoch nanoseconds, or seconds.
+
+    Args:
+        lines (list[bytes]): The first rows of the file (16 are plenty).
+
+    Returns:
+        str: 'epoch_ns' or 'seconds' (see TIME_COLUMNS), or None when
+        the first column is a channel.
+
+    """
+    rows = [line for line in lines if line.strip()]
+    if len(rows) < 3 or any(b',' not in row for row in rows):
+        return None
+    first = [row.split(b',', 1)[0].strip() for row in rows]
+    try:
+        if all(v.lstrip(b'-').isdigit() for v in first):
+            mode = 'epoch_ns'
+            values = np.array([int(v) for v in first], dtype=np.int64)
+            tolerance = 1
+            if values.min() < 10 ** 15:
+                return None
+        else:
+            mode = 'seconds'
+            values = np.array([float(v) for v in first])
+            tolerance = 2e-9
+    except ValueError:
+        return None
+    steps = np.diff(values)
+    if steps[0] <= 0 or \
+            np.abs(steps - steps[0]).max() > max(tolerance, 1e-6 * steps[0]):
+        return None
+    return mode
+
+
+def _with_time(block, times):
+    # Object array keeps epoch nanoseconds exact next to float samples
+    rows = np.empty((len(block), block.shape[1] + 1), dtype=object)
+    rows[:, 0] = times
+    rows[:, 1:] = block
+    return rows
+
+
+def format_csv_block(block, precision=5, lineterminator='\r\n', times=None,
+                     time_format='%.9f'):
+    """
+    Formats a whole block as CSV text at a fixed precision in a single
+    string operation. The layout matches csv.writer (comma separated,
+    CRLF line ends), only the number of decimals differs.
+
+    Args:
+        block (numpy.ndarray): Array of shape (n, num_channels).
+        precision (int): Decimals per value. 5 decimals resolve 10 uV,
+            well below the 4.9 mV step of a 12-bit +/-10 V converter.
+        lineterminator (str): Line ending of each row.
+        times (numpy.ndarray): Optional time of each row, written as the
+            first column.
+        time_format (str): %-format of the time column.
+
+    Returns:
+        bytes: The formatted rows.
+
+    """
+    block = np.asarray(block)
+    if len(block) == 0:
+        return b''
+    columns = ['%%.%df' % precision] * block.shape[1]
+    if times is not None:
+        columns.insert(0, time_format)
+        block = _with_time(block, times)
+    row = ','.join(columns) + lineterminator
+    return ((row * len(block)) % tuple(block.ravel().tolist())).encode('ascii')
+
+
+class RecordingWriter:
+    """
+    Behaviour shared by all recording writers. Subclasses open self.file
+    and set binary_header when a JSON header precedes the data.
+    """
+    binary_header = False
+
+    def set_trigger(self, trigger_time_ns, path_base=None):
+        """
+        Stamps the trigger time into a recording that was created before
+        the trigger, and optionally gives it its final name.
+
+        Args:
+            trigger_time_ns (int): Wall-clock time of the trigger (epoch ns).
+            path_base (str): New path of the recording without extension.
+
+        Returns:
+            None
+
+        """
+        self.update_header(trigger_time_ns=trigger_time_ns,
+                           trigger_time=datetime.fromtimestamp(
+                               trigger_time_ns / 1e9).isoformat())
+        if path_base is not None:
+            self.path = path_base + self.extension
+            self.file.flush()
+            self._raw().rename(self.path)
+
+    def _raw(self):
+        # The RecordingFile under the buffered (and text) layers
+        f = self.file.buffer if hasattr(self.file, 'buffer') else self.file
+        return f.raw
+
+    def discard(self):
+        """
+        Closes the recording and deletes it, e.g. when the DAQ shuts
+        down while a shot is armed. Nothing more is written.
+
+        Returns:
+            None
+
+        """
+        self._raw().discard()
+        self.close()
+
+    def update_header(self, **fields):
+        """
+        Adds fields to the header of the recording. A binary header is
+        rewritten in place within its reserved space, so the frames do
+        not move; the preamble and its sample count are left alone.
+
+        Args:
+            fields: Header fields to set.
+
+        Returns:
+            None
+
+        Raises:
+            ValueError: The header no longer fits its reserved space (it
+            is left unchanged on disk).
+
+        """
+        header = dict(self.header, **fields)
+        if self.binary_header:
+            text = encode_header(header, size=self.data_offset)[_PREAMBLE.size:]
+            self.file.flush()
+            os.pwrite(self.file.raw.fileno(), text, _PREAMBLE.size)
+        self.header = header
+
+
+class CsvRecordingWriter(RecordingWriter):
+    """
+    Writes blocks as CSV rows, one column per channel. With precision
+    set, each block is formatted by format_csv_block() into one bytes
+    buffer instead of going through csv.writer one float at a time.
+    With time_column set (see TIME_COLUMNS), a time column generated
+    from the header scan_rate and trigger_time_ns is written first; rows
+    before header['pretrigger_samples'] get negative times. The header
+    is stored next to the recording when it is closed (see
+    save_csv_header).
+    """
+    extension = '.csv'
+
+    def __init__(self, path, header, precision=None, time_column=None,
+                 **file_options):
+        if time_column is not None and time_column not in TIME_COLUMNS:
+            raise ValueError('Unknown time column: ' + str(time_column))
+        self.path = path
+        self.header = header
+        self.precision = precision
+        self.time_column = time_column
+        self.samples_written = 0
+        if precision is None:
+            self.file = open_file(path, text=True, **file_options)
+            self.csvwriter = csv.writer(self.file)
+        else:
+            self.file = open_file(path, **file_options)
+
+    def write(self, block):
+        """
+        Appends a block of rows to the recording.
+
+        Args:
+            block (numpy.ndarray or list): Rows of num_channels samples.
+
+        Returns:
+            None
+
+        """
+        times = None
+        if self.time_column:
+            times = time_column(self.samples_written
+                                - self.header.get('pretrigger_samples', 0),
+                                len(block),
+                                self.header['scan_rate'], self.time_column,
+                                self.header.get('trigger_time_ns', 0))
+        if self.precision is not None:
+            self.file.write(format_csv_block(
+                block, self.precision, times=times,
+                time_format=TIME_COLUMNS.get(self.time_column)))
+        else:
+            if times is not None:
+                block = _with_time(np.asarray(block), times)
+            if isinstance(block, np.ndarray):
+                block = block.tolist()
+            self.csvwriter.writerows(block)
+        self.samples_written += len(block)
+
+    def close(self):
+        raw = self._raw()
+        self.file.close()
+        if not raw.discarded:
+            save_csv_header(self.path, dict(self.header,
+                                            time_column=self.time_column))
+
+
+class BinaryRecordingWriter(RecordingWriter):
+    """
+    Writes blocks as contiguous binary frames behind a JSON header.
+    """
+    extension = '.racs'
+    binary_header = True
+
+    def __init__(self, path, header, dtype='<f8', **file_options):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.header = dict(header, format='binary', dtype=self.dtype.str)
+        if file_options.get('durable') or file_options.get('preallocate'):
+            # Only the count in the preamble says how many frames are
+            # valid; the size of the file includes unwritten space
+            self.header['committed_count'] = True
+        self.samples_written = 0
+        self.file = open_file(path, **file_options)
+        self.file.write(encode_header(self.header))
+        self.data_offset = self.file.tell()
+        _commit_header(self.file)
+        self.frame_size = self.dtype.itemsize * len(self.header['channels'])
+        self.file.raw.before_sync = self._commit_count
+
+    def write(self, block):
+        """
+        Appends a block of rows to the recording.
+
+        Args:
+            block (numpy.ndarray or list): Rows of num_channels samples.
+
+        Returns:
+            None
+
+        """
+        block = np.ascontiguousarray(block, dtype=self.dtype)
+        self.file.write(block.data)
+        self.samples_written += len(block)
+
+    def _commit_count(self):
+        # Store the number of whole frames that will be on the card after
+        # this sync, so that a recovered file keeps exactly those frames
+        raw = self.file.raw
+        count = (raw.size - self.data_offset) // self.frame_size
+        os.pwrite(raw.fileno(), struct.pack('<Q', count), _SAMPLE_COUNT_OFFSET)
+
+    def close(self):
+        # Record the final sample count in the preamble
+        self.file.seek(_SAMPLE_COUNT_OFFSET)
+        self.file.write(struct.pack('<Q', self.samples_written))
+        self.file.close()
+
+
+def delta_encode(block):
+    """
+    Delta encodes each channel of a block, losslessly. Samples are
+    treated as unsigned integers of the same width (the bit pattern of
+    float samples) and subtracted with wraparound, so the round trip is
+    exact for every dtype.
+
+    Args:
+        block (numpy.ndarray): Array of shape (n, num_channels).
+
+    Returns:
+        numpy.ndarray: Unsigned deltas of the same shape.
+
+    """
+    codes = np.ascontiguousarray(block).view('<u%d' % block.dtype.itemsize)
+    deltas = np.empty_like(codes)
+    deltas[:1] = codes[:1]
+    np.subtract(codes[1:], codes[:-1], out=deltas[1:])
+    return deltas
+
+
+def delta_decode(deltas, dtype):
+    """
+    Inverse of delta_encode.
+
+    Args:
+        deltas (numpy.ndarray): Unsigned deltas of shape (n, num_channels).
+        dtype: Sample type of the original block.
+
+    Returns:
+        numpy.ndarray: The original block.
+
+    """
+    return np.cumsum(deltas, axis=0, dtype=deltas.dtype).view(dtype)
+
+
+def compress_chunk(block, compression):
+    """
+    Compresses one chunk of a compressed recording. Runs in a worker
+    process; channel-planar deltas compress best.
+
+    Args:
+        block (numpy.ndarray): Array of shape (n, num_channels).
+        compression (str): One of the COMPRESSORS keys.
+
+    Returns:
+        tuple: (rows, compressed bytes), see write_chunk.
+
+    """
+    deltas = delta_encode(block)
+    return len(block), COMPRESSORS[compression][0](deltas.T.tobytes())
+
+
+_pool = None
+
+
+def _compression_pool(workers):
+    # One pool for the life of the process, shared by every recording.
+    # Workers come from a fork server, so starting one never copies the
+    # acquisition process with its reader threads and board handles.
+    global _pool
+    if _pool is None:
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+        else:
+            context = multiprocessing.get_context()
+        _pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+    return _pool
+
+
+def start_compression_pool(workers, compression='zlib'):
+    """
+    Starts the compression pool and every one of its workers ahead of
+    the first shot. The pool otherwise starts its workers as the first
+    chunks are submitted, in the middle of an acquisition.
+
+    Args:
+        workers (int): Worker processes, as passed to the writer.
+        compression (str): One of the COMPRESSORS keys; each worker
+            compresses a tiny chunk so its first real chunk is not
+            slowed down by imports.
+
+    Returns:
+        None
+
+    """
+    if not workers:
+        return
+    pool = _compression_pool(workers)
+    block = np.zeros((1, 1))
+    list(pool.map(compress_chunk, [block] * workers, [compression] * workers))
+
+
+class CompressedRecordingWriter(RecordingWriter):
+    """
+    Writes blocks as independently compressed chunks behind a JSON
+    header. Blocks are gathered into chunks of chunk_samples rows and
+    handed to a process pool; finished chunks are written in order as
+    they come back, so write() only copies the block and never waits
+    for the compressor unless max_pending chunks are outstanding. With
+    workers=0 chunks are compressed in the calling process.
+    """
+    extension = '.racz'
+    binary_header = True
+
+    def __init__(self, path, header, dtype='<f8', compression='zlib',
+                 chunk_samples=65536, workers=2, max_pending=8,
+                 **file_options):
+        if compression not in COMPRESSORS:
+            raise ValueError('Unknown compression: ' + str(compression))
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.compression = compression
+        self.header = dict(header, format='compressed', dtype=self.dtype.str,
+                           compression=compression, delta=True)
+        self.num_channels = len(header['channels'])
+        self.chunk = np.empty((chunk_samples, self.num_channels), self.dtype)
+        self.rows = 0
+        self.pool = _compression_pool(workers) if workers else None
+        self.pending = collections.deque()
+        self.max_pending = max_pending
+        self.index = []
+        self.samples_written = 0
+        self.file = open_file(path, **file_options)
+        self.file.write(encode_header(self.header))
+        self.data_offset = self.file.tell()
+        _commit_header(self.file)
+
+    def write(self, block):
+        """
+        Appends a block of rows to the recording.
+
+        Args:
+            block (numpy.ndarray or list): Rows of num_channels samples.
+
+        Returns:
+            None
+
+        """
+        block = np.asarray(block)
+        while len(block):
+            count = min(len(block), len(self.chunk) - self.rows)
+            self.chunk[self.rows:self.rows + count] = block[:count]
+            self.rows += count
+            block = block[count:]
+            if self.rows == len(self.chunk):
+                self._submit()
+        self._write_done(wait=False)
+
+    def _submit(self):
+        if self.pool is None:
+            self.write_chunk(*compress_chunk(self.chunk[:self.rows],
+                                             self.compression))
+        else:
+            self.pending.append(self.pool.submit(
+                compress_chunk, self.chunk[:self.rows].copy(), self.compression))
+        self.rows = 0
+
+    def _write_done(self, wait):
+        # Write completed chunks in order, waiting only when asked to or
+        # when too many are outstanding
+        while self.pending and (wait or self.pending[0].done()
+                                or len(self.pending) > self.max_pending):
+            self.write_chunk(*self.pending.popleft().result())
+
+    def write_chunk(self, rows, payload):
+        """
+        Appends a chunk that was already compressed by compress_chunk(),
+        e.g. by a batch converter running its own process pool.
+
+        Args:
+            rows (int): Rows in the chunk.
+            payload (bytes): Compressed chunk.
+
+        Returns:
+            None
+
+        """
+        self.index.append((self.file.tell(), rows))
+        self.file.write(_CHUNK.pack(_CHUNK_MAGIC, rows, len(payload)))
+        self.file.write(payload)
+        self.samples_written += rows
+
+    def discard(self):
+        # Chunks still being compressed are simply dropped
+        self.pending.clear()
+        self.rows = 0
+        super().discard()
+
+    def close(self):
+        if self.rows:
+            self._submit()
+        self._write_done(wait=True)
+
+        # Chunk index and footer, then the final sample count
+        index_offset = self.file.tell()
+        for entry in self.index:
+            self.file.write(_INDEX_ENTRY.pack(*entry))
+        self.file.write(_FOOTER.pack(_FOOTER_MAGIC, index_offset,
+                                     len(self.index)))
+        self.file.seek(_SAMPLE_COUNT_OFFSET)
+        self.file.write(struct.pack('<Q', self.samples_written))
+        self.file.close()
+
+
+class CompressedRecordingReader:
+    """
+    Random access to the chunks of a compressed recording. Only the
+    chunks covering the requested rows are read and decompressed.
+
+    Args:
+        path (str): Path of a .racz recording.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.header = read_header(path)
+        self.dtype = np.dtype(self.header['dtype'])
+        self.num_channels = len(self.header['channels'])
+        self.decompress = COMPRESSORS[self.header['compression']][1]
+        self.offsets, self.rows = self._load_index()
+        self.starts = np.concatenate(([0], np.cumsum(self.rows)))
+        self.header['samples_per_channel'] = int(self.starts[-1])
+
+    def _load_index(self):
+        with open(self.path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size - self.header['data_offset'] >= _FOOTER.size:
+                f.seek(size - _FOOTER.size)
+                magic, index_offset, count = _FOOTER.unpack(f.read(_FOOTER.size))
+                if magic == _FOOTER_MAGIC:
+                    f.seek(index_offset)
+                    entries = [_INDEX_ENTRY.unpack(f.read(_INDEX_ENTRY.size))
+                               for i in range(count)]
+                    return [e[0] for e in entries], [e[1] for e in entries]
+            # No index (not closed cleanly), walk the chunks instead
+            return scan_chunks(f, self.header['data_offset'], size)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def chunk(self, i):
+        """
+        Returns:
+            numpy.ndarray: The rows of chunk i, shape (n, num_channels).
+
+        """
+        with open(self.path, 'rb') as f:
+            f.seek(self.offsets[i])
+            magic, rows, length = _CHUNK.unpack(f.read(_CHUNK.size))
+            payload = f.read(length)
+        deltas = np.frombuffer(self.decompress(payload),
+                               '<u%d' % self.dtype.itemsize)
+        return delta_decode(deltas.reshape(self.num_channels, rows).T,
+                            self.dtype)
+
+    def read(self, start=0, stop=None):
+        """
+        Reads rows [start, stop) of the recording.
+
+        Returns:
+            numpy.ndarray: Array of shape (stop - start, num_channels).
+
+        """
+        total = int(self.starts[-1])
+        stop = total if stop is None else min(stop, total)
+        if start >= stop:
+            return np.empty((0, self.num_channels), self.dtype)
+        first = int(np.searchsorted(self.starts, start, side='right')) - 1
+        last = int(np.searchsorted(self.starts, stop, side='left'))
+        data = np.concatenate([self.chunk(i) for i in range(first, last)])
+        offset = int(self.starts[first])
+        return data[start - offset:stop - offset]
+
+
+def scan_chunks(f, data_offset, size):
+    """
+    Walks the chunk framing of a compressed recording from the start,
+    stopping at the first incomplete or invalid chunk.
+
+    Args:
+        f (file): Recording opened in binary mode.
+        data_offset (int): Byte offset of the first chunk.
+        size (int): Size of the file.
+
+    Returns:
+        tuple: (list of chunk offsets, list of chunk row counts).
+
+    """
+    offsets, rows = [], []
+    position = data_offset
+    while position + _CHUNK.size <= size:
+        f.seek(position)
+        magic, count, length = _CHUNK.unpack(f.read(_CHUNK.size))
+        if magic != _CHUNK_MAGIC or position + _CHUNK.size + length > size:
+            break
+        offsets.append(position)
+        rows.append(count)
+        position += _CHUNK.size + length
+    return offsets, rows
+
+
+# Writer class and keyword arguments for each supported recording format
+RECORDING_FORMATS = {
+    'csv': (CsvRecordingWriter, {}),
+    'float32': (BinaryRecordingWriter, {'dtype': '<f4'}),
+    'float64': (BinaryRecordingWriter, {'dtype': '<f8'}),
+    'int16': (BinaryRecordingWriter, {'dtype': '<i2'}),
+}
+
+# Formats that store uncalibrated, unscaled ADC codes. Scans recorded in
+# these formats must be started with OptionFlags.NOSCALEDATA and
+# OptionFlags.NOCALIBRATEDATA.
+RAW_FORMATS = ('int16',)
+
+
+def estimate_recording_size(recording_format, samples_per_channel,
+                            num_channels, compression=None, precision=None,
+                            time_column=None):
+    """
+    Upper bound on the size of a recording, used to reserve its space on
+    the card before the scan is armed.
+
+    Args:
+        recording_format (str): One of the RECORDING_FORMATS keys.
+        samples_per_channel (int): Samples per channel in the scan.
+        num_channels (int): The number of channels in the scan.
+        compression (str): Compression of a binary format, or None.
+        precision (int): Decimals of the csv format (None for csv.writer).
+        time_column (str): Time column of the csv format, or None.
+
+    Returns:
+        int: Size in bytes.
+
+    """
+    if recording_format == 'csv':
+        # '-10.' plus the decimals and a comma, or the longest float repr
+        width = precision + 5 if precision is not None else 24
+        row = num_channels * width + 1
+        if time_column:
+            row += 21
+        return samples_per_channel * row
+
+    cls, kwargs = RECORDING_FORMATS[recording_format]
+    size = samples_per_channel * num_channels * np.dtype(kwargs['dtype']).itemsize
+    if compression:
+        # Incompressible data grows slightly; allow for the chunk framing
+        size += size // 100 + 65536
+    return HEADER_ALIGN + size
+
+
+def recording_extensions():
+    """
+    Returns:
+        list[str]: File extensions used by the supported formats.
+
+    """
+    extensions = set(cls.extension for cls, _ in RECORDING_FORMATS.values())
+    extensions.add(CompressedRecordingWriter.extension)
+    return sorted(extensions)
+
+
+def open_recording(path_base, recording_format, header, compression=None,
+                   **options):
+    """
+    Creates a recording writer for the requested format.
+
+    Args:
+        path_base (str): Path of the recording without extension.
+        recording_format (str): One of the RECORDING_FORMATS keys.
+        header (dict): Recording metadata (DAQ name, channels, scan
+            rate, trigger time, ...). Stored in binary recordings.
+        compression (str): None, or one of the COMPRESSORS keys to write
+            a binary format as a compressed recording.
+        options: Extra keyword arguments for the writer, e.g.
+            chunk_samples and workers of the compressed writer, or the
+            durable, sync_bytes, sync_seconds, preallocate and
+            block_size file options.
+
+    Returns:
+        A writer with write(block) and close() methods and a path
+        attribute.
+
+    """
+    try:
+        cls, kwargs = RECORDING_FORMATS[recording_format]
+    except KeyError:
+        raise ValueError('Unknown recording format: ' + str(recording_format))
+    if compression:
+        if cls is not BinaryRecordingWriter:
+            raise ValueError('Compression requires a binary recording format')
+        cls = CompressedRecordingWriter
+        kwargs = dict(kwargs, compression=compression)
+    return cls(path_base + cls.extension, header, **dict(kwargs, **options))
+
+
+def raw_header(coefficients):
+    """
+    Builds the header fields needed to turn raw codes back into volts.
+
+    Args:
+        coefficients (list): Per-channel (slope, offset) calibration
+            coefficients, as returned by mcc118.calibration_coefficient_read.
+
+    Returns:
+        dict: Header fields to merge into the recording header.
+
+    """
+    return {
+        'raw': True,
+        'calibration': [[float(c[0]), float(c[1])] for c in coefficients],
+        'lsb': MCC118_LSB,
+        'min_volts': MCC118_MIN_VOLTS,
+    }
+
+
+def codes_to_volts(codes, header):
+    """
+    Applies the per-channel calibration and scaling stored in a raw
+    recording header to a block of codes.
+
+    Args:
+        codes (numpy.ndarray): Array of shape (n, num_channels).
+        header (dict): Header of a raw recording.
+
+    Returns:
+        numpy.ndarray: float64 volts of the same shape.
+
+    """
+    calibration = np.asarray(header['calibration'], dtype=np.float64)
+    slope = calibration[:, 0] * header['lsb']
+    offset = calibration[:, 1] * header['lsb'] + header['min_volts']
+    return codes * slope + offset
+
+
+def encode_header(header, samples_per_channel=0, size=None):
+    """
+    Builds the preamble and padded JSON header of a binary recording.
+
+    Args:
+        header (dict): Recording metadata.
+        samples_per_channel (int): Sample count stored in the preamble.
+        size (int): Exact size to pad to, when rewriting the header of an
+            existing recording. By default the header is padded to the
+            next HEADER_ALIGN boundary, leaving at least HEADER_RESERVE
+            plus HEADER_RESERVE_PER_CHANNEL per channel spare bytes.
+
+    Returns:
+        bytes: Everything that precedes the first frame.
+
+    """
+    text = json.dumps(header, sort_keys=True).encode('utf-8')
+    length = len(text) + _PREAMBLE.size
+    if size is None:
+        reserve = (HEADER_RESERVE + HEADER_RESERVE_PER_CHANNEL
+                   * len(header.get('channels') or ()))
+        padding = reserve + (-(length + reserve) % HEADER_ALIGN)
+    elif length <= size:
+        padding = size - length
+    else:
+        raise ValueError('Recording header does not fit in %d bytes' % size)
+    text += b' ' * padding
+    return _PREAMBLE.pack(RECORDING_MAGIC, RECORDING_VERSION, len(text),
+                          samples_per_channel) + text
+
+
+def csv_header_path(recording_path):
+    """
+    Returns:
+        str: Path of the header stored next to a CSV recording, which
+        has no room for one of its own.
+
+    """
+    return os.path.splitext(recording_path)[0] + '.header.json'
+
+
+def save_csv_header(recording_path, header):
+    """
+    Stores the header of a CSV recording next to it (see
+    csv_header_path), so that its exact trigger time, pre-trigger
+    samples, scan rate and channels are not lost with the file name
+    as the only record.
+
+    Args:
+        recording_path (str): Path of the CSV recording.
+        header (dict): Recording header.
+
+    Returns:
+        None
+
+    """
+    header = dict(header, format='csv')
+    header.setdefault('pretrigger_samples', 0)
+    with open(csv_header_path(recording_path), 'w') as f:
+        json.dump(header, f, sort_keys=True)
+
+
+def read_csv_header(path):
+    """
+    Reads the header stored next to a CSV recording.
+
+    Args:
+        path (str): Path of a CSV recording.
+
+    Returns:
+        dict: Recording metadata, or None when the recording has none
+        (written by an older version, or recovered after a power loss).
+
+    """
+    try:
+        with open(csv_header_path(path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def read_header(path):
+    """
+    Reads the header of a binary recording.
+
+    Args:
+        path (str): Path of a binary recording.
+
+    Returns:
+        dict: Recording metadata, including samples_per_channel and
+        data_offset (byte offset of the first frame).
+
+    """
+    with open(path, 'rb') as f:
+        preamble = f.read(_PREAMBLE.size)
+        if len(preamble) < _PREAMBLE.size:
+            raise ValueError(path + ': not a RACS recording')
+        magic, version, header_length, count = _PREAMBLE.unpack(preamble)
+        if magic != RECORDING_MAGIC:
+            raise ValueError(path + ': not a RACS recording')
+        if version > RECORDING_VERSION:
+            raise ValueError(path + ': unsupported version %d' % version)
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    header['data_offset'] = _PREAMBLE.size + header_length
+    frame_size = np.dtype(header['dtype']).itemsize * len(header['channels'])
+    if count == 0 and header['format'] == 'binary' \
+            and not header.get('committed_count'):
+        # Not closed cleanly, use whatever whole frames made it to disk
+        data_size = os.path.getsize(path) - header['data_offset']
+        count = max(data_size, 0) // frame_size
+    header['samples_per_channel'] = count
+    return header
+
+
+def read_rows(path, start=0, stop=None, raw=False, header=None):
+    """
+    Reads rows [start, stop) of a binary or compressed recording without
+    loading the rest of it.
+
+    Args:
+        path (str): Path of a binary or compressed recording.
+        start (int): First row.
+        stop (int): End row, or None for the end of the recording.
+        raw (bool): Return the stored ADC codes of a raw recording
+            instead of converting them to volts.
+        header (dict): Header from read_header, to avoid reading it again.
+
+    Returns:
+        numpy.ndarray: Array of shape (n, num_channels).
+
+    """
+    if header is None:
+        header = read_header(path)
+    num_channels = len(header['channels'])
+    if header['format'] == 'compressed':
+        data = CompressedRecordingReader(path).read(start, stop)
+    else:
+        total = header['samples_per_channel']
+        stop = total if stop is None else min(stop, total)
+        count = max(stop - start, 0)
+        dtype = np.dtype(header['dtype'])
+        data = np.fromfile(path, dtype=dtype, count=count * num_channels,
+                           offset=header['data_offset']
+                           + start * num_channels * dtype.itemsize)
+        data = data.reshape(-1, num_channels)
+    if header.get('raw') and not raw:
+        data = codes_to_volts(data, header)
+    return data
+
+
+def read_recording(path, raw=False):
+    """
+    Loads a recording into memory.
+
+    Args:
+        path (str): Path of a .csv or binary recording.
+        raw (bool): Return the stored ADC codes of a raw recording
+            instead of converting them to volts.
+
+    Returns:
+        tuple: (header dict, numpy.ndarray of shape (n, num_channels)).
+        Float recordings keep their stored dtype, CSV and converted raw
+        recordings are float64. The time column of a CSV recording is
+        left out and named in header['time_column']; the rest of its
+        header comes from read_csv_header.
+
+    """
+    if path.endswith(CsvRecordingWriter.extension):
+        with open(path, 'rb') as f:
+            mode = detect_time_column([f.readline() for i in range(16)])
+        data = np.loadtxt(path, delimiter=',', ndmin=2)
+        if mode:
+            data = data[:, 1:]
+        header = dict(read_csv_header(path) or {}, format='csv',
+                      samples_per_channel=len(data), time_column=mode)
+        return header, data
+
+    header = read_header(path)
+    if header['format'] == 'compressed':
+        header = CompressedRecordingReader(path).header
+    return header, read_rows(path, raw=raw, header=header)
+
+def recover_recording(path):
+    """
+    Salvages the valid prefix of a recording that was not closed, e.g.
+    a '.part' file left behind by a power loss. The file is cut back to
+    the last complete row (CSV), the last committed frame (binary) or
+    the last intact chunk (compressed), its header is repaired and it
+    is renamed to its final name.
+
+    Args:
+        path (str): Path of the partial recording.
+
+    Returns:
+        tuple: (path of the recovered recording, samples per channel).
+
+    """
+    final = path[:-len(PART_SUFFIX)] if path.endswith(PART_SUFFIX) else path
+    if final.endswith(CsvRecordingWriter.extension):
+        samples = _recover_csv(path)
+    else:
+        header = read_header(path)
+        if header['format'] == 'compressed':
+            samples = _recover_compressed(path, header)
+        else:
+            samples = _recover_binary(path, header)
+    os.replace(path, final)
+    _sync_directory(final)
+    return final, samples
+
+
+def quarantine_recording(path):
+    """
+    Sets aside a partial recording that could not be recovered, under a
+    name the recovery scan no longer matches, for a person to look at.
+
+    Args:
+        path (str): Path of the partial recording.
+
+    Returns:
+        str: The new path.
+
+    """
+    bad = path + QUARANTINE_SUFFIX
+    os.replace(path, bad)
+    return bad
+
+
+def _recover_csv(path):
+    with open(path, 'r+b') as f:
+        data = f.read()
+        # Blocks that never reached the card read back as zeros
+        end = data.find(b'\0')
+        if end >= 0:
+            data = data[:end]
+        data = data[:data.rfind(b'\n') + 1]
+        lines = data.splitlines()
+        if len(lines) > 1 and lines[-1].count(b',') != lines[0].count(b','):
+            data = data[:data.rfind(b'\n', 0, len(data) - 1) + 1]
+            lines.pop()
+        f.truncate(len(data))
+        os.fsync(f.fileno())
+    return len(lines)
+
+
+def _recover_binary(path, header):
+    frame_size = np.dtype(header['dtype']).itemsize * len(header['channels'])
+    # A power loss during the last sync can leave the committed count
+    # on the card ahead of the frames it counts
+    whole_frames = max(os.path.getsize(path) - header['data_offset'], 0) // frame_size
+    count = min(header['samples_per_channel'], whole_frames)
+    with open(path, 'r+b') as f:
+        f.truncate(header['data_offset'] + count * frame_size)
+        f.seek(_SAMPLE_COUNT_OFFSET)
+        f.write(struct.pack('<Q', count))
+        os.fsync(f.fileno())
+    return count
+
+
+def _recover_compressed(path, header):
+    decompress = COMPRESSORS[header['compression']][1]
+    with open(path, 'r+b') as f:
+        size = os.fstat(f.fileno()).st_size
+        offsets, rows = scan_chunks(f, header['data_offset'], size)
+
+        # Drop trailing chunks whose payload did not make it to the card
+        while offsets:
+            f.seek(offsets[-1])
+            magic, count, length = _CHUNK.unpack(f.read(_CHUNK.size))
+            try:
+                decompress(f.read(length))
+                break
+            except (zlib.error, lzma.LZMAError):
+                offsets.pop()
+                rows.pop()
+
+        if offsets:
+            end = offsets[-1] + _CHUNK.size + length
+        else:
+            end = header['data_offset']
+        f.truncate(end)
+        f.seek(end)
+        for entry in zip(offsets, rows):
+            f.write(_INDEX_ENTRY.pack(*entry))
+        f.write(_FOOTER.pack(_FOOTER_MAGIC, end, len(offsets)))
+        f.seek(_SAMPLE_COUNT_OFFSET)
+        f.write(struct.pack('<Q', sum(rows)))
+        os.fsync(f.fileno())
+    return sum(rows)
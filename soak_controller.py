@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+	Description:
+		 Soak test of the long-lived shot controller (racs_controller)
+		 driving the real DAQ script. RACS_DAQA is imported with stand-ins
+		 for the hardware modules it uses (RPi.GPIO, daqhats,
+		 daqhats_utils, serial and serial.threaded) installed in
+		 sys.modules, and its own setup_session, arm_shot,
+		 wait_for_trigger, record_shot, finalize_shot, abort_shot and
+		 teardown_session run thousands of shots. The simulated LoStik
+		 delivers its lines on one reader thread and answers every READY
+		 announcement with the trigger command, and the one after the
+		 last shot with the shutdown command, so that the armed shot is
+		 aborted as in the field. With --boards 2 or more the shots go
+		 through a HatGroup.
+
+		 After a warm-up, the traced Python memory, the resident set
+		 size, the thread count and the open file descriptors are
+		 compared with their values at the end. The script also checks
+		 that the GPIO pins, the LoStik, the MCC118s and the scan plan
+		 were set up once and reused by every shot, and that only the
+		 catalog and the planner cache are left in the DATA directory.
+		 Any failure is reported and the script exits with status 1.
+
+		 Usage: python3 soak_controller.py [--shots 5000] [--samples 5000]
+		        [--channels 2] [--boards 1] [--format float32] [--warmup 200]
+"""
+
+import argparse
+import binascii
+import ctypes
+import ctypes.util
+import enum
+import gc
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from collections import namedtuple
+from contextlib import redirect_stdout
+import numpy as np
+from racs_acquire import ScanRead, ScanStatus
+from racs_analysis import overview_path, summary_path
+from racs_recording import csv_header_path, RECORDING_FORMATS
+
+
+class SimulatedGPIO(types.ModuleType):
+    """
+    Stands in for RPi.GPIO: keeps the pin levels and counts the setup
+    calls.
+    """
+    BCM = 11
+    OUT, IN = 0, 1
+    LOW, HIGH = 0, 1
+    PUD_DOWN = 21
+    RISING = 31
+
+    def __init__(self):
+        super().__init__('RPi.GPIO')
+        self.levels = {}
+        self.calls = {'setmode': 0, 'add_event_detect': 0, 'cleanup': 0}
+
+    def setmode(self, mode):
+        self.calls['setmode'] += 1
+
+    def setup(self, pin, direction, initial=0, pull_up_down=None):
+        self.levels[pin] = initial
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self.calls['add_event_detect'] += 1
+
+    def output(self, pin, level):
+        self.levels[pin] = level
+
+    def input(self, pin):
+        return self.levels.get(pin, 0)
+
+    def cleanup(self):
+        self.calls['cleanup'] += 1
+
+
+class HatError(Exception):
+    pass
+
+
+class OptionFlags(enum.IntFlag):
+    DEFAULT = 0
+    NOSCALEDATA = 1
+    NOCALIBRATEDATA = 2
+    EXTCLOCK = 4
+    EXTTRIGGER = 8
+    CONTINUOUS = 16
+
+
+class TriggerModes(enum.IntEnum):
+    RISING_EDGE = 0
+    FALLING_EDGE = 1
+    ACTIVE_HIGH = 2
+    ACTIVE_LOW = 3
+
+
+CalibrationInfo = namedtuple('CalibrationInfo', 'slope offset')
+
+
+class SimulatedMcc118:
+    """
+    Stands in for daqhats.mcc118 running finite scans. Every read returns
+    at once with up to the requested samples; the scan stops when all
+    samples_per_channel have been read.
+    """
+    opened = 0
+
+    def __init__(self, address):
+        SimulatedMcc118.opened += 1
+        self.address = address
+        self.num_channels = 0
+        self.remaining = 0
+        self.scans = 0
+        self.noise = np.random.uniform(-1, 1, 8 * 65536)
+
+    def a_in_scan_actual_rate(self, num_channels, scan_rate):
+        return 100000.0 / max(round(100000.0 / scan_rate), 1)
+
+    def trigger_mode(self, mode):
+        pass
+
+    def calibration_coefficient_read(self, channel):
+        return CalibrationInfo(1.0, 0.0)
+
+    def a_in_scan_start(self, channel_mask, samples_per_channel, sample_rate,
+                        options):
+        if self.remaining:
+            raise HatError('Scan already running')
+        self.num_channels = bin(channel_mask).count('1')
+        self.remaining = samples_per_channel
+        self.scans += 1
+
+    def a_in_scan_read_numpy(self, samples_per_channel, timeout):
+        count = self.remaining
+        if samples_per_channel >= 0:
+            count = min(count, samples_per_channel)
+        count = min(count, 65536)
+        self.remaining -= count
+        return ScanRead(self.remaining > 0, False, False, True, False,
+                        self.noise[:count * self.num_channels])
+
+    a_in_scan_read = a_in_scan_read_numpy
+
+    def a_in_scan_status(self):
+        return ScanStatus(self.remaining > 0, False, False, True,
+                          self.remaining)
+
+    def a_in_scan_stop(self):
+        pass
+
+    def a_in_scan_cleanup(self):
+        self.remaining = 0
+
+
+class SimulatedSerial:
+    """
+    Stands in for serial.Serial; counts the ports opened.
+    """
+    opened = 0
+
+    def __init__(self, port, baudrate=9600):
+        SimulatedSerial.opened += 1
+
+
+class LineReader:
+    """
+    Base class of PrintLines, as in serial.threaded.
+    """
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        pass
+
+
+class SimulatedReaderThread:
+    """
+    Stands in for serial.threaded.ReaderThread and the LoStik behind it:
+    one long-lived thread passes the received lines to the protocol's
+    handle_line, as the real reader thread does. Every READY announcement
+    is answered with the trigger command, the one after the last shot
+    with the shutdown command.
+    """
+
+    def __init__(self, serial_instance, protocol_factory):
+        self.protocol_factory = protocol_factory
+        self.protocol = None
+        self.alive = True
+        self.lines = queue.Queue()
+        self.triggers = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def connect(self):
+        self.protocol = self.protocol_factory()
+        self.protocol.connection_made(self)
+        return self, self.protocol
+
+    def write(self, data):
+        command = data.decode().strip()
+        if not command.startswith('radio tx '):
+            return
+        if binascii.unhexlify(command[9:]).decode() != daq.READY_RESPONSE:
+            return
+        if self.triggers < shots_wanted:
+            self.triggers += 1
+            self.lines.put(daq.REC_SIG)
+        else:
+            self.lines.put(daq.SHUTDOWN_SIG)
+
+    def _run(self):
+        while True:
+            line = self.lines.get()
+            if line is None:
+                break
+            self.protocol.handle_line(line)
+
+    def close(self):
+        if self.alive:
+            self.alive = False
+            self.lines.put(None)
+            self.thread.join()
+
+
+class FastClock:
+    """
+    The time module as seen by the DAQ script, without the LED and radio
+    pauses: sleep only yields to the other threads.
+    """
+    time_ns = staticmethod(time.time_ns)
+
+    @staticmethod
+    def sleep(seconds):
+        time.sleep(0)
+
+
+def install_stubs():
+    """
+    Puts the simulated hardware modules in sys.modules, so that the DAQ
+    script imports them instead of the real ones.
+
+    Returns:
+        SimulatedGPIO: The GPIO stand-in.
+
+    """
+    gpio = SimulatedGPIO()
+    rpi = types.ModuleType('RPi')
+    rpi.GPIO = gpio
+    daqhats = types.ModuleType('daqhats')
+    daqhats.mcc118 = SimulatedMcc118
+    daqhats.OptionFlags = OptionFlags
+    daqhats.TriggerModes = TriggerModes
+    daqhats.HatIDs = types.SimpleNamespace(MCC_118=322)
+    daqhats.HatError = HatError
+    utils = types.ModuleType('daqhats_utils')
+    utils.select_hat_device = lambda hat_id: 0
+    utils.enum_mask_to_string = lambda enum_type, mask: str(mask)
+    utils.chan_list_to_mask = lambda channels: sum(1 << c for c in channels)
+    serial = types.ModuleType('serial')
+    serial.Serial = SimulatedSerial
+    serial.SerialException = OSError
+    threaded = types.ModuleType('serial.threaded')
+    threaded.LineReader = LineReader
+    threaded.ReaderThread = SimulatedReaderThread
+    serial.threaded = threaded
+    sys.modules.update({'RPi': rpi, 'RPi.GPIO': gpio, 'daqhats': daqhats,
+                        'daqhats_utils': utils, 'serial': serial,
+                        'serial.threaded': threaded})
+    return gpio
+
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'))
+    malloc_trim = libc.malloc_trim
+except (OSError, AttributeError, TypeError):
+    # Not glibc
+    malloc_trim = None
+
+
+def resident_bytes():
+    """
+    Returns the heap freed by the shots to the OS first (glibc keeps it
+    otherwise, and the resident set then follows fragmentation rather
+    than live memory).
+
+    Returns:
+        int: Current resident set size, or 0 where /proc is missing.
+
+    """
+    if malloc_trim is not None:
+        malloc_trim(0)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+def open_descriptors():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return 0
+
+
+def measure():
+    gc.collect()
+    return {
+        'traced': tracemalloc.get_traced_memory()[0],
+        'rss': resident_bytes(),
+        'threads': threading.active_count(),
+        'fds': open_descriptors(),
+    }
+
+
+# The DAQ script under test and the shots the radio triggers, set by main
+daq = None
+shots_wanted = 0
+
+
+def main():
+    global daq
+    global shots_wanted
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--shots', type=int, default=5000,
+                        help='shots to run')
+    parser.add_argument('--warmup', type=int, default=200,
+                        help='shots before the baseline is taken')
+    parser.add_argument('--samples', type=int, default=5000,
+                        help='samples per channel per shot')
+    parser.add_argument('--channels', type=int, default=2,
+                        help='channels per board')
+    parser.add_argument('--boards', type=int, default=1,
+                        help='MCC118 boards, more than 1 scans a HatGroup')
+    parser.add_argument('--rate', type=float, default=50000.0,
+                        help='nominal scan rate (samples/sec/channel)')
+    parser.add_argument('--format', default='float32',
+                        choices=sorted(RECORDING_FORMATS))
+    parser.add_argument('--max-traced-kb', type=float, default=256.0,
+                        help='allowed growth of traced Python memory')
+    parser.add_argument('--max-rss-mb', type=float, default=4.0,
+                        help='allowed growth of the resident set')
+    args = parser.parse_args()
+    if args.shots <= args.warmup:
+        parser.error('--shots must exceed --warmup')
+
+    gpio = install_stubs()
+    import RACS_DAQA
+    daq = RACS_DAQA
+    shots_wanted = args.shots
+    daq.time = FastClock
+    daq.RESPONSE_DELAY = 0
+    daq.EXTRA_LEAD_TIME = 0
+    daq.RECORDING_FORMAT = args.format
+    daq.scan_rate = args.rate
+    daq.recording_length = args.samples / args.rate
+    daq.channels = list(range(args.channels))
+    if args.boards > 1:
+        daq.HAT_CHANNELS = {address: list(range(args.channels))
+                            for address in range(args.boards)}
+
+    tracemalloc.start()
+    marks = {}
+    scan_rates = set()
+    failures = []
+    console = sys.stdout
+
+    def finalize(shot):
+        daq.finalize_shot(shot)
+        writer = shot[0]
+        scan_rates.add(writer.header['scan_rate'])
+        if writer.samples_written != daq.samples_per_channel:
+            failures.append('shot %d recorded %d of %d samples'
+                            % (controller.shots, writer.samples_written,
+                               daq.samples_per_channel))
+        # Keep the disk flat too
+        for path in (writer.path, overview_path(writer.path),
+                     summary_path(writer.path), csv_header_path(writer.path)):
+            if os.path.exists(path):
+                os.remove(path)
+        daq.catalog.remove(writer.path)
+
+    def on_state(state):
+        if state == 'armed' and controller.shots in (args.warmup, args.shots - 1):
+            marks[controller.shots] = measure()
+        elif state == 'armed' and controller.shots and controller.shots % 1000 == 0:
+            print('    %6d shots, %.1f MB resident'
+                  % (controller.shots, resident_bytes() / 1e6), file=console)
+
+    with tempfile.TemporaryDirectory() as directory:
+        daq.basepath = directory
+        daq.mypath = os.path.join(directory, 'DATA')
+        controller = daq.ShotController(
+            daq.setup_session, daq.arm_shot,
+            lambda shot: daq.wait_for_trigger(daq.hat, shot[1]),
+            daq.record_shot, finalize, daq.abort_shot,
+            daq.teardown_session, on_state)
+        daq.controller = controller
+        start = time.perf_counter()
+        # The script's own messages are not part of the report
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            shots = controller.run()
+        elapsed = time.perf_counter() - start
+        remaining = sorted(os.listdir(daq.mypath))
+
+    before = marks[args.warmup]
+    after = marks[args.shots - 1]
+    boards = daq.hat.hats if args.boards > 1 else [daq.hat]
+    print('    %d shots in %.1f s (%.1f ms/shot), %d scans on each of %d HATs'
+          % (shots, elapsed, elapsed / shots * 1e3, boards[0].scans,
+             len(boards)))
+    print('    after shot %d -> %d:' % (args.warmup, args.shots - 1))
+    print('      traced memory %+8.1f kB' % ((after['traced'] - before['traced']) / 1e3))
+    print('      resident      %+8.1f kB' % ((after['rss'] - before['rss']) / 1e3))
+    print('      threads       %+8d' % (after['threads'] - before['threads']))
+    print('      descriptors   %+8d' % (after['fds'] - before['fds']))
+
+    if after['traced'] - before['traced'] > args.max_traced_kb * 1e3:
+        failures.append('traced memory grew')
+    if after['rss'] - before['rss'] > args.max_rss_mb * 1e6:
+        failures.append('resident set grew')
+    if after['threads'] > before['threads']:
+        failures.append('threads leaked')
+    if after['fds'] > before['fds']:
+        failures.append('file descriptors leaked')
+    if shots != args.shots:
+        failures.append('only %d shots completed' % shots)
+    if gpio.calls != {'setmode': 1, 'add_event_detect': 1, 'cleanup': 1}:
+        failures.append('GPIO set up %(setmode)d times, cleaned up %(cleanup)d times'
+                        % gpio.calls)
+    if SimulatedSerial.opened != 1:
+        failures.append('LoStik opened %d times' % SimulatedSerial.opened)
+    if SimulatedMcc118.opened != args.boards:
+        failures.append('%d MCC118s opened' % SimulatedMcc118.opened)
+    if any(board.scans != shots + 1 for board in boards):
+        # One scan per shot, plus the one armed when the shutdown came
+        failures.append('scans per board differ from the shots')
+    if len(scan_rates) != 1:
+        failures.append('scan rate changed between shots')
+    if remaining != ['catalog.sqlite', 'racs_planner.json']:
+        failures.append('left behind: ' + ', '.join(remaining))
+    print('    ' + ('FAIL: ' + ', '.join(failures) if failures else 'PASS'))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
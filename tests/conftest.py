@@ -0,0 +1,30 @@
+#  -*- coding: utf-8 -*-
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# The racs_* modules sit at the top of the repository, next to the DAQ
+# scripts, and are not installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def header():
+    return {
+        'daq_name': 'DAQ_T',
+        'channels': [0, 1, 2],
+        'scan_rate': 1000.0,
+        'trigger_time_ns': 1700000000 * 10 ** 9,
+        'trigger_time': '2023-11-14T22:13:20',
+    }
+
+
+@pytest.fixture
+def volts():
+    # Three channels of 12-bit MCC118 levels, exactly representable in
+    # every format
+    rng = np.random.default_rng(7)
+    return rng.integers(0, 4096, (1000, 3)) * (20.0 / 4096) - 10.0
@@ -0,0 +1,345 @@
+#  -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from racs_acquire import ScanPipeline, CaptureBuffer, RingBuffer, \
+    PretriggerCapture, HatGroup, ScanRead, ScanStatus, deinterleave_list, \
+    deinterleave_numpy, read_block_size, prepend_read
+from racs_analysis import TriggerEngine
+
+
+def ramp(start, count, num_channels=2):
+    # Row i holds i on channel 0, -i on channel 1
+    index = np.arange(start, start + count, dtype=np.float64)
+    return np.column_stack([index, -index][:num_channels])
+
+
+class RampScan:
+    """
+    Scan returning `chunk` rows of the ramp per read, ending after
+    `limit` rows when set, with an optional step on channel 0 from row
+    `step_at` on. With `hold_at` set, the scan stops there until
+    `resume` is set.
+    """
+
+    def __init__(self, chunk, limit=None, hold_at=None, step_at=None):
+        self.chunk = chunk
+        self.limit = limit
+        self.step_at = step_at
+        self.hold_at = hold_at
+        self.held = threading.Event()
+        self.resume = threading.Event()
+        self.rows = 0
+
+    def __call__(self):
+        if self.hold_at is not None and self.rows >= self.hold_at:
+            self.held.set()
+            self.resume.wait()
+        count = self.chunk
+        if self.hold_at is not None and self.rows < self.hold_at:
+            count = min(count, self.hold_at - self.rows)
+        if self.limit is not None:
+            count = min(count, self.limit - self.rows)
+        rows = ramp(self.rows, count)
+        if self.step_at is not None:
+            rows[:, 0] = np.where(np.arange(self.rows, self.rows + count)
+                                  >= self.step_at, 5.0, 0.0)
+        self.rows += count
+        running = self.limit is None or self.rows < self.limit
+        return ScanRead(running, False, False, True, False, rows.ravel())
+
+
+def test_deinterleave():
+    data = ramp(0, 10).ravel()
+    np.testing.assert_array_equal(deinterleave_numpy(data, 2), ramp(0, 10))
+    assert deinterleave_list(list(data), 2) == ramp(0, 10).tolist()
+
+
+def test_read_block_size():
+    # 50 ms of a 50 kS/s scan, with a second of slack on the timeout
+    assert read_block_size(50000.0, 0.05) == (2500, pytest.approx(1.05))
+    # Kept to a quarter of the scan buffer, and never empty
+    assert read_block_size(50000.0, 0.05, 4000)[0] == 1000
+    assert read_block_size(10.0, 0.01)[0] == 1
+    assert read_block_size(10.0, 0.01, 2)[0] == 1
+
+
+def test_prepend_read():
+    scan = RampScan(4)
+    first = scan()
+    read = prepend_read(first, scan)
+    # The read that waited for the trigger comes first, then the scan
+    assert read() is first
+    np.testing.assert_array_equal(deinterleave_numpy(read().data, 2),
+                                  ramp(4, 4))
+
+
+def test_blocking_reads_through_pipeline():
+    # Fixed-size reads of 250 rows, after a first read of one row
+    scan = RampScan(250, limit=1001)
+    first = RampScan(1)()
+    scan.rows = 1
+    pipeline = ScanPipeline(prepend_read(first, scan), 1001, 2, 400, 3)
+    pipeline.start()
+    blocks = [block.copy() for block in pipeline.blocks()]
+    np.testing.assert_array_equal(np.concatenate(blocks), ramp(0, 1001))
+
+
+def test_scan_pipeline_order():
+    # Reads of 7 rows are regrouped into blocks of 16 through 3 buffers
+    pipeline = ScanPipeline(RampScan(7, limit=100), 100, 2, 16, 3)
+    pipeline.start()
+    blocks = [block.copy() for block in pipeline.blocks()]
+    assert [len(block) for block in blocks] == [16] * 6 + [4]
+    np.testing.assert_array_equal(np.concatenate(blocks), ramp(0, 100))
+    assert pipeline.completed
+    report = pipeline.report()
+    assert report['samples_read'] == 100
+    assert report['blocks'] == 7
+    assert report['high_water'] <= 3
+    assert report['overrun'] is None
+
+
+def test_scan_pipeline_waits_for_writer():
+    pipeline = ScanPipeline(RampScan(8, limit=64), 64, 2, 8, 2)
+    pipeline.start()
+    blocks = []
+    for block in pipeline.blocks():
+        # Holding a block stalls the reader once the pool is used up
+        pipeline.thread.join(0.05)
+        blocks.append(block.copy())
+    np.testing.assert_array_equal(np.concatenate(blocks), ramp(0, 64))
+    assert pipeline.reader_waits > 0
+
+
+def test_scan_pipeline_overrun():
+    scan = RampScan(10)
+
+    def read_chunk():
+        result = scan()
+        return result._replace(buffer_overrun=scan.rows > 30)
+
+    pipeline = ScanPipeline(read_chunk, 100, 2, 16, 3)
+    pipeline.start()
+    blocks = [block.copy() for block in pipeline.blocks()]
+    np.testing.assert_array_equal(np.concatenate(blocks), ramp(0, 30))
+    assert pipeline.overrun == 'Buffer overrun'
+    assert not pipeline.completed
+
+
+def test_scan_pipeline_reader_error():
+    def read_chunk():
+        raise IOError('read failed')
+
+    pipeline = ScanPipeline(read_chunk, 100, 2, 16, 3)
+    pipeline.start()
+    with pytest.raises(IOError):
+        list(pipeline.blocks())
+
+
+def test_capture_buffer():
+    capture = CaptureBuffer(100, 2)
+    assert capture.capture(RampScan(9)) == 100
+    np.testing.assert_array_equal(capture.data, ramp(0, 100))
+    assert [len(block) for block in capture.blocks(40)] == [40, 40, 20]
+    assert CaptureBuffer.size_bytes(100, 2) == capture.data.nbytes
+
+
+def test_capture_buffer_stopped_scan():
+    # The scan stops after 30 rows: the capture ends short, not waiting
+    # for samples that will never arrive
+    capture = CaptureBuffer(100, 2)
+    assert capture.capture(RampScan(9, limit=30)) == 30
+    assert capture.overrun is None
+    np.testing.assert_array_equal(np.concatenate(list(capture.blocks(16))),
+                                  ramp(0, 30))
+
+
+def test_capture_buffer_overrun():
+    scan = RampScan(10)
+
+    def read_chunk():
+        result = scan()
+        return result._replace(hardware_overrun=scan.rows > 20)
+
+    capture = CaptureBuffer(100, 2)
+    assert capture.capture(read_chunk) == 20
+    assert capture.overrun == 'Hardware overrun'
+
+
+def test_ring_buffer_wraparound():
+    ring = RingBuffer(10, 2)
+    for start in range(0, 28, 4):
+        ring.write(ramp(start, 4))
+    assert ring.written == 28
+    assert ring.oldest == 18
+
+    segments = ring.segments(18, 28)
+    assert len(segments) == 2
+    np.testing.assert_array_equal(np.concatenate(segments), ramp(18, 10))
+    segments = ring.segments(20, 23)
+    assert len(segments) == 1
+    np.testing.assert_array_equal(segments[0], ramp(20, 3))
+    assert ring.segments(25, 25) == []
+
+    with pytest.raises(ValueError):
+        ring.segments(17, 20)
+    with pytest.raises(ValueError):
+        ring.segments(25, 29)
+
+
+def test_ring_buffer_oversized_block():
+    ring = RingBuffer(10, 2)
+    ring.write(ramp(0, 3))
+    ring.write(ramp(3, 25))
+    assert ring.written == 28
+    np.testing.assert_array_equal(np.concatenate(ring.segments(18, 28)),
+                                  ramp(18, 10))
+
+
+def collect(capture, block_samples):
+    return np.concatenate([np.concatenate(segments) for segments
+                           in capture.blocks(block_samples)])
+
+
+def test_pretrigger_capture_wraparound():
+    # The ring holds 40 + 30 rows, far less than the 1000 rows scanned
+    # before the trigger and the 500 after it
+    scan = RampScan(7, hold_at=1000)
+    capture = PretriggerCapture(scan, 2, 40, 500, 30)
+    capture.start()
+    assert scan.held.wait(5)
+    assert capture.trigger() == 40
+    scan.resume.set()
+    # Nothing is taken yet, so the reader must wait rather than
+    # overwrite the frozen history
+    deadline = time.monotonic() + 5
+    while not capture.reader_waits and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert capture.reader_waits
+
+    data = collect(capture, 16)
+    np.testing.assert_array_equal(data, ramp(960, 540))
+    assert capture.report()['pretrigger_samples'] == 40
+    capture.stop()
+
+
+def test_pretrigger_capture_short_history():
+    # Triggered before pre_samples were read: only what exists is kept
+    scan = RampScan(5, limit=10)
+    capture = PretriggerCapture(scan, 2, 40, 0, 30)
+    capture.start()
+    capture.thread.join()
+    assert capture.trigger(10) == 10
+    np.testing.assert_array_equal(collect(capture, 4), ramp(0, 10))
+
+
+def test_pretrigger_capture_software_trigger():
+    scan = RampScan(64, step_at=777)
+    engine = TriggerEngine(2, level=1.0, channels=[0])
+    fired = threading.Event()
+    capture = PretriggerCapture(scan, 2, 100, 200, 150, detector=engine.update,
+                                on_trigger=fired.set)
+    capture.start()
+    assert fired.wait(5)
+    assert capture.trigger_index == 777
+    data = collect(capture, 50)
+    assert len(data) == 300
+    np.testing.assert_array_equal(data[:, 1], -np.arange(677, 977))
+    assert data[99, 0] == 0.0 and data[100, 0] == 5.0
+    capture.stop()
+
+
+def test_pretrigger_capture_stop_without_trigger():
+    capture = PretriggerCapture(RampScan(8), 2, 40, 100, 30)
+    capture.start()
+    capture.stop()
+    assert not capture.thread.is_alive()
+    assert not capture.triggered
+
+    # Stopping a capture that never started does not wait for anything
+    PretriggerCapture(RampScan(8), 2, 40, 100, 30).stop()
+
+
+class FakeBoard:
+    """
+    MCC118 stand-in: channel c of sample i reads address * 100 + c + i
+    / 1000, delivered `chunks` rows at a time, one entry per read.
+    """
+    started = []
+
+    def __init__(self, address, num_channels, chunks, rate=1000.0):
+        self.address = address
+        self.num_channels = num_channels
+        self.chunks = list(chunks)
+        self.rate = rate
+        self.rows = 0
+
+    def a_in_scan_actual_rate(self, num_channels, scan_rate):
+        return min(scan_rate, self.rate)
+
+    def calibration_coefficient_read(self, channel):
+        return (self.address, channel)
+
+    def a_in_scan_start(self, mask, samples, rate, options):
+        FakeBoard.started.append((self.address, mask, options))
+
+    def a_in_scan_status(self):
+        return ScanStatus(True, False, False, self.address == 0, 10 - self.address)
+
+    def a_in_scan_read_numpy(self, samples_per_channel, timeout):
+        count = self.chunks.pop(0) if self.chunks else 0
+        index = np.arange(self.rows, self.rows + count)[:, None] / 1000.0
+        rows = self.address * 100 + np.arange(self.num_channels) + index
+        self.rows += count
+        return ScanRead(bool(self.chunks), False, False, True, False,
+                        rows.ravel())
+
+
+def expected_rows(start, count, layout):
+    index = np.arange(start, start + count)[:, None] / 1000.0
+    return np.hstack([address * 100 + np.arange(num_channels) + index
+                      for address, num_channels in layout])
+
+
+def test_hat_group_start():
+    FakeBoard.started = []
+    group = HatGroup([(0, FakeBoard(0, 2, []), [0, 1]),
+                      (2, FakeBoard(2, 1, [], rate=900.0), [3])], 0x100)
+    assert group.channels == [0, 1, 19]
+    assert group.a_in_scan_actual_rate(3, 1000.0) == 900.0
+    assert group.calibration_coefficient_read(19) == (2, 3)
+
+    group.a_in_scan_start(None, 100, 1000.0, 0x1)
+    # The follower waits for the leader's clock before the leader starts
+    assert FakeBoard.started == [(2, 0b1000, 0x101), (0, 0b11, 0x1)]
+    with pytest.raises(ValueError):
+        group.a_in_scan_start(0b11, 100, 1000.0, 0)
+
+    status = group.a_in_scan_status()
+    assert status.running and not status.triggered
+    assert status.samples_available == 8
+
+
+def test_hat_group_joins_uneven_reads():
+    # The boards deliver their rows in different chunks: only rows that
+    # both have delivered are returned, the rest wait for the next read
+    group = HatGroup([(0, FakeBoard(0, 2, [5, 0, 7, 3]), [0, 1]),
+                      (1, FakeBoard(1, 1, [3, 4, 8]), [0])], 0x100)
+    group.a_in_scan_start(None, 15, 1000.0, 0)
+    layout = [(0, 2), (1, 1)]
+    counts = []
+    data = []
+    for i in range(4):
+        result = group.a_in_scan_read_numpy(-1, 1.0)
+        rows = deinterleave_numpy(result.data, 3)
+        counts.append(len(rows))
+        data.append(rows)
+    assert counts == [3, 2, 7, 3]
+    assert not result.running
+    np.testing.assert_array_equal(np.concatenate(data),
+                                  expected_rows(0, 15, layout))
@@ -0,0 +1,105 @@
+#  -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from racs_analysis import TriggerEngine, BlockSummary, save_summary, \
+    load_summary, summary_path, summary_message
+
+
+def feed(engine, signal, block):
+    for start in range(0, len(signal), block):
+        fired = engine.update(signal[start:start + block])
+        if fired is not None:
+            return fired
+    return None
+
+
+@pytest.mark.parametrize('block', [1, 7, 1000])
+def test_trigger_level_across_blocks(block):
+    signal = np.zeros((1000, 2))
+    signal[613:, 1] = -0.8
+    assert feed(TriggerEngine(2, level=0.5), signal, block) == 613
+
+
+def test_trigger_level_from_baseline():
+    # Offset channels trigger on their departure from the baseline
+    signal = np.full((500, 2), 3.0)
+    signal[300:, 0] = 3.4
+    signal[400:, 0] = 3.6
+    engine = TriggerEngine(2, level=0.5, baseline_samples=100)
+    assert feed(engine, signal, 64) == 400
+
+
+def test_trigger_not_armed_during_baseline():
+    signal = np.zeros((300, 1))
+    signal[10] = 2.0
+    signal[250] = 2.0
+    assert feed(TriggerEngine(1, level=1.0, baseline_samples=50), signal, 32) == 250
+
+
+def test_trigger_slope():
+    # A slow ramp stays below the slope threshold, a step does not
+    signal = np.linspace(0.0, 5.0, 1000)[:, None]
+    signal[700:] += 1.0
+    assert feed(TriggerEngine(1, slope=0.5), signal, 100) == 700
+
+
+@pytest.mark.parametrize('window, expected', [(5, 103), (2, None)])
+def test_trigger_coincidence(window, expected):
+    # Single-sample hits, 3 samples apart, on two of three channels
+    signal = np.zeros((200, 3))
+    signal[100, 0] = 1.0
+    signal[103, 1] = 1.0
+    engine = TriggerEngine(3, level=0.5, coincidence=2, window=window)
+    assert feed(engine, signal, 16) == expected
+
+
+def test_trigger_channels_and_latch():
+    signal = np.zeros((100, 2))
+    signal[20:, 0] = 1.0
+    signal[60:, 1] = 1.0
+    engine = TriggerEngine(2, level=0.5, channels=[1])
+    assert feed(engine, signal, 10) == 60
+    # Once fired, later blocks are not examined
+    engine.update(np.full((10, 2), 9.0))
+    assert engine.fired == 60 and engine.count == 80
+
+
+def test_trigger_needs_threshold():
+    with pytest.raises(ValueError):
+        TriggerEngine(2)
+
+
+def test_block_summary_trigger_relative():
+    signal = np.zeros((1000, 2))
+    signal[:100] = 0.5
+    signal[400, 0] = 4.0
+    signal[50, 1] = -3.0
+    summary = BlockSummary(2, 1000.0, baseline_samples=100, trigger_index=200)
+    for start in range(0, 1000, 128):
+        summary.update(signal[start:start + 128])
+    result = summary.result()
+    assert result['max'][0] == 4.0 and result['min'][1] == -3.0
+    assert result['max_time'][0] == pytest.approx(0.2)
+    assert result['min_time'][1] == pytest.approx(-0.15)
+    assert result['baseline_mean'] == pytest.approx([0.5, 0.465])
+
+
+def test_summary_sidecar(tmp_path):
+    recording = str(tmp_path / 'DAQ_A_(01_02_2024)-(03-04-05).csv')
+    assert load_summary(recording) is None
+    summary = {'min': [-1.0], 'max': [2.0], 'mean': [0.1]}
+    save_summary(summary_path(recording), summary)
+    assert load_summary(recording) == summary
+    # A summary in the header comes first
+    assert load_summary(recording, {'summary': {'max': [3.0]}}) == {'max': [3.0]}
+
+
+def test_summary_message():
+    summary = {'min': [-1.0, -0.5], 'max': [2.0, 0.25], 'mean': [0.0, 0.0]}
+    assert summary_message(summary, [4, 7]) == '4:+2/-1 7:+0.25/-0.5'
+    # Without channels (or with the wrong number) they count from 0
+    assert summary_message(summary) == '0:+2/-1 1:+0.25/-0.5'
+    assert summary_message(summary, [4]) == '0:+2/-1 1:+0.25/-0.5'
+    assert summary_message({'min': [], 'max': [], 'mean': []}) == 'no data'
@@ -0,0 +1,102 @@
+#  -*- coding: utf-8 -*-
+
+import os
+
+import numpy as np
+
+from racs_catalog import Catalog, describe_recording, CATALOG_NAME
+from racs_recording import open_recording, csv_header_path
+
+
+def record(directory, name, header, rows=100, recording_format='float32'):
+    writer = open_recording(os.path.join(directory, name), recording_format,
+                            header)
+    writer.write(np.zeros((rows, len(header['channels']))))
+    writer.close()
+    return writer.path
+
+
+def test_add_query_latest(tmp_path, header):
+    directory = str(tmp_path)
+    catalog = Catalog(directory)
+    assert catalog.count() == 0 and catalog.latest() is None
+
+    first = record(directory, 'first', header)
+    catalog.add(first, header, 100, {'max': [1.0, 2.0, 3.0]})
+    later = dict(header, daq_name='DAQ_U',
+                 trigger_time_ns=header['trigger_time_ns'] + 10 ** 9)
+    second = record(directory, 'second', later)
+    catalog.add(second, later, 100)
+
+    assert catalog.count() == 2
+    assert [row['path'] for row in catalog.query()] == [first, second]
+    assert catalog.latest()['path'] == second
+    row = catalog.latest('DAQ_T')
+    assert row['channels'] == [0, 1, 2]
+    assert row['summary'] == {'max': [1.0, 2.0, 3.0]}
+    assert catalog.query(since_ns=later['trigger_time_ns'])[0]['path'] == second
+
+    catalog.remove(second)
+    assert catalog.count() == 1
+    catalog.close()
+
+
+def test_reconcile_with_directory(tmp_path, header):
+    directory = str(tmp_path)
+    kept = record(directory, 'kept', header)
+    gone = record(directory, 'gone', header)
+    catalog = Catalog(directory)
+    # Recordings already in the directory are cataloged when it opens
+    assert catalog.count() == 2
+    assert not catalog.refresh()
+
+    os.remove(gone)
+    copied = record(directory, 'DAQ_B_(01_02_2024)-(03-04-05)', header, 7,
+                    'csv')
+    assert catalog.refresh()
+    assert sorted(row['path'] for row in catalog.query()) == sorted([kept, copied])
+    assert catalog.count() == 2
+    catalog.close()
+
+    # The catalog persists across sessions
+    catalog = Catalog(directory)
+    assert catalog.count() == 2
+    assert sorted(os.listdir(directory)) == sorted([
+        CATALOG_NAME, os.path.basename(kept), os.path.basename(copied),
+        os.path.basename(csv_header_path(copied))])
+    catalog.close()
+
+
+def test_refresh_after_own_changes(tmp_path, header):
+    directory = str(tmp_path)
+    catalog = Catalog(directory)
+    # Recordings written and cataloged by the DAQ do not cost a walk
+    path = record(directory, 'shot', header)
+    catalog.add(path, header, 100)
+    assert not catalog.refresh()
+    os.remove(path)
+    catalog.remove(path)
+    assert not catalog.refresh()
+
+    # A recording copied in by hand still does
+    record(directory, 'copied', header)
+    assert catalog.refresh()
+    assert catalog.count() == 1
+    catalog.close()
+
+
+def test_describe_csv_recording(tmp_path, header):
+    path = record(str(tmp_path), 'DAQ_B_(01_02_2024)-(03-04-05)', header, 7,
+                  'csv')
+    # The header stored with the recording wins over its file name
+    described, samples = describe_recording(path)
+    assert samples == 7
+    assert described['daq_name'] == 'DAQ_T'
+    assert described['trigger_time_ns'] == header['trigger_time_ns']
+    assert described['pretrigger_samples'] == 0
+
+    os.remove(csv_header_path(path))
+    described, samples = describe_recording(path)
+    assert samples == 7
+    assert described['daq_name'] == 'DAQ_B'
+    assert described['trigger_time'] == '2024-01-02T03:04:05'
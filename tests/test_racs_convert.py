@@ -0,0 +1,87 @@
+#  -*- coding: utf-8 -*-
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+import racs_convert
+from racs_recording import open_recording, read_recording, read_csv_header
+
+
+def record(directory, name, header, data, recording_format='float64',
+           compression=None):
+    options = {'workers': 0} if compression else {}
+    writer = open_recording(os.path.join(directory, name), recording_format,
+                            header, compression, **options)
+    writer.write(data)
+    writer.close()
+    return writer.path
+
+
+def convert(monkeypatch, *argv):
+    monkeypatch.setattr(sys, 'argv', ['racs_convert.py'] + list(argv))
+    racs_convert.main()
+
+
+def test_decimate():
+    block = np.arange(14, dtype=np.float64).reshape(7, 2)
+    np.testing.assert_array_equal(racs_convert.decimate(block, 3),
+                                  [[2, 3], [8, 9], [12, 13]])
+
+
+def test_convert_directory(tmp_path, monkeypatch, header, volts):
+    source = str(tmp_path / 'source')
+    os.makedirs(source)
+    record(source, 'first', header, volts)
+    record(source, 'second', header, volts[::-1])
+    csv_dir = str(tmp_path / 'csv')
+    convert(monkeypatch, source, csv_dir, '--to', 'csv', '--precision', '6',
+            '--workers', '1', '--chunk-rows', '300')
+    assert sorted(os.listdir(csv_dir)) == [
+        'first.csv', 'first.header.json', 'second.csv', 'second.header.json']
+    stored = read_csv_header(os.path.join(csv_dir, 'second.csv'))
+    assert stored['trigger_time_ns'] == header['trigger_time_ns']
+
+    # And back, compressed, on whole chunks of 64 rows
+    binary_dir = str(tmp_path / 'binary')
+    convert(monkeypatch, csv_dir, binary_dir, '--to', 'float64',
+            '--compression', 'zlib', '--scan-rate', '1000', '--workers', '1',
+            '--chunk-rows', '256', '--chunk-samples', '64')
+    converted, data = read_recording(os.path.join(binary_dir, 'second.racz'))
+    np.testing.assert_allclose(data, volts[::-1], atol=1e-6)
+    assert converted['scan_rate'] == 1000
+
+
+def test_convert_decimated(tmp_path, monkeypatch, header, volts):
+    source = record(str(tmp_path), 'shot', dict(header, pretrigger_samples=100),
+                    volts)
+    dest = str(tmp_path / 'decimated')
+    convert(monkeypatch, source, dest, '--to', 'float32', '--decimate', '4',
+            '--workers', '1')
+    converted, data = read_recording(os.path.join(dest, 'shot.racs'))
+    assert converted['scan_rate'] == 250
+    assert converted['pretrigger_samples'] == 25
+    np.testing.assert_allclose(data, volts.reshape(250, 4, 3).mean(axis=1),
+                               rtol=1e-6)
+
+
+def test_refuses_to_overwrite_source(tmp_path, monkeypatch, header, volts):
+    directory = str(tmp_path)
+    source = record(directory, 'shot', header, volts)
+    with pytest.raises(SystemExit):
+        convert(monkeypatch, directory, directory, '--to', 'float64')
+    np.testing.assert_array_equal(read_recording(source)[1], volts)
+
+
+def test_refuses_duplicate_outputs(tmp_path, monkeypatch, header, volts):
+    source = str(tmp_path / 'source')
+    os.makedirs(source)
+    record(source, 'shot', header, volts)
+    record(source, 'shot', header, volts[::-1], compression='zlib')
+    dest = str(tmp_path / 'csv')
+    with pytest.raises(SystemExit):
+        convert(monkeypatch, source, dest, '--to', 'csv', '--workers', '1')
+    # Nothing was converted, not even the first of the pair
+    assert not os.path.exists(dest)
@@ -0,0 +1,220 @@
+#  -*- coding: utf-8 -*-
+
+import binascii
+import os
+import sys
+import threading
+
+import numpy as np
+import pytest
+
+import soak_controller
+from racs_analysis import save_summary, summary_path
+from racs_catalog import Catalog
+from racs_recording import open_recording, read_recording, csv_header_path
+
+
+@pytest.fixture
+def daq(monkeypatch):
+    # The DAQ script, on the simulated hardware modules of the soak test
+    if 'RACS_DAQA' not in sys.modules:
+        soak_controller.install_stubs()
+    import RACS_DAQA
+    monkeypatch.setattr(RACS_DAQA, 'time', soak_controller.FastClock)
+    monkeypatch.setattr(RACS_DAQA, 'RESPONSE_DELAY', 0)
+    monkeypatch.setattr(RACS_DAQA, 'EXTRA_LEAD_TIME', 0)
+    return RACS_DAQA
+
+
+def lostik(daq):
+    # The LoStik protocol with the commands it sends collected
+    reader = daq.PrintLines()
+    reader.sent = []
+    reader.send_cmd = lambda cmd, delay=.5: reader.sent.append(cmd)
+    return reader
+
+
+def replies(reader):
+    return [binascii.unhexlify(cmd[9:]).decode() for cmd in reader.sent
+            if cmd.startswith('radio tx ')]
+
+
+def length_message(daq, text):
+    return daq.RECORDINGLENGTH_SIG[:10] + binascii.hexlify(
+        ('MCCRL ' + text).encode()).decode().upper()
+
+
+# Module state of the DAQ script that a session changes
+SESSION_STATE = ['hat', 'radio', 'catalog', 'controller', 'basepath',
+                 'mypath', 'scan_rate', 'actual_scan_rate',
+                 'requested_scan_rate', 'samples_per_channel', 'num_channels',
+                 'scan_channels', 'channel_mask', 'options', 'recording_length',
+                 'write_bandwidth', 'CMD_RECEIVED', 'CMD_SHUTDOWN',
+                 'REARM_REQUESTED', 'armed_shot', 'trigger_time_ns',
+                 'first_read', 'trigger_latency_ns']
+
+
+@pytest.fixture
+def session(tmp_path, monkeypatch, daq):
+    """
+    Runs whole sessions of the DAQ script on the simulated LoStik and
+    MCC118 of the soak test: every READY is answered with the trigger,
+    the one after `shots` shots with the shutdown command. Returns a
+    function running a session, and the list of every command the
+    script sent to the LoStik.
+    """
+    for name in SESSION_STATE:
+        # Restored, or removed again if the script had not set it yet
+        monkeypatch.setattr(daq, name, getattr(daq, name, None),
+                            raising=False)
+    monkeypatch.setattr(daq, 'pending_commands', [])
+    monkeypatch.setattr(daq, 'basepath', str(tmp_path))
+    monkeypatch.setattr(daq, 'mypath', str(tmp_path / 'DATA'))
+    monkeypatch.setattr(daq, 'WRITE_BANDWIDTH_MB', 100.0)
+    monkeypatch.setattr(daq, 'scan_rate', 1000.0)
+    monkeypatch.setattr(daq, 'recording_length', 1)
+    monkeypatch.setattr(soak_controller, 'daq', daq, raising=False)
+    sent = []
+    write = soak_controller.SimulatedReaderThread.write
+
+    def record_write(self, data):
+        sent.append(data.decode().strip())
+        write(self, data)
+
+    monkeypatch.setattr(soak_controller.SimulatedReaderThread, 'write',
+                        record_write)
+
+    def run(shots):
+        monkeypatch.setattr(soak_controller, 'shots_wanted', shots,
+                            raising=False)
+        finished = []
+        controller = daq.ShotController(
+            daq.setup_session, daq.arm_shot,
+            lambda shot: daq.wait_for_trigger(daq.hat, shot[1]),
+            daq.record_shot,
+            lambda shot: finished.append(daq.finalize_shot(shot) or shot[0]),
+            daq.abort_shot, daq.teardown_session)
+        daq.controller = controller
+        assert controller.run() == shots
+        return finished
+
+    return run, sent
+
+
+def test_stats_after_catalog_rebuild(tmp_path, monkeypatch, daq, header):
+    # A CSV recording from before headers were stored next to it: the
+    # rebuilt catalog knows its channels only from its columns
+    directory = str(tmp_path)
+    path_base = os.path.join(directory, 'DAQ_A_(01_02_2024)-(03-04-05)')
+    writer = open_recording(path_base, 'csv', header)
+    writer.write(np.zeros((10, 3)))
+    writer.close()
+    os.remove(csv_header_path(writer.path))
+    save_summary(summary_path(writer.path), {
+        'min': [-1.0, -2.0, -3.0], 'max': [1.0, 2.0, 3.0], 'mean': [0.0] * 3})
+    catalog = Catalog(directory)
+    assert catalog.latest('DAQ_A')['channels'] == [0, 1, 2]
+    monkeypatch.setattr(daq, 'catalog', catalog)
+
+    reader = lostik(daq)
+    reader.handle_line(daq.STATS_SIG)
+    assert replies(reader) == ['DAQ_A Sts 0:+1/-1 1:+2/-2 2:+3/-3']
+    assert reader.sent[-1] == 'radio rx 0'
+    catalog.close()
+
+
+def test_stats_survives_catalog_error(tmp_path, monkeypatch, daq):
+    catalog = Catalog(str(tmp_path))
+    catalog.close()
+    monkeypatch.setattr(daq, 'catalog', catalog)
+
+    # The reply still goes out, and the reader thread lives on
+    reader = lostik(daq)
+    reader.handle_line(daq.STATS_SIG)
+    assert replies(reader) == ['DAQ_A Sts no data']
+
+
+LEAD_TIME = 0.25
+
+
+class LeadClock(soak_controller.FastClock):
+    """
+    FastClock whose sleep of EXTRA_LEAD_TIME waits until `lit` is set.
+    """
+    waiting = threading.Event()
+    lit = threading.Event()
+
+    @classmethod
+    def sleep(cls, seconds):
+        if seconds == LEAD_TIME:
+            cls.waiting.set()
+            cls.lit.wait(5)
+
+
+@pytest.mark.parametrize('rearmed', [False, True])
+def test_radio_trigger_applies_to_its_shot(monkeypatch, daq, rearmed):
+    monkeypatch.setattr(daq, 'time', LeadClock)
+    monkeypatch.setattr(daq, 'EXTRA_LEAD_TIME', LEAD_TIME)
+    monkeypatch.setattr(daq, 'CMD_RECEIVED', 1)
+    monkeypatch.setattr(daq, 'armed_shot', 1)
+    LeadClock.waiting.clear()
+    LeadClock.lit.clear()
+    daq.wake.clear()
+
+    reader = lostik(daq)
+    thread = threading.Thread(target=reader.handle_line, args=(daq.REC_SIG,))
+    thread.start()
+    assert LeadClock.waiting.wait(5)
+    if rearmed:
+        # The shot ended on its software trigger and the next one was
+        # armed while the radio trigger waited out the lead time
+        daq.armed_shot += 1
+    LeadClock.lit.set()
+    thread.join()
+
+    assert replies(reader) == ['DAQ_A Trg']
+    assert daq.CMD_RECEIVED == (1 if rearmed else 0)
+    assert daq.wake.is_set() != rearmed
+    daq.wake.clear()
+
+
+def test_length_message_checked_before_queuing(monkeypatch, daq):
+    monkeypatch.setattr(daq, 'controller', None)
+    monkeypatch.setattr(daq, 'pending_commands', [])
+    reader = lostik(daq)
+    for text in ['', 'ten', '-5', '0']:
+        reader.handle_line(length_message(daq, text))
+    assert reader.sent.count('radio rx 0') == 4
+    reader.handle_line(daq.RECORDINGLENGTH_SIG + 'ZZ')
+    assert daq.pending_commands == []
+
+    # Armed: a bad length is reported, the shot keeps its length
+    monkeypatch.setattr(daq, 'recording_length', 10)
+    monkeypatch.setattr(daq, 'REARM_REQUESTED', 0)
+    reader.handle_armed_command(length_message(daq, 'ten'))
+    assert daq.recording_length == 10 and not daq.REARM_REQUESTED
+    reader.handle_armed_command(length_message(daq, '12'))
+    assert daq.recording_length == 12 and daq.REARM_REQUESTED
+    daq.wake.clear()
+
+
+def test_queued_commands_applied_when_armed(monkeypatch, daq, session):
+    run, sent = session
+    monkeypatch.setattr(daq, 'controller', None)
+    reader = lostik(daq)
+    reader.handle_line(daq.PING_SIG)
+    reader.handle_line(length_message(daq, '3'))
+    reader.handle_line(daq.PING_SIG)
+    # Pings queued for the same shot get one answer
+    assert daq.pending_commands == [daq.PING_SIG, length_message(daq, '3')]
+
+    finished = run(1)
+    # The new length applies to the next shot without a re-arm
+    assert finished[0].samples_written == 3000
+    assert read_recording(finished[0].path)[1].shape == (3000, len(daq.channels))
+    tx = [binascii.unhexlify(cmd[9:]).decode() for cmd in sent
+          if cmd.startswith('radio tx ')]
+    # The pings are answered once, after the shot is reported ready
+    pings = [reply for reply in tx if ' Png' in reply]
+    assert tx[0] == daq.READY_RESPONSE and len(pings) == 1
+    assert daq.pending_commands == []
@@ -0,0 +1,108 @@
+#  -*- coding: utf-8 -*-
+
+import os
+
+import numpy as np
+import pytest
+
+from racs_merge import RecordingStream, plan_merge, merge
+from racs_recording import open_recording, read_recording, \
+    csv_header_path
+
+
+def ramp(count, scale=1.0):
+    index = np.arange(count, dtype=np.float64)
+    return np.column_stack([index, -index]) * scale
+
+
+def record(directory, name, header, data, recording_format='float64',
+           **options):
+    writer = open_recording(os.path.join(directory, name), recording_format,
+                            header, **options)
+    writer.write(data)
+    writer.close()
+    return writer.path
+
+
+@pytest.fixture
+def shot(tmp_path, header):
+    # DAQ_B triggered 5 ms (5 samples) after DAQ_A
+    directory = str(tmp_path)
+    a = dict(header, daq_name='DAQ_A', channels=[0, 1])
+    b = dict(a, daq_name='DAQ_B',
+             trigger_time_ns=header['trigger_time_ns'] + 5 * 10 ** 6)
+    return [record(directory, 'a', a, ramp(100)),
+            record(directory, 'b', b, ramp(80, 10.0), 'float32')]
+
+
+def test_merge_nearest(tmp_path, shot):
+    streams = [RecordingStream(path) for path in shot]
+    nodes, start_ns, rate, samples = plan_merge(streams)
+    assert [node.offset for node in nodes] == [0.0, 0.005]
+    assert rate == 1000.0 and samples == 100
+
+    writer = open_recording(str(tmp_path / 'merged'), 'float64',
+                            {'channels': list(range(4)), 'scan_rate': rate})
+    assert merge(nodes, rate, samples, writer, window=32) == 100
+    writer.close()
+    data = read_recording(writer.path)[1]
+    np.testing.assert_array_equal(data[:, :2], ramp(100))
+    assert np.isnan(data[:5, 2:]).all() and np.isnan(data[85:, 2:]).all()
+    np.testing.assert_array_equal(data[5:85, 2:], ramp(80, 10.0))
+
+
+def test_merge_resample(shot):
+    streams = [RecordingStream(path) for path in shot]
+    nodes, start_ns, rate, samples = plan_merge(streams, rate=2000.0)
+    assert samples == 200
+    times = np.arange(samples) / rate
+    a = nodes[0].sample(times, resample=True)
+    # Linear between the samples of the ramp, NaN after the last one
+    np.testing.assert_allclose(a[:199], ramp(199) / 2)
+    assert np.isnan(a[199]).all()
+
+    # A clock running 1000 ppm fast sampled 0.1% more than scan_rate
+    nodes, start_ns, rate, samples = plan_merge(streams, drift={'DAQ_A': 1000.0})
+    a = nodes[0].sample(np.arange(50) / rate, resample=True)
+    np.testing.assert_allclose(a[:, 0], np.arange(50) * 1.001)
+
+
+def test_csv_stream_time_column(tmp_path, header):
+    path = record(str(tmp_path), 'c', dict(header, channels=[0, 1]),
+                  ramp(300), 'csv', precision=3, time_column='epoch_ns')
+    # Scan rate and channels come from the header stored with the CSV
+    stream = RecordingStream(path, csv_rows=64)
+    assert stream.header['scan_rate'] == 1000.0
+    assert stream.num_channels == 2 and stream.total == 300
+    np.testing.assert_array_equal(stream.rows(0, 10), ramp(10))
+    np.testing.assert_array_equal(stream.rows(150, 290), ramp(290)[150:])
+    stream.close()
+
+
+def test_csv_exact_trigger(tmp_path, header):
+    # A CSV node triggered 7.5 ms into the second, with 20 samples of
+    # history, is placed as exactly as a binary one
+    directory = str(tmp_path)
+    a = dict(header, daq_name='DAQ_A', channels=[0, 1])
+    c = dict(a, daq_name='DAQ_C', pretrigger_samples=20,
+             trigger_time_ns=header['trigger_time_ns'] + 7500000)
+    streams = [RecordingStream(record(directory, 'a', a, ramp(100))),
+               RecordingStream(record(directory, 'DAQ_C_(11_14_2023)-(22-13-20)',
+                                      c, ramp(50), 'csv'))]
+    nodes, start_ns, rate, samples = plan_merge(streams)
+    assert start_ns == header['trigger_time_ns'] - 12500000
+    assert [node.offset for node in nodes] == [0.0125, 0.0]
+    streams[1].close()
+
+
+def test_csv_without_stored_header(tmp_path, header):
+    # Only the second is known from the file name: merging it would
+    # silently misalign the node
+    path = record(str(tmp_path), 'DAQ_C_(01_02_2024)-(03-04-05)',
+                  dict(header, channels=[0, 1]), ramp(10), 'csv')
+    os.remove(csv_header_path(path))
+    stream = RecordingStream(path, scan_rate=1000.0)
+    assert stream.header['trigger_time_ns'] is not None
+    with pytest.raises(ValueError):
+        plan_merge([stream])
+    stream.close()
@@ -0,0 +1,88 @@
+#  -*- coding: utf-8 -*-
+
+import json
+import os
+import time
+
+import numpy as np
+import pytest
+
+import racs_planner
+from racs_planner import plan_scan, bytes_per_row, measure_encode_cost, \
+    cached_write_bandwidth, save_write_bandwidth, PlanError, BANDWIDTH_CACHE
+
+
+def test_plan_board_limit():
+    # Four channels on the busiest board share its 100 kS/s
+    plan = plan_scan([2, 4], 'float32', 1e9)
+    assert plan.actual_scan_rate == 25000.0
+    assert not plan.downgraded
+
+
+def test_plan_downgrades_to_disk():
+    row = bytes_per_row('float32', 2)
+    plan = plan_scan([2], 'float32', 4e5, requested_rate=40000.0,
+                     disk_budget=0.5)
+    assert plan.downgraded
+    assert plan.actual_scan_rate == pytest.approx(2e5 / row)
+    assert plan.bytes_per_second <= 2e5 * 1.000001
+    assert 'write bandwidth' in plan.notes[0]
+
+    with pytest.raises(PlanError):
+        plan_scan([2], 'float32', 4e5, requested_rate=40000.0,
+                  downgrade=False)
+    # Lowering the rate does not help channels that need more
+    with pytest.raises(PlanError):
+        plan_scan([2], 'float32', 4e5, requested_rate=40000.0,
+                  min_rates={0: 40000.0})
+
+
+def test_plan_cpu_and_clock_rounding():
+    # 10 us of encoding per scan, half a core: 50 kS/s at most. The
+    # boards round the rate up, so the planner steps below it.
+    plan = plan_scan([1], 'float64', 1e9, lambda rate: rate * 1.01,
+                     requested_rate=60000.0, encode_cost=1e-5)
+    assert plan.actual_scan_rate <= 50000.0 * 1.000001
+    assert plan.cpu_load == pytest.approx(plan.actual_scan_rate * 1e-5)
+
+
+@pytest.mark.parametrize('recording_format, options', [
+    ('csv', {'precision': None}),
+    ('csv', {'precision': 5, 'time_column': 'seconds'}),
+    ('int16', {'compression': 'zlib'}),
+])
+def test_encode_cost_runs_writer_and_analysis(recording_format, options):
+    blocks = []
+
+    def analyse(block, header):
+        blocks.append(len(block))
+        if recording_format == 'int16':
+            assert header['raw'] and block.dtype == np.int16
+
+    cost = measure_encode_cost(recording_format, 3, rows=1000,
+                               analyse=analyse, block_rows=300, **options)
+    assert cost > 0
+    assert blocks == [300, 300, 300, 100]
+
+
+def test_cached_write_bandwidth(tmp_path, monkeypatch):
+    directory = str(tmp_path)
+    measured = []
+    monkeypatch.setattr(racs_planner, 'measure_write_bandwidth',
+                        lambda directory: measured.append(1) or 12e6)
+    assert cached_write_bandwidth(directory) == (12e6, True)
+    assert cached_write_bandwidth(directory) == (12e6, False)
+    assert len(measured) == 1
+
+    # An old measurement, or one of another card, is taken again
+    save_write_bandwidth(directory, 20e6)
+    path = os.path.join(directory, BANDWIDTH_CACHE)
+    with open(path) as f:
+        cached = json.load(f)
+    with open(path, 'w') as f:
+        json.dump(dict(cached, measured=time.time() - 31 * 86400), f)
+    assert cached_write_bandwidth(directory, 30.0) == (12e6, True)
+    with open(path, 'w') as f:
+        json.dump(dict(cached, device=cached['device'] + 1), f)
+    assert cached_write_bandwidth(directory) == (12e6, True)
+    assert len(measured) == 3
@@ -0,0 +1,223 @@
+#  -*- coding: utf-8 -*-
+
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+import racs_recording
+from racs_recording import open_recording, read_recording, read_rows, \
+    recover_recording, read_header, estimate_recording_size, raw_header, \
+    start_compression_pool, MCC118_LSB, MCC118_MIN_VOLTS, PART_SUFFIX
+
+
+def to_codes(volts):
+    return np.rint((volts - MCC118_MIN_VOLTS) / MCC118_LSB).astype(np.int16)
+
+
+def write_blocks(writer, data, block=128):
+    for start in range(0, len(data), block):
+        writer.write(data[start:start + block])
+
+
+@pytest.mark.parametrize('recording_format', ['float32', 'float64'])
+@pytest.mark.parametrize('compression', [None, 'zlib', 'lzma'])
+def test_float_round_trip(tmp_path, header, volts, recording_format,
+                          compression):
+    options = {'chunk_samples': 300, 'workers': 0} if compression else {}
+    writer = open_recording(str(tmp_path / 'shot'), recording_format, header,
+                            compression, **options)
+    write_blocks(writer, volts)
+    writer.close()
+
+    stored, data = read_recording(writer.path)
+    assert stored['samples_per_channel'] == len(volts)
+    assert stored['daq_name'] == 'DAQ_T'
+    assert data.dtype == np.dtype(recording_format)
+    np.testing.assert_array_equal(data, volts.astype(recording_format))
+    np.testing.assert_array_equal(read_rows(writer.path, 250, 700),
+                                  volts[250:700].astype(recording_format))
+
+
+def test_compression_pool_started(tmp_path, header, volts):
+    # Every worker is running before the first shot, and none of them
+    # was forked from the process running the scan
+    start_compression_pool(2, 'lzma')
+    pool = racs_recording._pool
+    assert len(pool._processes) == 2
+    assert pool._mp_context.get_start_method() == 'forkserver'
+
+    writer = open_recording(str(tmp_path / 'shot'), 'float64', header, 'lzma',
+                            chunk_samples=300, workers=2)
+    write_blocks(writer, volts)
+    writer.close()
+    np.testing.assert_array_equal(read_recording(writer.path)[1], volts)
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_raw_round_trip(tmp_path, header, volts, compression):
+    options = {'chunk_samples': 300, 'workers': 0} if compression else {}
+    header = dict(header, **raw_header([(1.0, 0.0)] * 3))
+    writer = open_recording(str(tmp_path / 'shot'), 'int16', header,
+                            compression, **options)
+    write_blocks(writer, to_codes(volts))
+    writer.close()
+
+    np.testing.assert_array_equal(read_recording(writer.path, raw=True)[1],
+                                  to_codes(volts))
+    np.testing.assert_allclose(read_recording(writer.path)[1], volts)
+
+
+@pytest.mark.parametrize('precision', [None, 5])
+def test_csv_round_trip(tmp_path, header, volts, precision):
+    writer = open_recording(str(tmp_path / 'shot'), 'csv', header,
+                            precision=precision)
+    write_blocks(writer, volts)
+    writer.close()
+
+    stored, data = read_recording(writer.path)
+    assert stored['samples_per_channel'] == len(volts)
+    np.testing.assert_allclose(data, volts, atol=1e-5 if precision else 0)
+    # The header is kept next to the CSV, exact trigger time included
+    assert stored['trigger_time_ns'] == header['trigger_time_ns']
+    assert stored['scan_rate'] == header['scan_rate']
+    assert stored['pretrigger_samples'] == 0
+
+
+@pytest.mark.parametrize('precision', [None, 5])
+@pytest.mark.parametrize('time_column', ['seconds', 'epoch_ns'])
+def test_csv_time_column(tmp_path, header, volts, precision, time_column):
+    writer = open_recording(str(tmp_path / 'shot'), 'csv', header,
+                            precision=precision, time_column=time_column)
+    write_blocks(writer, volts)
+    writer.close()
+
+    stored, data = read_recording(writer.path)
+    assert stored['time_column'] == time_column
+    np.testing.assert_allclose(data, volts, atol=1e-5 if precision else 0)
+    with open(writer.path) as f:
+        first = f.readline().split(',')[0]
+    assert float(first) == (0.0 if time_column == 'seconds'
+                            else header['trigger_time_ns'])
+
+
+def crash_image(writer, tmp_path):
+    # Copy of the '.part' file as a power loss would leave it, taken
+    # after the last sync; the writer itself is then thrown away
+    writer.file.flush()
+    writer.file.raw.sync()
+    name = os.path.basename(writer.file.raw.name)
+    image = str(tmp_path / 'crash' / name)
+    os.makedirs(os.path.dirname(image), exist_ok=True)
+    shutil.copyfile(writer.file.raw.name, image)
+    writer.discard()
+    return image
+
+
+def test_recover_binary(tmp_path, header, volts):
+    writer = open_recording(str(tmp_path / 'shot'), 'float64', header,
+                            durable=True)
+    write_blocks(writer, volts[:600])
+    image = crash_image(writer, tmp_path)
+    # The last frame only partly reached the card, although the count
+    # committed with it did
+    with open(image, 'r+b') as f:
+        f.truncate(os.path.getsize(image) - 5)
+
+    path, samples = recover_recording(image)
+    assert not path.endswith(PART_SUFFIX) and os.path.exists(path)
+    assert not os.path.exists(image)
+    assert samples == 599
+    assert os.path.getsize(path) == read_header(path)['data_offset'] + 599 * 24
+    np.testing.assert_array_equal(read_recording(path)[1], volts[:599])
+
+
+def test_recover_csv(tmp_path, header, volts):
+    writer = open_recording(str(tmp_path / 'shot'), 'csv', header,
+                            precision=5, durable=True)
+    write_blocks(writer, volts[:600])
+    image = crash_image(writer, tmp_path)
+    # Cut in the middle of the last row
+    with open(image, 'r+b') as f:
+        f.truncate(os.path.getsize(image) - 7)
+
+    path, samples = recover_recording(image)
+    assert samples == 599
+    np.testing.assert_allclose(read_recording(path)[1], volts[:599],
+                               atol=1e-5)
+
+
+def test_recover_compressed(tmp_path, header, volts):
+    writer = open_recording(str(tmp_path / 'shot'), 'float64', header, 'zlib',
+                            chunk_samples=200, workers=0, durable=True)
+    write_blocks(writer, volts[:700])
+    image = crash_image(writer, tmp_path)
+    # The last complete chunk loses its tail; the 100 rows still being
+    # gathered never reached the file
+    with open(image, 'r+b') as f:
+        f.truncate(os.path.getsize(image) - 10)
+
+    path, samples = recover_recording(image)
+    assert samples == 400
+    np.testing.assert_array_equal(read_recording(path)[1], volts[:400])
+
+
+def test_set_trigger_renames(tmp_path, header, volts):
+    armed = dict(header, trigger_time_ns=None, trigger_time=None)
+    writer = open_recording(str(tmp_path / 'armed'), 'float32', armed,
+                            durable=True, preallocate=1 << 20)
+    assert os.path.exists(str(tmp_path / 'armed.racs') + PART_SUFFIX)
+    writer.set_trigger(header['trigger_time_ns'], str(tmp_path / 'shot'))
+    write_blocks(writer, volts)
+    writer.close()
+
+    assert os.listdir(str(tmp_path)) == ['shot.racs']
+    assert read_header(writer.path)['trigger_time_ns'] == header['trigger_time_ns']
+    # The unused part of the reservation is released
+    assert os.path.getsize(writer.path) == read_header(writer.path)['data_offset'] \
+        + len(volts) * 12
+
+
+@pytest.mark.parametrize('recording_format', ['csv', 'float32', 'int16'])
+def test_discard_leaves_nothing(tmp_path, header, recording_format):
+    writer = open_recording(str(tmp_path / 'armed'), recording_format,
+                            dict(header, **raw_header([(1.0, 0.0)] * 3)),
+                            durable=True, preallocate=1 << 20)
+    writer.discard()
+    assert os.listdir(str(tmp_path)) == []
+
+
+@pytest.mark.parametrize('recording_format', ['float64', 'csv'])
+def test_recover_preallocated(tmp_path, header, volts, recording_format):
+    # The reservation past the last sync reads back as zeros
+    options = {'precision': 5} if recording_format == 'csv' else {}
+    size = estimate_recording_size(recording_format, len(volts), 3, **options)
+    writer = open_recording(str(tmp_path / 'shot'), recording_format, header,
+                            durable=True, preallocate=size, **options)
+    write_blocks(writer, volts[:600])
+    image = crash_image(writer, tmp_path)
+    assert os.path.getsize(image) == size
+
+    path, samples = recover_recording(image)
+    assert samples == 600
+    np.testing.assert_allclose(read_recording(path)[1], volts[:600], atol=1e-5)
+
+
+def test_preallocated_without_durable_commits_count(tmp_path, header, volts):
+    # Not durable, so nothing is synced, but the count still follows the
+    # frames written: a crashed file reads back at its final name
+    size = estimate_recording_size('float64', len(volts), 3)
+    writer = open_recording(str(tmp_path / 'shot'), 'float64', header,
+                            preallocate=size, sync_bytes=4096)
+    write_blocks(writer, volts[:600])
+    writer.file.flush()
+    image = str(tmp_path / 'crash.racs')
+    shutil.copyfile(writer.path, image)
+    writer.close()
+
+    committed = read_header(image)['samples_per_channel']
+    assert 600 - 4096 // 24 <= committed <= 600
+    path, samples = recover_recording(image)
+    assert samples == committed
+    np.testing.assert_array_equal(read_recording(path)[1], volts[:committed])